@@ -183,6 +183,21 @@ preserve_hardlinks = 1
 # increments.  Default is to compress based on regexp below.
 compression = 1
 
+# Codec used to compress increments, one of the names in
+# rpath.compression_codecs, and the level (1-9) used when writing
+# compressed files.  The codec is recorded in the increment's suffix.
+# A level of None means the codec's default.
+compression_codec = "gzip"
+compression_level = None
+
+# Before an increment is compressed, up to compression_sample_size
+# bytes from the start of the mirror file are compressed as a test.
+# If the sample's size divided by its compressed size is less than
+# compression_min_ratio, the increment is stored uncompressed.  A
+# sample size of 0 turns the test off.
+compression_sample_size = 64 * 1024
+compression_min_ratio = 1.1
+
 # Increments based on files whose names match this
 # case-insensitive regular expression won't be compressed (applies
 # to .snapshots and .diffs).  The second below will be the
@@ -192,6 +207,85 @@ no_compression_regexp_string = ("(?i).*\\.(gz|z|bz|bz2|tgz|zip|rpm|deb|"
     "gpg|rz|lzh|zoo|lharc|rar|arj|asc)$")
 no_compression_regexp = None
 
+# Format new mirror_metadata files are written in, "text" or
+# "binary".  If None, use the format recorded in the repository's
+# rdiff-backup-data/metadata_format file, or text if there is none.
+metadata_format = None
+
+# Number of bytes to read at a time from mirror_metadata, extended
+# attribute, and ACL files.  Larger reads may help when the
+# rdiff-backup-data directory is on a slow seeking disk.
+metadata_blocksize = 32 * 1024
+
+# If true, gzip compression and decompression of local metadata, EA
+# and ACL files is done in a separate thread (see FlatFile), so it
+# can overlap with the rest of the backup or restore.
+metadata_threads = 1
+
+# Maximum size in bytes of the rdiff-backup-data/metadata_cache
+# directory, which holds metadata snapshots made by patching metadata
+# diffs (see metadata.MetadataCache).  0 means don't add to the cache.
+metadata_cache_size = 64 * 1024 * 1024
+
+# Number of threads reading directory listings ahead of the walk over
+# the source directory (see selection.DirPrefetcher), and the maximum
+# number of listings read ahead.  Useful when each lstat is slow, for
+# instance on NFS.  0 threads means list directories only when needed.
+walker_threads = 0
+walker_prefetch = 64
+
+# Number of threads making the deltas of changed files on the source
+# side ahead of the destination reading them (see backup.DeltaPool),
+# and the number of bytes of finished deltas they may keep in memory
+# before writing them to temp files.  0 threads means make each delta
+# only when it is read.
+delta_threads = 0
+delta_buffer_size = 64 * 1024 * 1024
+
+# Number of threads making the increments of changed regular files on
+# the destination side, while the next files are patched (see
+# backup.IncrementPool).  0 means make each increment right after its
+# file is patched.
+increment_threads = 0
+
+# Signatures and deltas of files of at least chunked_delta_min_size
+# bytes are made in chunks of delta_chunk_size bytes, by
+# delta_chunk_threads threads (see librsync.ChunkedDeltaFile).  0 means
+# never chunk, as versions before 1.3.4 can't read chunked deltas.
+chunked_delta_min_size = 0
+delta_chunk_size = 1024 * 1024 * 1024
+delta_chunk_threads = 4
+
+# When a mirror file of at least signature_cache_min_size bytes is
+# written, its rsync signature is kept in rdiff-backup-data/signatures
+# so the next backup doesn't have to read the file to make it (see
+# sigcache.py).  The stored signatures take up at most
+# signature_cache_size bytes; 0 means don't keep any.
+signature_cache_size = 1024 * 1024 * 1024
+signature_cache_min_size = 1024 * 1024
+
+# If set, a new regular file of at least rename_min_size bytes with the
+# inode, size, and mtime of a mirror file recorded in the last backup
+# is taken to be renamed, and is sent as a delta against the old mirror
+# file (see backup.RenameDetector).  0 means don't look for renamed
+# files, because that takes an extra pass over the source.
+rename_min_size = 0
+
+# Directories with more entries than this are listed without keeping
+# all the filenames in memory: they are sorted in runs of this many
+# names, which are written to temp files and merged (see
+# rpath.listdir_sorted).  0 means always sort in memory.
+listdir_run_size = 10000
+
+# If true, data is copied between local uncompressed files by the
+# kernel, with copy_file_range or sendfile (see rpath.copy_fd_local).
+kernel_copy = 1
+
+# If true, local copies of files with holes keep them: the holes are
+# skipped and other blocks of zeros become holes too (see
+# rpath.copy_sparse).  Set by --no-sparse-files.
+sparse_files = 1
+
 # If true, filelists and directory statistics will be split on
 # nulls instead of newlines.
 null_separator = None
@@ -234,6 +328,13 @@ compare_inode = 1
 # guarantee that any changes have been committed to disk.
 fsync_directories = None
 
+# Increments written during a backup are synced to disk together, in
+# batches of up to fsync_batch_size files or fsync_batch_time seconds,
+# before the mirror files they belong to are changed (see
+# backup.SyncBatch).  A batch size of 1 fsyncs each increment alone.
+fsync_batch_size = 1000
+fsync_batch_time = 2.0
+
 # If set, exit with error instead of dropping ACLs or ACL entries.
 never_drop_acls = None
 
@@ -59,34 +59,45 @@ def parse_cmdlineoptions(arglist):
 
 	try: optlist, args = getopt.getopt(arglist, "blr:sv:V",
 		 ["backup-mode", "calculate-average", "carbonfile",
-		  "check-destination-dir",
+		  "check-destination-dir", "chunked-delta-min-size=",
 		  "compare", "compare-at-time=", "compare-hash",
 		  "compare-hash-at-time=", "compare-full", "compare-full-at-time=",
-		  "create-full-path", "current-time=", "exclude=",
+		  "compression-codec=", "compression-level=",
+		  "compression-min-ratio=", "compression-sample-size=",
+		  "convert-metadata=", "create-full-path", "current-time=",
+		  "delta-buffer-size=", "delta-chunk-size=", "delta-chunk-threads=",
+		  "delta-threads=", "exclude=",
 		  "exclude-device-files", "exclude-fifos", "exclude-filelist=",
 		  "exclude-symbolic-links", "exclude-sockets",
 		  "exclude-filelist-stdin", "exclude-globbing-filelist=",
 		  "exclude-globbing-filelist-stdin", "exclude-mirror=",
 		  "exclude-other-filesystems", "exclude-regexp=", "exclude-if-present=",
-		  "exclude-special-files", "force", "group-mapping-file=",
+		  "exclude-special-files", "force", "fsync-batch-size=",
+		  "fsync-batch-time=", "group-mapping-file=",
 		  "include=", "include-filelist=", "include-filelist-stdin",
 		  "include-globbing-filelist=",
 		  "include-globbing-filelist-stdin", "include-regexp=",
 		  "include-special-files", "include-symbolic-links",
+		  "increment-threads=",
 		  "list-at-time=", "list-changed-since=", "list-increments",
 		  "list-increment-sizes", "never-drop-acls",
-		  "max-file-size=", "min-file-size=",
+		  "max-file-size=", "metadata-blocksize=", "metadata-cache-size=",
+		  "metadata-format=", "min-file-size=",
 		  "no-acls", "no-carbonfile",
 		  "no-compare-inode", "no-compression", "no-compression-regexp=",
-		  "no-eas", "no-file-statistics", "no-hard-links", "null-separator",
+		  "no-eas", "no-file-statistics", "no-hard-links", "no-sparse-files",
+		  "null-separator",
 		  "override-chars-to-quote=", "parsable-output",
 		  "preserve-numerical-ids", "print-statistics",
 		  "remote-cmd=", "remote-schema=", "remote-tempdir=",
-		  "remove-older-than=", "restore-as-of=", "restrict=",
+		  "remove-older-than=", "rename-min-file-size=", "restore-as-of=",
+		  "restrict=",
 		  "restrict-read-only=", "restrict-update-only=", "server",
+		  "signature-cache-min-file-size=", "signature-cache-size=",
 		  "ssh-no-compression", "tempdir=", "terminal-verbosity=",
 		  "test-server", "use-compatible-timestamps", "user-mapping-file=",
-		  "verbosity=", "verify", "verify-at-time=", "version"])
+		  "verbosity=", "verify", "verify-at-time=", "version",
+		  "walker-prefetch=", "walker-threads="])
 	except getopt.error, e:
 		commandline_error("Bad commandline options: " + str(e))
 
@@ -95,15 +106,48 @@ def parse_cmdlineoptions(arglist):
 		elif opt == "--calculate-average": action = "calculate-average"
 		elif opt == "--carbonfile": Globals.set("carbonfile_active", 1)
 		elif opt == "--check-destination-dir": action = "check-destination-dir"
+		elif opt == "--chunked-delta-min-size":
+			Globals.set_integer('chunked_delta_min_size', arg)
 		elif opt in ("--compare", "--compare-at-time",
 					 "--compare-hash", "--compare-hash-at-time",
 					 "--compare-full", "--compare-full-at-time"):
 			if opt[-8:] == "-at-time": restore_timestr, opt = arg, opt[:-8]
 			else: restore_timestr = "now"
 			action = opt[2:]
+		elif opt == "--compression-codec": set_compression_codec(arg)
+		elif opt == "--compression-level":
+			Globals.set_integer('compression_level', arg)
+			if not 1 <= Globals.compression_level <= 9:
+				commandline_error("Compression level must be from 1 to 9")
+		elif opt == "--compression-min-ratio":
+			Globals.set_float('compression_min_ratio', arg, min = 0)
+		elif opt == "--compression-sample-size":
+			Globals.set_integer('compression_sample_size', arg)
+			if Globals.compression_sample_size < 0:
+				commandline_error("Compression sample size can't be negative")
+		elif opt == "--convert-metadata":
+			action = "convert-metadata"
+			set_metadata_format(arg)
 		elif opt == "--create-full-path": create_full_path = 1
 		elif opt == "--current-time":
 			Globals.set_integer('current_time', arg)
+		elif opt == "--delta-buffer-size":
+			Globals.set_integer('delta_buffer_size', arg)
+			if Globals.delta_buffer_size < 0:
+				commandline_error("Delta buffer size can't be negative")
+		elif opt == "--delta-chunk-size":
+			Globals.set_integer('delta_chunk_size', arg)
+			if Globals.delta_chunk_size <= 0:
+				commandline_error("Delta chunk size must be positive")
+		elif opt == "--delta-chunk-threads":
+			Globals.set_integer('delta_chunk_threads', arg)
+			if Globals.delta_chunk_threads < 1:
+				commandline_error("Number of delta chunk threads must be at "
+								  "least 1")
+		elif opt == "--delta-threads":
+			Globals.set_integer('delta_threads', arg)
+			if Globals.delta_threads < 0:
+				commandline_error("Number of delta threads can't be negative")
 		elif (opt == "--exclude" or
 			  opt == "--exclude-device-files" or
 			  opt == "--exclude-fifos" or
@@ -128,6 +172,12 @@ def parse_cmdlineoptions(arglist):
 								"standard input"))
 			select_files.append(sys.stdin)
 		elif opt == "--force": force = 1
+		elif opt == "--fsync-batch-size":
+			Globals.set_integer('fsync_batch_size', arg)
+			if Globals.fsync_batch_size < 1:
+				commandline_error("Fsync batch size must be at least 1")
+		elif opt == "--fsync-batch-time":
+			Globals.set_float('fsync_batch_time', arg, min = 0)
 		elif opt == "--group-mapping-file": group_mapping_filename = arg
 		elif (opt == "--include" or
 			  opt == "--include-special-files" or
@@ -147,6 +197,11 @@ def parse_cmdlineoptions(arglist):
 								"standard input"))
 			select_files.append(sys.stdin)
 		elif opt == "--include-regexp": select_opts.append((opt, arg))
+		elif opt == "--increment-threads":
+			Globals.set_integer('increment_threads', arg)
+			if Globals.increment_threads < 0:
+				commandline_error("Number of increment threads can't be "
+								  "negative")
 		elif opt == "--list-at-time":
 			restore_timestr, action = arg, "list-at-time"
 		elif opt == "--list-changed-since":
@@ -155,6 +210,15 @@ def parse_cmdlineoptions(arglist):
 			action = "list-increments"
 		elif opt == '--list-increment-sizes': action = 'list-increment-sizes'
 		elif opt == "--max-file-size": select_opts.append((opt, arg))
+		elif opt == "--metadata-blocksize":
+			Globals.set_integer('metadata_blocksize', arg)
+			if Globals.metadata_blocksize <= 0:
+				commandline_error("Metadata blocksize must be positive")
+		elif opt == "--metadata-cache-size":
+			Globals.set_integer('metadata_cache_size', arg)
+			if Globals.metadata_cache_size < 0:
+				commandline_error("Metadata cache size can't be negative")
+		elif opt == "--metadata-format": set_metadata_format(arg)
 		elif opt == "--min-file-size": select_opts.append((opt, arg))
 		elif opt == "--never-drop-acls": Globals.set("never_drop_acls", 1)
 		elif opt == "--no-acls":
@@ -168,6 +232,7 @@ def parse_cmdlineoptions(arglist):
 		elif opt == "--no-eas": Globals.set("eas_active", 0)
 		elif opt == "--no-file-statistics": Globals.set('file_statistics', 0)
 		elif opt == "--no-hard-links": Globals.set('preserve_hardlinks', 0)
+		elif opt == "--no-sparse-files": Globals.set('sparse_files', 0)
 		elif opt == "--null-separator": Globals.set("null_separator", 1)
 		elif opt == "--override-chars-to-quote":
 			Globals.set('chars_to_quote', arg)
@@ -182,6 +247,10 @@ def parse_cmdlineoptions(arglist):
 		elif opt == "--remove-older-than":
 			remove_older_than_string = arg
 			action = "remove-older-than"
+		elif opt == "--rename-min-file-size":
+			Globals.set_integer('rename_min_size', arg)
+			if Globals.rename_min_size < 0:
+				commandline_error("Rename minimum file size can't be negative")
 		elif opt == "--no-resource-forks":
 			Globals.set('resource_forks_active', 0)
 		elif opt == "--restrict": Globals.restrict_path = normalize_path(arg)
@@ -194,6 +263,15 @@ def parse_cmdlineoptions(arglist):
 		elif opt == "-s" or opt == "--server":
 			action = "server"
 			Globals.server = 1
+		elif opt == "--signature-cache-min-file-size":
+			Globals.set_integer('signature_cache_min_size', arg)
+			if Globals.signature_cache_min_size < 65536:
+				commandline_error("Signature cache minimum file size must be "
+								  "at least 65536")
+		elif opt == "--signature-cache-size":
+			Globals.set_integer('signature_cache_size', arg)
+			if Globals.signature_cache_size < 0:
+				commandline_error("Signature cache size can't be negative")
 		elif opt == "--ssh-no-compression":
 			Globals.set('ssh_compression', None)
 		elif opt == "--tempdir": tempfile.tempdir = arg
@@ -208,9 +286,38 @@ def parse_cmdlineoptions(arglist):
 		elif opt == "-V" or opt == "--version":
 			print "rdiff-backup " + Globals.version
 			sys.exit(0)
+		elif opt == "--walker-prefetch":
+			Globals.set_integer('walker_prefetch', arg)
+			if Globals.walker_prefetch < 1:
+				commandline_error("Walker prefetch must be at least 1")
+		elif opt == "--walker-threads":
+			Globals.set_integer('walker_threads', arg)
+			if Globals.walker_threads < 0:
+				commandline_error("Number of walker threads can't be negative")
 		else: Log.FatalError("Unknown option %s" % opt)
 	Log("Using rdiff-backup version %s" % (Globals.version), 4)
 
+def set_metadata_format(format):
+	"""Check and set format of mirror_metadata files"""
+	if format not in ("text", "binary"):
+		commandline_error("Metadata format must be text or binary, not %s"
+						  % (format,))
+	Globals.set("metadata_format", format)
+
+def set_compression_codec(codec):
+	"""Check and set codec used to compress increments"""
+	if codec == "store": Globals.set("compression", None)
+	elif codec in rpath.compression_codecs:
+		if not rpath.compression_codecs[codec][1]:
+			Log.FatalError("Python module needed for %s compression "
+						   "not found" % (codec,))
+		Globals.set("compression_codec", codec)
+	else:
+		codecs = rpath.compression_codecs.keys()
+		codecs.sort()
+		commandline_error("Compression codec must be one of %s or store, "
+						  "not %s" % (", ".join(codecs), codec))
+
 def check_action():
 	"""Check to make sure action is compatible with args"""
 	global action
@@ -218,7 +325,7 @@ def check_action():
 					   1: ['list-increments', 'list-increment-sizes',
 						   'remove-older-than', 'list-at-time',
 						   'list-changed-since', 'check-destination-dir',
-						   'verify'],
+						   'convert-metadata', 'verify'],
 					   2: ['backup', 'restore', 'restore-as-of',
 						   'compare', 'compare-hash', 'compare-full']}
 	l = len(args)
@@ -283,6 +390,7 @@ def take_action(rps):
 	elif action == "calculate-average": CalculateAverage(rps)
 	elif action == "check-destination-dir": CheckDest(rps[0])
 	elif action.startswith("compare"): Compare(action, rps[0], rps[1])
+	elif action == "convert-metadata": ConvertMetadata(rps[0])
 	elif action == "list-at-time": ListAtTime(rps[0])
 	elif action == "list-changed-since": ListChangedSince(rps[0])
 	elif action == "list-increments": ListIncrements(rps[0])
@@ -348,6 +456,15 @@ def Backup(rpin, rpout):
 		backup.Mirror(rpin, rpout)
 		rpout.conn.Main.backup_touch_curmirror_local(rpin, rpout)
 	rpout.conn.Main.backup_close_statistics(time.time())
+	log_stat_counts()
+
+def log_stat_counts():
+	"""Log the calls made to read file information on each connection"""
+	for conn in Globals.connections:
+		counts = conn.rpath.get_stat_counts().items()
+		counts.sort()
+		Log("Stat calls on connection %d: %s" % (conn.conn_number,
+			", ".join(["%s %d" % pair for pair in counts]) or "none"), 5)
 
 def backup_quoted_rpaths(rpout):
 	"""Get QuotedRPath versions of important RPaths.  Return rpout"""
@@ -595,6 +712,7 @@ def Restore(src_rp, dest_rp, restore_as_of = None):
 			raise
 	else:
 		Log("Restore finished", 4)
+		log_stat_counts()
 
 def restore_init_quoting(src_rp):
 	"""Change rpaths into quoted versions of themselves if necessary"""
@@ -781,6 +899,12 @@ def RemoveOlderThan(rootrp):
 	Log("Actual remove older than time: %s" % (time,), 6)
 	manage.delete_earlier_than(Globals.rbdir, time)
 
+def ConvertMetadata(rootrp):
+	"""Rewrite the mirror_metadata files in rootrp's repository"""
+	rootrp = require_root_set(rootrp, 0)
+	rot_require_rbdir_base(rootrp)
+	Globals.rbdir.conn.metadata.ConvertFormat(Globals.metadata_format)
+
 def rot_check_time(time_string):
 	"""Check remove older than time_string, return time in seconds"""
 	try: time = Time.genstrtotime(time_string)
@@ -25,11 +25,24 @@ import Globals, log, static, TempFile, rpath, hash
 
 def get_signature(rp, blocksize = None):
 	"""Take signature of rpin file and return in file object"""
-	if not blocksize: blocksize = find_blocksize(rp.getsize())
+	file_len = rp.getsize()
+	if not blocksize: blocksize = find_blocksize(file_len)
 	log.Log("Getting signature of %s with blocksize %s" %
 			(rp.get_indexpath(), blocksize), 7)
+	if is_chunked(file_len):
+		return librsync.ChunkedSigFile(lambda: rp.open("rb"), file_len,
+				blocksize, Globals.delta_chunk_size, Globals.delta_chunk_threads)
 	return librsync.SigFile(rp.open("rb"), blocksize)
 
+def is_chunked(file_len):
+	"""True if signatures and deltas of file_len long files are chunked
+
+	See Globals.chunked_delta_min_size and librsync.ChunkedDeltaFile.
+
+	"""
+	return (Globals.chunked_delta_min_size > 0 and librsync.threading and
+			file_len >= Globals.chunked_delta_min_size)
+
 def find_blocksize(file_len):
 	"""Return a reasonable block size to use on files of length file_len
 
@@ -42,61 +55,83 @@ def find_blocksize(file_len):
 	else: # Use square root, rounding to nearest 16
 		return long(pow(file_len, 0.5)/16)*16
 
+def get_delta_file(sig_fileobj, rp_new, with_hash = None):
+	"""Return DeltaFile of rp_new, or ChunkedDeltaFile if rp_new is big
+
+	If with_hash is true, the close value is the hash.Report of rp_new.
+
+	"""
+	file_len = rp_new.getsize()
+	if is_chunked(file_len):
+		if with_hash: hash_fp = hash.FileWrapper(rp_new.open("rb"))
+		else: hash_fp = None
+		return librsync.ChunkedDeltaFile(sig_fileobj,
+				lambda: rp_new.open("rb"), file_len, Globals.delta_chunk_size,
+				Globals.delta_chunk_threads, hash_fp)
+	new_fp = rp_new.open("rb")
+	if with_hash: new_fp = hash.FileWrapper(new_fp)
+	return librsync.DeltaFile(sig_fileobj, new_fp)
+
 def get_delta_sigfileobj(sig_fileobj, rp_new):
 	"""Like get_delta but signature is in a file object"""
 	log.Log("Getting delta of %s with signature stream" % (rp_new.path,), 7)
-	return librsync.DeltaFile(sig_fileobj, rp_new.open("rb"))
+	return get_delta_file(sig_fileobj, rp_new)
 
 def get_delta_sigrp(rp_signature, rp_new):
 	"""Take signature rp and new rp, return delta file object"""
 	log.Log("Getting delta of %s with signature %s" %
 			(rp_new.path, rp_signature.get_indexpath()), 7)
-	return librsync.DeltaFile(rp_signature.open("rb"), rp_new.open("rb"))
+	return get_delta_file(rp_signature.open("rb"), rp_new)
 
 def get_delta_sigrp_hash(rp_signature, rp_new):
 	"""Like above but also calculate hash of new as close() value"""
 	log.Log("Getting delta (with hash) of %s with signature %s" %
 			(rp_new.path, rp_signature.get_indexpath()), 7)
-	return librsync.DeltaFile(rp_signature.open("rb"),
-							  hash.FileWrapper(rp_new.open("rb")))
+	return get_delta_file(rp_signature.open("rb"), rp_new, 1)
 	
 
 def write_delta(basis, new, delta, compress = None):
 	"""Write rdiff delta which brings basis to new"""
 	log.Log("Writing delta %s from %s -> %s" %
 			(basis.path, new.path, delta.path), 7)
-	deltafile = librsync.DeltaFile(get_signature(basis), new.open("rb"))
+	deltafile = get_delta_file(get_signature(basis), new)
 	delta.write_from_fileobj(deltafile, compress)
 
 def write_patched_fp(basis_fp, delta_fp, out_fp):
 	"""Write patched file to out_fp given input fps.  Closes input files"""
-	rpath.copyfileobj(librsync.PatchedFile(basis_fp, delta_fp), out_fp)
+	rpath.copyfileobj(librsync.get_patched_file(basis_fp, delta_fp), out_fp)
 	assert not basis_fp.close() and not delta_fp.close()
 
-def write_via_tempfile(fp, rp):
+def write_via_tempfile(fp, rp, sparse = None):
 	"""Write fileobj fp to rp by writing to tempfile and renaming"""
 	tf = TempFile.new(rp)
-	retval = tf.write_from_fileobj(fp)
+	retval = tf.write_from_fileobj(fp, sparse = sparse)
 	rpath.rename(tf, rp)
 	return retval
 
-def patch_local(rp_basis, rp_delta, outrp = None, delta_compressed = None):
+def patch_local(rp_basis, rp_delta, outrp = None, delta_compressed = None,
+				sig_gen = None):
 	"""Patch routine that must be run locally, writes to outrp
 
 	This should be run local to rp_basis because it needs to be a real
 	file (librsync may need to seek around in it).  If outrp is None,
-	patch rp_basis instead.
+	patch rp_basis instead.  If sig_gen is given, the patched data is
+	also passed through it, see librsync.SigTee.  Like cp
+	--sparse=auto, the output is written sparsely if rp_basis has
+	holes, or the delta was made from a file with holes.
 
 	The return value is the close value of the delta, so it can be
 	used to produce hashes.
 
 	"""
 	assert rp_basis.conn is Globals.local_connection
-	if delta_compressed: deltafile = rp_delta.open("rb", 1)
+	if delta_compressed: deltafile = rp_delta.open("rb", delta_compressed)
 	else: deltafile = rp_delta.open("rb")
-	patchfile = librsync.PatchedFile(rp_basis.open("rb"), deltafile)
-	if outrp: return outrp.write_from_fileobj(patchfile)
-	else: return write_via_tempfile(patchfile, rp_basis)
+	sparse = rp_delta.issparse() or rpath.has_holes(rp_basis)
+	patchfile = librsync.get_patched_file(rp_basis.open("rb"), deltafile)
+	if sig_gen: patchfile = librsync.SigTee(patchfile, sig_gen)
+	if outrp: return outrp.write_from_fileobj(patchfile, sparse = sparse)
+	else: return write_via_tempfile(patchfile, rp_basis, sparse)
 
 def copy_local(rpin, rpout, rpnew = None):
 	"""Write rpnew == rpin using rpout as basis.  rpout and rpnew local"""
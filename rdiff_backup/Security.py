@@ -116,6 +116,7 @@ def set_security_level(action, cmdpairs):
 	elif action in ["test-server", "list-increments", 'list-increment-sizes',
 					"list-at-time", "list-changed-since",
 					"calculate-average", "remove-older-than", "compare",
+					"convert-metadata",
 					"compare-hash", "compare-full", "verify"]:
 		sec_level = "minimal"
 		rdir = tempfile.gettempdir()
@@ -134,13 +135,14 @@ def set_allowed_requests(sec_level):
 		 "Log.log_to_file", "FilenameMapping.set_init_quote_vals_local",
 		 "FilenameMapping.set_init_quote_vals", "Time.setcurtime_local",
 		 "SetConnections.add_redirected_conn", "RedirectedRun",
-		 "sys.stdout.write", "robust.install_signal_handlers"]
+		 "sys.stdout.write", "robust.install_signal_handlers",
+		 "rpath.get_stat_counts"]
 	if (sec_level == "read-only" or sec_level == "update-only" or
 		sec_level == "all"):
 		l.extend(["rpath.make_file_dict", "os.listdir", "rpath.ea_get",
 				  "rpath.acl_get", "rpath.setdata_local",
 				  "log.Log.log_to_file", "os.getuid",
-				  "rpath.gzip_open_local_read", "rpath.open_local_read",
+				  "rpath.compressed_open_local_read", "rpath.open_local_read",
 				  "Hardlink.initialize_dictionaries", "user_group.uid2uname",
 				  "user_group.gid2gname"])
 	if sec_level == "read-only" or sec_level == "all":
@@ -156,6 +158,7 @@ def set_allowed_requests(sec_level):
 				  "backup.SourceStruct.get_source_select",
 				  "backup.SourceStruct.set_source_select",
 				  "backup.SourceStruct.get_diffs",
+				  "backup.SourceStruct.get_rename_keys",
 				  "compare.RepoSide.init_and_get_iter",
 				  "compare.RepoSide.close_rf_cache",
 				  "compare.RepoSide.attach_files",
@@ -169,6 +172,7 @@ def set_allowed_requests(sec_level):
 				  "log.ErrorLog.open", "log.ErrorLog.isopen",
 				  "log.ErrorLog.close",
 				  "backup.DestinationStruct.set_rorp_cache",
+				  "backup.DestinationStruct.set_renames",
 				  "backup.DestinationStruct.get_sigs",				 
 				  "backup.DestinationStruct.patch_and_increment",
 				  "Main.backup_touch_curmirror_local",
@@ -189,7 +193,8 @@ def set_allowed_requests(sec_level):
 				  "restore.TargetStruct.set_target_select",
 				  "fs_abilities.restore_set_globals",
 				  "fs_abilities.single_set_globals",
-				  "regress.Regress", "manage.delete_earlier_than_local"])
+				  "regress.Regress", "manage.delete_earlier_than_local",
+				  "metadata.ConvertFormat"])
 	if Globals.server:
 		l.extend(["SetConnections.init_connection_remote",
 				  "log.Log.setverbosity", "log.Log.setterm_verbosity",
@@ -33,17 +33,22 @@ _tfindex = 0
 
 def new(rp_base):
 	"""Return new tempfile that isn't in use in same dir as rp_base"""
-	return new_in_dir(rp_base.get_parent_rp())
+	assert rp_base.conn is Globals.local_connection
+	return new_with(rp_base.new_sibling)
 
 def new_in_dir(dir_rp):
 	"""Return new temp rpath in directory dir_rp"""
-	global _tfindex
 	assert dir_rp.conn is Globals.local_connection
+	return new_with(dir_rp.append)
+
+def new_with(make_rp):
+	"""Return make_rp(filename) for the first temp filename not in use"""
+	global _tfindex
 	while 1:
 		if _tfindex > 100000000:
 			Log("Warning: Resetting tempfile index", 2)
 			_tfindex = 0
-		tf = dir_rp.append('rdiff-backup.tmp.%d' % _tfindex)
+		tf = make_rp('rdiff-backup.tmp.%d' % _tfindex)
 		_tfindex = _tfindex+1
 		if not tf.lstat(): return tf
 
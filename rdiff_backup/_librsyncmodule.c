@@ -25,6 +25,14 @@
 #include <librsync.h>
 #define RS_JOB_BLOCKSIZE 65536
 
+/* Python 2.6 added Py_buffer, which cycle_into needs, and
+   PyFile_IncUseCount, which keeps the basis file of a patch job open
+   while the GIL is released.  With older pythons the makers only
+   have cycle(), and patch jobs keep the GIL. */
+#if PY_VERSION_HEX >= 0x02060000
+#define HAVE_PY_BUFFER
+#endif
+
 static PyObject *librsyncError;
 
 /* Sets python error string from result */
@@ -36,6 +44,52 @@ _librsync_seterror(rs_result result, char *location)
   PyErr_SetString(librsyncError, error_string);
 }
 
+/* Run job over the data in inbuf, writing output to the start of the
+   writable buffer outbuf, and return a triple (done, bytes_used,
+   bytes_written).  As with cycle(), an empty inbuf means there is no
+   more input.  The GIL is released while librsync works, so other
+   threads can run meanwhile.  If basis_file isn't NULL, it is the
+   file object the job reads from, which must not be closed until the
+   job is done with it.
+*/
+#ifdef HAVE_PY_BUFFER
+static PyObject *
+_librsync_job_cycle_into(rs_job_t *job, PyObject *basis_file,
+						 PyObject *args, char *location)
+{
+  Py_buffer inbuf, outbuf;
+  rs_buffers_t buf;
+  rs_result result;
+  Py_ssize_t used, written;
+
+  if (!PyArg_ParseTuple(args, "s*w*:cycle_into", &inbuf, &outbuf))
+	return NULL;
+
+  buf.next_in = (char *)inbuf.buf;
+  buf.avail_in = (size_t)inbuf.len;
+  buf.next_out = (char *)outbuf.buf;
+  buf.avail_out = (size_t)outbuf.len;
+  buf.eof_in = (inbuf.len == 0);
+
+  if (basis_file != NULL) PyFile_IncUseCount((PyFileObject *)basis_file);
+  Py_BEGIN_ALLOW_THREADS
+  result = rs_job_iter(job, &buf);
+  Py_END_ALLOW_THREADS
+  if (basis_file != NULL) PyFile_DecUseCount((PyFileObject *)basis_file);
+  used = inbuf.len - (Py_ssize_t)buf.avail_in;
+  written = outbuf.len - (Py_ssize_t)buf.avail_out;
+  PyBuffer_Release(&inbuf);
+  PyBuffer_Release(&outbuf);
+
+  if (result != RS_DONE && result != RS_BLOCKED) {
+	_librsync_seterror(result, location);
+	return NULL;
+  }
+
+  return Py_BuildValue("(inn)", (result == RS_DONE), used, written);
+}
+#endif
+
 
 /* --------------- SigMaker Object for incremental signatures */
 staticforward PyTypeObject _librsync_SigMakerType;
@@ -93,7 +147,9 @@ _librsync_sigmaker_cycle(_librsync_SigMakerObject *self, PyObject *args)
   buf.avail_out = (size_t)RS_JOB_BLOCKSIZE;
   buf.eof_in = (inbuf_length == 0);
 
+  Py_BEGIN_ALLOW_THREADS
   result = rs_job_iter(self->sig_job, &buf);
+  Py_END_ALLOW_THREADS
 
   if (result != RS_DONE && result != RS_BLOCKED) {
 	_librsync_seterror(result, "signature cycle");
@@ -105,8 +161,21 @@ _librsync_sigmaker_cycle(_librsync_SigMakerObject *self, PyObject *args)
 					   outbuf, RS_JOB_BLOCKSIZE - (long)buf.avail_out);
 }
 
+#ifdef HAVE_PY_BUFFER
+/* Like cycle, but read from and write to buffers, see
+   _librsync_job_cycle_into */
+static PyObject *
+_librsync_sigmaker_cycle_into(_librsync_SigMakerObject *self, PyObject *args)
+{
+  return _librsync_job_cycle_into(self->sig_job, NULL, args, "signature cycle");
+}
+#endif
+
 static PyMethodDef _librsync_sigmaker_methods[] = {
   {"cycle", (PyCFunction)_librsync_sigmaker_cycle, METH_VARARGS},
+#ifdef HAVE_PY_BUFFER
+  {"cycle_into", (PyCFunction)_librsync_sigmaker_cycle_into, METH_VARARGS},
+#endif
   {NULL, NULL, 0, NULL}  /* sentinel */
 };
 
@@ -198,13 +267,18 @@ _librsync_new_deltamaker(PyObject* self, PyObject* args)
   buf.next_out = outbuf;
   buf.avail_out = (size_t)RS_JOB_BLOCKSIZE;
   buf.eof_in = 1;
+  Py_BEGIN_ALLOW_THREADS
   result = rs_job_iter(sig_loader, &buf);
+  Py_END_ALLOW_THREADS
   rs_job_free(sig_loader);
   if (result != RS_DONE) {
 	_librsync_seterror(result, "delta rs_signature_t builder");
 	return NULL;
   }
-  if ((result = rs_build_hash_table(sig_ptr)) != RS_DONE) {
+  Py_BEGIN_ALLOW_THREADS
+  result = rs_build_hash_table(sig_ptr);
+  Py_END_ALLOW_THREADS
+  if (result != RS_DONE) {
 	_librsync_seterror(result, "delta rs_build_hash_table");
 	return NULL;
   }
@@ -247,7 +321,9 @@ _librsync_deltamaker_cycle(_librsync_DeltaMakerObject *self, PyObject *args)
   buf.avail_out = (size_t)RS_JOB_BLOCKSIZE;
   buf.eof_in = (inbuf_length == 0);
 
+  Py_BEGIN_ALLOW_THREADS
   result = rs_job_iter(self->delta_job, &buf);
+  Py_END_ALLOW_THREADS
   if (result != RS_DONE && result != RS_BLOCKED) {
 	_librsync_seterror(result, "delta cycle");
 	return NULL;
@@ -258,8 +334,21 @@ _librsync_deltamaker_cycle(_librsync_DeltaMakerObject *self, PyObject *args)
 					   outbuf, RS_JOB_BLOCKSIZE - (long)buf.avail_out);
 }
 
+#ifdef HAVE_PY_BUFFER
+/* Like cycle, but read from and write to buffers, see
+   _librsync_job_cycle_into */
+static PyObject *
+_librsync_deltamaker_cycle_into(_librsync_DeltaMakerObject *self, PyObject *args)
+{
+  return _librsync_job_cycle_into(self->delta_job, NULL, args, "delta cycle");
+}
+#endif
+
 static PyMethodDef _librsync_deltamaker_methods[] = {
   {"cycle", (PyCFunction)_librsync_deltamaker_cycle, METH_VARARGS},
+#ifdef HAVE_PY_BUFFER
+  {"cycle_into", (PyCFunction)_librsync_deltamaker_cycle_into, METH_VARARGS},
+#endif
   {NULL, NULL, 0, NULL}  /* sentinel */
 };
 
@@ -383,7 +472,15 @@ _librsync_patchmaker_cycle(_librsync_PatchMakerObject *self, PyObject *args)
   buf.avail_out = (size_t)RS_JOB_BLOCKSIZE;
   buf.eof_in = (inbuf_length == 0);
 
+#ifdef HAVE_PY_BUFFER
+  PyFile_IncUseCount((PyFileObject *)self->basis_file);
+  Py_BEGIN_ALLOW_THREADS
   result = rs_job_iter(self->patch_job, &buf);
+  Py_END_ALLOW_THREADS
+  PyFile_DecUseCount((PyFileObject *)self->basis_file);
+#else
+  result = rs_job_iter(self->patch_job, &buf);
+#endif
   if (result != RS_DONE && result != RS_BLOCKED) {
 	_librsync_seterror(result, "patch cycle");
 	return NULL;
@@ -394,8 +491,21 @@ _librsync_patchmaker_cycle(_librsync_PatchMakerObject *self, PyObject *args)
 					   outbuf, RS_JOB_BLOCKSIZE - (long)buf.avail_out);
 }
 
+#ifdef HAVE_PY_BUFFER
+/* Like cycle, but read from and write to buffers, see
+   _librsync_job_cycle_into */
+static PyObject *
+_librsync_patchmaker_cycle_into(_librsync_PatchMakerObject *self, PyObject *args)
+{
+  return _librsync_job_cycle_into(self->patch_job, self->basis_file, args, "patch cycle");
+}
+#endif
+
 static PyMethodDef _librsync_patchmaker_methods[] = {
   {"cycle", (PyCFunction)_librsync_patchmaker_cycle, METH_VARARGS},
+#ifdef HAVE_PY_BUFFER
+  {"cycle_into", (PyCFunction)_librsync_patchmaker_cycle_into, METH_VARARGS},
+#endif
   {NULL, NULL, 0, NULL}  /* sentinel */
 };
 
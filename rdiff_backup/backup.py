@@ -20,10 +20,13 @@
 """High level functions for mirroring and mirror+incrementing"""
 
 from __future__ import generators
-import errno
+import errno, sys, time, tempfile, itertools
 import Globals, metadata, rorpiter, TempFile, Hardlink, robust, increment, \
 	   rpath, static, log, selection, Time, Rdiff, statistics, iterfile, \
-	   hash, longname
+	   hash, longname, librsync, sigcache
+
+try: import threading, Queue
+except ImportError: threading = None
 
 def Mirror(src_rpath, dest_rpath):
 	"""Turn dest_rpath into a copy of src_rpath"""
@@ -46,6 +49,8 @@ def Mirror_and_increment(src_rpath, dest_rpath, inc_rpath):
 
 	source_rpiter = SourceS.get_source_select()
 	DestS.set_rorp_cache(dest_rpath, source_rpiter, 1)
+	if Globals.rename_min_size > 0:
+		DestS.set_renames(dest_rpath, SourceS.get_rename_keys())
 	dest_sigiter = DestS.get_sigs(dest_rpath)
 	source_diffiter = SourceS.get_diffs(dest_sigiter)
 	DestS.patch_and_increment(dest_rpath, source_diffiter, inc_rpath)
@@ -77,10 +82,37 @@ class SourceStruct:
 		"""Return source select iterator, set by set_source_select"""
 		return cls._source_select
 
+	def get_rename_keys(cls):
+		"""Return dict of inode keys of large source files to (size, mtime)
+
+		This walks the selected source files ahead of the backup, so
+		the destination knows which old files have moved (see
+		RenameDetector).  Only regular files with one link and at
+		least Globals.rename_min_size bytes are included.
+
+		"""
+		sel = Globals.select_mirror
+		keys = {}
+		for rp in sel.Iterate_fast(sel.rpath, sel.Select):
+			if (rp.isreg() and rp.getnumlinks() == 1 and
+				rp.getsize() >= Globals.rename_min_size):
+				keys[Hardlink.get_inode_key(rp)] = (rp.getsize(),
+													rp.getmtime())
+		return keys
+
 	def get_diffs(cls, dest_sigiter):
-		"""Return diffs of any files with signature in dest_sigiter"""
+		"""Return diffs of any files with signature in dest_sigiter
+
+		If Globals.delta_threads is set, the deltas of the next few
+		changed files are made in a DeltaPool while earlier diffs are
+		being read.
+
+		"""
 		source_rps = cls._source_select
 		error_handler = robust.get_error_handler("ListError")
+		pool = cls.get_delta_pool()
+		if pool: get_delta = pool.get_delta_sigrp_hash
+		else: get_delta = Rdiff.get_delta_sigrp_hash
 		def attach_snapshot(diff_rorp, src_rp):
 			"""Attach file of snapshot to diff_rorp, w/ error checking"""
 			fileobj = robust.check_common_error(
@@ -92,18 +124,18 @@ class SourceStruct:
 		def attach_diff(diff_rorp, src_rp, dest_sig):
 			"""Attach file of diff to diff_rorp, w/ error checking"""
 			fileobj = robust.check_common_error(
-				error_handler, Rdiff.get_delta_sigrp_hash, (dest_sig, src_rp))
+				error_handler, get_delta, (dest_sig, src_rp))
 			if fileobj:
 				diff_rorp.setfile(fileobj)
 				diff_rorp.set_attached_filetype('diff')
 			else:
 				diff_rorp.zero()
 				diff_rorp.set_attached_filetype('snapshot')
-				
-		for dest_sig in dest_sigiter:
+
+		def get_diff(dest_sig):
+			"""Return diff_rorp to send in response to dest_sig"""
 			if dest_sig is iterfile.MiscIterFlushRepeat:
-				yield iterfile.MiscIterFlush # Flush buffer when get_sigs does
-				continue
+				return iterfile.MiscIterFlush # Flush buffer when get_sigs does
 			src_rp = (source_rps.get(dest_sig.index) or
 					  rpath.RORPath(dest_sig.index))
 			diff_rorp = src_rp.getRORPath()
@@ -116,6 +148,7 @@ class SourceStruct:
 					reset_perms = True
 					src_rp.chmod(0400 | src_rp.getperms())
 
+				if rpath.has_holes(src_rp): diff_rorp.set_sparse()
 				if dest_sig.isreg(): attach_diff(diff_rorp, src_rp, dest_sig)
 				else: attach_snapshot(diff_rorp, src_rp)
 
@@ -123,11 +156,199 @@ class SourceStruct:
 			else:
 				dest_sig.close_if_necessary()
 				diff_rorp.set_attached_filetype('snapshot')
+			return diff_rorp
+
+		diff_iter = itertools.imap(get_diff, dest_sigiter)
+		if pool: diff_iter = pool.read_ahead(diff_iter)
+		remote = Globals.backup_reader is not Globals.backup_writer
+		for diff_rorp in diff_iter:
+			if diff_rorp is iterfile.MiscIterFlush and not remote: continue
 			yield diff_rorp
+		if pool: pool.close()
+
+	def get_delta_pool(cls):
+		"""Return DeltaPool for making deltas ahead, or None if not used"""
+		if Globals.delta_threads <= 0 or not threading: return None
+		return DeltaPool(Globals.delta_threads, Globals.delta_buffer_size)
 
 static.MakeClass(SourceStruct)
 
 
+class DeltaPool:
+	"""Make the deltas of changed source files in worker threads
+
+	SourceStruct.get_diffs normally makes each delta only as the
+	destination reads it, so only one core is used no matter how many
+	big files changed.  With a DeltaPool, read_ahead reads up to
+	max_deltas diffs past the one being sent.  get_delta_sigrp_hash
+	queues their deltas (and SHA1s) for the workers, which run in
+	parallel as librsync releases the GIL.  Diffs are still yielded in
+	index order.
+
+	The finished part of each delta is kept in memory while the pool
+	holds fewer than buffer_size bytes, and written to a temp file
+	after that (see DeltaSpool).
+
+	Reading ahead stops at each flush marker from
+	DestinationStruct.get_sigs, which sends one every so many files.
+	Otherwise the destination's cache of files could run out before
+	they are patched.
+
+	"""
+	# Maximum number of diffs read ahead, counting unchanged ones,
+	# since each snapshot keeps its source file open
+	max_diffs = 100
+
+	def __init__(self, num_threads, buffer_size):
+		self.max_deltas = 2 * num_threads
+		self.buffer_size = buffer_size
+		self.lock = threading.Lock()
+		self.buffer_used = 0
+		self.jobs = Queue.Queue()
+		self.threads = []
+		for i in range(num_threads):
+			thread = threading.Thread(target = self.worker)
+			thread.setDaemon(1)
+			thread.start()
+			self.threads.append(thread)
+
+	def worker(self):
+		"""Make queued deltas until given None"""
+		while 1:
+			job = self.jobs.get()
+			if job is None: return
+			spool, sig_string, new_fp = job
+			try:
+				delta_fp = librsync.DeltaFile(sig_string,
+											  hash.FileWrapper(new_fp))
+				while 1:
+					buf = delta_fp.read(Globals.blocksize)
+					if not buf: break
+					spool.write(buf)
+				spool.set_done(delta_fp.close())
+			except Exception, exc:
+				new_fp.close()
+				spool.set_done(None, exc)
+
+	def get_delta_sigrp_hash(self, rp_signature, rp_new):
+		"""Like Rdiff.get_delta_sigrp_hash, but return a DeltaSpool
+
+		The signature is read and the new file opened here, so errors
+		are raised to the caller as usual.  Chunked deltas make
+		themselves in parallel, so they aren't queued.
+
+		"""
+		if Rdiff.is_chunked(rp_new.getsize()):
+			return Rdiff.get_delta_sigrp_hash(rp_signature, rp_new)
+		log.Log("Queueing delta (with hash) of %s with signature %s" %
+				(rp_new.path, rp_signature.get_indexpath()), 7)
+		sig_fp = rp_signature.open("rb")
+		sig_string = sig_fp.read()
+		assert not sig_fp.close()
+		spool = DeltaSpool(self)
+		self.jobs.put((spool, sig_string, rp_new.open("rb")))
+		return spool
+
+	def read_ahead(self, diff_iter):
+		"""Yield the diffs of diff_iter, reading and queueing ahead"""
+		queue, num_deltas, at_marker, done = [], 0, None, None
+		while 1:
+			while not (done or at_marker or num_deltas >= self.max_deltas or
+					   len(queue) >= self.max_diffs):
+				try: diff_rorp = diff_iter.next()
+				except StopIteration:
+					done = 1
+					break
+				queue.append(diff_rorp)
+				if diff_rorp is iterfile.MiscIterFlush: at_marker = 1
+				elif self.is_queued_delta(diff_rorp): num_deltas += 1
+			if not queue: break
+			diff_rorp = queue.pop(0)
+			if diff_rorp is iterfile.MiscIterFlush: at_marker = None
+			elif self.is_queued_delta(diff_rorp): num_deltas -= 1
+			yield diff_rorp
+
+	def is_queued_delta(self, diff_rorp):
+		"""True if diff_rorp has a delta made by this pool attached"""
+		return diff_rorp.file and isinstance(diff_rorp.file.file, DeltaSpool)
+
+	def reserve(self, length):
+		"""Return true if length more bytes may be kept in memory"""
+		self.lock.acquire()
+		try:
+			if self.buffer_used + length > self.buffer_size: return None
+			self.buffer_used += length
+			return 1
+		finally: self.lock.release()
+
+	def release(self, length):
+		"""Give back length bytes of memory reserved earlier"""
+		self.lock.acquire()
+		self.buffer_used -= length
+		self.lock.release()
+
+	def close(self):
+		"""Stop the worker threads"""
+		for thread in self.threads: self.jobs.put(None)
+
+
+class DeltaSpool:
+	"""Delta of one file made by a DeltaPool worker, read like a file
+
+	Like the file returned by Rdiff.get_delta_sigrp_hash, read()
+	returns the delta and close() the hash.Report of the new file.
+	Reading waits until the worker is done.  If the worker failed, the
+	exception is raised by read().
+
+	"""
+	def __init__(self, pool):
+		self.pool = pool
+		self.pieces = [] # parts of the delta kept in memory
+		self.tempfile = None # holds the rest of the delta, if any
+		self.done = threading.Event()
+		self.close_val = self.exc = None
+
+	def write(self, buf):
+		"""Add buf to the end of the delta (called by worker)"""
+		if not self.tempfile and self.pool.reserve(len(buf)):
+			self.pieces.append(buf)
+		else:
+			if not self.tempfile: self.tempfile = tempfile.TemporaryFile()
+			self.tempfile.write(buf)
+
+	def set_done(self, close_val, exc = None):
+		"""Record the delta's close value or exception (called by worker)"""
+		self.close_val, self.exc = close_val, exc
+		if self.tempfile: self.tempfile.seek(0)
+		self.done.set()
+
+	def read(self, length = -1):
+		"""Return the next length bytes of the delta"""
+		self.done.wait()
+		if self.exc: raise self.exc
+		result, size = [], 0
+		while self.pieces and (length < 0 or size < length):
+			piece = self.pieces.pop(0)
+			if length >= 0 and size + len(piece) > length:
+				self.pieces.insert(0, piece[length - size:])
+				piece = piece[:length - size]
+			self.pool.release(len(piece))
+			result.append(piece)
+			size += len(piece)
+		if self.tempfile and (length < 0 or size < length):
+			if length < 0: result.append(self.tempfile.read())
+			else: result.append(self.tempfile.read(length - size))
+		return "".join(result)
+
+	def close(self):
+		"""Free the buffers and return the hash.Report of the new file"""
+		self.done.wait()
+		for piece in self.pieces: self.pool.release(len(piece))
+		self.pieces = []
+		if self.tempfile: self.tempfile.close()
+		return self.close_val
+
+
 class DestinationStruct:
 	"""Hold info used by destination side when backing up"""
 	def get_dest_select(cls, rpath, use_metadata = 1):
@@ -146,7 +367,9 @@ class DestinationStruct:
 		metadata.SetManager()
 		if use_metadata:
 			rorp_iter = metadata.ManagerObj.GetAtTime(Time.prevtime)
-			if rorp_iter: return rorp_iter
+			if rorp_iter:
+				metadata.ManagerObj.open_meta_diff(Time.prevtime)
+				return rorp_iter
 		return get_iter_from_fs()
 
 	def set_rorp_cache(cls, baserp, source_iter, for_increment):
@@ -161,26 +384,36 @@ class DestinationStruct:
 		cls.CCPP = CacheCollatedPostProcess(
 			collated, Globals.pipeline_max_length*4, baserp)
 		# pipeline len adds some leeway over just*3 (to and from and back)
-		
+
+	def set_renames(cls, baserp, source_keys):
+		"""Look for renamed files, given source inode keys to (size, mtime)"""
+		old_iter = metadata.ManagerObj.get_meta_at_time(Time.prevtime, None)
+		if old_iter:
+			cls.CCPP.renames = RenameDetector(baserp, old_iter, source_keys)
 	def get_sigs(cls, dest_base_rpath):
 		"""Yield signatures of any changed destination files
 
 		If we are backing up across a pipe, we must flush the pipeline
 		every so often so it doesn't get congested on destination end.
+		The same markers keep a DeltaPool from reading too far ahead.
 
 		"""
 		flush_threshold = Globals.pipeline_max_length - 2
 		num_rorps_seen = 0
+		renames = cls.CCPP.renames
 		for src_rorp, dest_rorp in cls.CCPP:
-			if (Globals.backup_reader is not Globals.backup_writer):
+			if (Globals.backup_reader is not Globals.backup_writer or
+				Globals.delta_threads):
 				num_rorps_seen += 1
 				if (num_rorps_seen > flush_threshold):
 					num_rorps_seen = 0
 					yield iterfile.MiscIterFlushRepeat
-			if not (src_rorp and dest_rorp and src_rorp == dest_rorp and
-				(not Globals.preserve_hardlinks or
-				 Hardlink.rorp_eq(src_rorp, dest_rorp))):
-
+			changed = not (src_rorp and dest_rorp and src_rorp == dest_rorp
+						   and (not Globals.preserve_hardlinks or
+								Hardlink.rorp_eq(src_rorp, dest_rorp)))
+			if renames and dest_rorp:
+				renames.add_mirror(src_rorp, dest_rorp, changed)
+			if changed:
 				index = src_rorp and src_rorp.index or dest_rorp.index
 				sig = cls.get_one_sig(dest_base_rpath, index,
 									  src_rorp, dest_rorp)
@@ -198,18 +431,47 @@ class DestinationStruct:
 			dest_sig = dest_rorp.getRORPath()
 			if dest_rorp.isreg():
 				dest_rp = longname.get_mirror_rp(dest_base_rpath, dest_rorp)
-				sig_fp = cls.get_one_sig_fp(dest_rp)
+				sig_fp = cls.get_one_sig_fp(dest_rp, dest_rorp)
 				if sig_fp is None: return None
 				dest_sig.setfile(sig_fp)
+		elif src_rorp and cls.CCPP.renames:
+			dest_sig = cls.get_rename_sig(index, src_rorp)
 		else: dest_sig = rpath.RORPath(index)
 		return dest_sig
 
-	def get_one_sig_fp(cls, dest_rp):
-		"""Return a signature fp of given index, corresponding to reg file"""
+	def get_rename_sig(cls, index, src_rorp):
+		"""Return signature for new src_rorp, of its old file if renamed
+
+		The source then sends a delta against the old mirror file,
+		which is used as the basis when patching (see RenameDetector).
+
+		"""
+		basis = cls.CCPP.renames.find_basis(src_rorp)
+		if not basis: return rpath.RORPath(index)
+		old_rorp, basis_rp = basis
+		sig_fp = cls.get_one_sig_fp(basis_rp, old_rorp)
+		if sig_fp is None: return rpath.RORPath(index)
+		log.Log("Sending %s as a delta against %s" % (src_rorp.get_indexpath(),
+				old_rorp.get_indexpath()), 5)
+		cls.CCPP.renames.set_basis(index, basis_rp)
+		dest_sig = rpath.RORPath(index, old_rorp.data)
+		dest_sig.setfile(sig_fp)
+		return dest_sig
+
+	def get_one_sig_fp(cls, dest_rp, dest_rorp):
+		"""Return a signature fp of given index, corresponding to reg file
+
+		dest_rorp is the mirror file as recorded in the metadata.  If a
+		signature of the file was stored when it was written, and the
+		file hasn't changed since, that is used instead of reading it.
+
+		"""
 		if not dest_rp.isreg():
 			log.ErrorLog.write_if_open("UpdateError", dest_rp,
 				"File changed from regular file before signature")
 			return None
+		sig_fp = sigcache.get_signature(dest_rp, dest_rorp)
+		if sig_fp: return sig_fp
 		if (Globals.process_uid != 0 and not dest_rp.readable() and
 				dest_rp.isowner()):
 			# This branch can happen with root source and non-root
@@ -240,17 +502,30 @@ class DestinationStruct:
 			ITR(diff.index, diff)
 		ITR.Finish()
 		cls.CCPP.close()
+		sigcache.close()
 		dest_rpath.setdata()
 
 	def patch_and_increment(cls, dest_rpath, source_diffiter, inc_rpath):
 		"""Patch dest_rpath with rorpiter of diffs and write increments"""
+		sync_batch = SyncBatch(Globals.fsync_batch_size,
+							   Globals.fsync_batch_time)
+		cls.CCPP.sync_batch = sync_batch
+		if Globals.increment_threads > 0 and threading:
+			inc_pool = IncrementPool(Globals.increment_threads)
+		else: inc_pool = None
+		cls.CCPP.inc_pool = inc_pool
 		ITR = rorpiter.IterTreeReducer(IncrementITRB,
-									   [dest_rpath, inc_rpath, cls.CCPP])
+				   [dest_rpath, inc_rpath, cls.CCPP, sync_batch, inc_pool])
 		for diff in rorpiter.FillInIter(source_diffiter, dest_rpath):
 			log.Log("Processing changed file " + diff.get_indexpath(), 5)
 			ITR(diff.index, diff)
 		ITR.Finish()
+		if inc_pool:
+			inc_pool.flush()
+			inc_pool.close()
+		sync_batch.flush()
 		cls.CCPP.close()
+		sigcache.close()
 		dest_rpath.setdata()
 
 static.MakeClass(DestinationStruct)
@@ -312,6 +587,14 @@ class CacheCollatedPostProcess:
 		self.cache_dict = {}
 		self.cache_indicies = []
 
+		# SyncBatch holding mirror changes not yet made, and
+		# IncrementPool holding increments not yet finished, if any.
+		# They are flushed before their cache entries are processed.
+		self.sync_batch = self.inc_pool = None
+
+		# RenameDetector finding the old files of renamed ones, if used
+		self.renames = None
+
 		# Contains a list of pairs (destination_rps, permissions) to
 		# be used to reset the permissions of certain directories
 		# after we're finished with them
@@ -363,6 +646,10 @@ class CacheCollatedPostProcess:
 	def shorten_cache(self):
 		"""Remove one element from cache, possibly adding it to metadata"""
 		first_index = self.cache_indicies[0]
+		if self.inc_pool and self.inc_pool.is_pending(first_index):
+			self.inc_pool.flush()
+		if self.sync_batch and self.sync_batch.is_pending(first_index):
+			self.sync_batch.flush()
 		del self.cache_indicies[0]
 		try: (old_source_rorp, old_dest_rorp, changed_flag,
 			  success_flag, inc) = self.cache_dict[first_index]
@@ -415,7 +702,9 @@ class CacheCollatedPostProcess:
 		if not changed or success:
 			if source_rorp: self.statfileobj.add_source_file(source_rorp)
 			if dest_rorp: self.statfileobj.add_dest_file(dest_rorp)
-		if success == 0: metadata_rorp = dest_rorp
+		if success == 0 and not changed and source_rorp:
+			metadata_rorp = get_unchanged_rorp(source_rorp, dest_rorp)
+		elif success == 0: metadata_rorp = dest_rorp
 		elif success == 1: metadata_rorp = source_rorp
 		else: metadata_rorp = None # in case deleted because of ListError
 		if success == 1 or success == 2: 
@@ -423,6 +712,9 @@ class CacheCollatedPostProcess:
 
 		if metadata_rorp and metadata_rorp.lstat():
 			self.metawriter.write_object(metadata_rorp)
+		else: metadata_rorp = None
+		if metadata_rorp is not dest_rorp:
+			metadata.ManagerObj.write_meta_diff(metadata_rorp, dest_rorp)
 		if Globals.file_statistics:
 			statistics.FileStats.update(source_rorp, dest_rorp, changed, inc)
 
@@ -478,6 +770,11 @@ class CacheCollatedPostProcess:
 		try: return self.cache_dict[index][1]
 		except KeyError: return self.get_parent_rorps(index)[1]
 
+	def get_rename_basis(self, index):
+		"""Return rp the diff of a renamed file applies to, or None"""
+		if not self.renames: return None
+		return self.renames.pop_basis(index)
+
 	def update_hash(self, index, sha1sum):
 		"""Update the source rorp's SHA1 hash"""
 		self.get_source_rorp(index).set_sha1(sha1sum)
@@ -495,10 +792,290 @@ class CacheCollatedPostProcess:
 		while self.dir_perms_list:
 			dir_rp, perms = self.dir_perms_list.pop()
 			dir_rp.chmod(perms)
+		if self.renames: self.renames.close()
 		self.metawriter.close()
 		metadata.ManagerObj.ConvertMetaToDiff()
 
 
+def get_unchanged_rorp(source_rorp, dest_rorp):
+	"""Return rorp to record for an unchanged file
+
+	This is dest_rorp, with the source inode if that's different or
+	missing, as it is in metadata written before all inodes were kept.
+
+	"""
+	if (not source_rorp.isreg() or not source_rorp.has_inode() or
+		(dest_rorp.has_inode() and Hardlink.get_inode_key(dest_rorp) ==
+		 Hardlink.get_inode_key(source_rorp))): return dest_rorp
+	metadata_rorp = dest_rorp.getRORPath()
+	metadata_rorp.set_data_item('inode', source_rorp.getinode())
+	metadata_rorp.set_data_item('devloc', source_rorp.getdevloc())
+	return metadata_rorp
+
+
+class RenameDetector:
+	"""Find the old mirror files of renamed regular files
+
+	Before the backup, the source is walked for the inode keys, sizes,
+	and mtimes of its regular files of at least Globals.rename_min_size
+	bytes (see SourceStruct.get_rename_keys).  Files in the last
+	mirror_metadata with the same inode, size, and mtime have moved, if
+	the source doesn't still have them at the same index, so only these
+	are recorded, as (index, size, mtime) tuples.  A new source file
+	matching one of these is taken to be that file renamed, so its
+	signature is made from the old mirror file, and the delta from the
+	source is applied to it instead of a snapshot being sent.
+
+	The old file may be changed or deleted before the new one is
+	patched, if its index comes first.  So when the collation reaches
+	a moved file that is going to be replaced, it is hard linked into
+	a holding directory in rdiff-backup-data, which is deleted when
+	the session ends.
+
+	"""
+	hold_dir_name = "rename-basis"
+
+	def __init__(self, mirror_root_rp, old_rorp_iter, source_keys):
+		"""Record the moved files in old_rorp_iter, the last metadata"""
+		self.mirror_root_rp = mirror_root_rp
+		self.hold_dir_rp = Globals.rbdir.append(self.hold_dir_name)
+		if self.hold_dir_rp.lstat(): self.hold_dir_rp.delete() # old session
+		self.made_hold_dir = None
+
+		self.moved = {} # inode keys to (index, size, mtime) of old files
+		self.mirror_names = {} # inode keys to alt mirror names, if any
+		for rorp in old_rorp_iter:
+			if (not rorp.isreg() or not rorp.has_inode() or
+				rorp.getnumlinks() != 1): continue
+			key = Hardlink.get_inode_key(rorp)
+			if source_keys.get(key) != (rorp.getsize(), rorp.getmtime()):
+				continue
+			if self.moved.has_key(key): self.moved[key] = None
+			else:
+				self.moved[key] = (rorp.index, rorp.getsize(),
+								   rorp.getmtime())
+				if rorp.has_alt_mirror_name():
+					self.mirror_names[key] = rorp.get_alt_mirror_name()
+		self.bases = {} # inode keys of held old files to basis rps
+		self.new_bases = {} # indicies of renamed files to basis rps
+
+	def add_mirror(self, src_rorp, dest_rorp, changed):
+		"""Process collated pair, holding old file if it will be replaced"""
+		if not dest_rorp.isreg() or not dest_rorp.has_inode(): return
+		key = Hardlink.get_inode_key(dest_rorp)
+		old = self.moved.get(key)
+		if not old or old[0] != dest_rorp.index: return
+		if (src_rorp and src_rorp.has_inode() and
+			Hardlink.get_inode_key(src_rorp) == key):
+			del self.moved[key] # still here, so not renamed
+		elif changed: self.bases[key] = self.hold(dest_rorp)
+
+	def hold(self, dest_rorp):
+		"""Hard link mirror file of dest_rorp to a temp file, return that"""
+		if not self.made_hold_dir:
+			self.hold_dir_rp.mkdir()
+			self.made_hold_dir = 1
+		mirror_rp = longname.get_mirror_rp(self.mirror_root_rp, dest_rorp)
+		held_rp = TempFile.new_in_dir(self.hold_dir_rp)
+		try: held_rp.hardlink(mirror_rp.path)
+		except (IOError, OSError), exc:
+			log.Log("Unable to hold %s for renamed files: %s" %
+					(mirror_rp.get_indexpath(), exc), 4)
+			return None
+		return held_rp
+
+	def find_basis(self, src_rorp):
+		"""Return (old rorp, basis rp) if src_rorp is renamed, or None
+
+		Each old file is used for one new file, after which it needn't
+		be held.  The old rorp is rebuilt from the recorded tuple.
+
+		"""
+		if (not src_rorp.isreg() or not src_rorp.has_inode() or
+			src_rorp.getnumlinks() > 1): return None
+		key = Hardlink.get_inode_key(src_rorp)
+		old = self.moved.get(key)
+		if not old or old[1:] != (src_rorp.getsize(), src_rorp.getmtime()):
+			return None
+		del self.moved[key]
+		old_rorp = rpath.RORPath(old[0], {'type': 'reg', 'size': old[1],
+										  'mtime': old[2]})
+		if self.mirror_names.has_key(key):
+			old_rorp.set_alt_mirror_name(self.mirror_names[key])
+		if self.bases.has_key(key): basis_rp = self.bases.pop(key)
+		else: basis_rp = longname.get_mirror_rp(self.mirror_root_rp, old_rorp)
+		if not basis_rp or not basis_rp.isreg(): return None
+		return old_rorp, basis_rp
+
+	def set_basis(self, index, basis_rp):
+		"""Record that the diff of new file index applies to basis_rp"""
+		self.new_bases[index] = basis_rp
+
+	def pop_basis(self, index):
+		"""Return basis rp of the renamed file at index, or None"""
+		try: return self.new_bases.pop(index)
+		except KeyError: return None
+
+	def close(self):
+		"""Delete the files held for this session"""
+		if self.made_hold_dir: self.hold_dir_rp.delete()
+
+
+class SyncBatch:
+	"""Change mirror files only after their increments are on disk
+
+	Regressing a failed backup (see regress.py) relies on each
+	increment being written to disk before the mirror file it records
+	is changed.  IncrementITRB hands each increment, and the action
+	which then changes the mirror, to this class.  Once batch_size
+	increments have been queued, or batch_time seconds have passed
+	since the first, they are all synced together with
+	rpath.sync_files, and then the actions run in the order queued.
+
+	With a batch_size of 1 each increment is fsync'd on its own
+	before its action runs, as rdiff-backup always used to do.
+
+	"""
+	def __init__(self, batch_size, batch_time):
+		self.batch_size, self.batch_time = batch_size, batch_time
+		self.incs, self.actions = [], []
+		self.first_index = self.start_time = None
+
+	def add(self, index, inc, action):
+		"""Run action, which changes the mirror at index, once inc is synced
+
+		inc can be None if there is nothing to sync, in which case
+		action is only delayed if earlier actions are.
+
+		"""
+		if inc is None and not self.actions: return action()
+		if not self.actions:
+			self.first_index, self.start_time = index, time.time()
+		if inc is not None: self.incs.append(inc)
+		self.actions.append(action)
+		if (len(self.incs) >= self.batch_size or
+			time.time() - self.start_time >= self.batch_time): self.flush()
+
+	def is_pending(self, index):
+		"""True if mirror changes at or before index may be waiting"""
+		return self.actions and index >= self.first_index
+
+	def flush(self):
+		"""Sync the queued increments, then run the queued actions"""
+		if not self.actions: return
+		incs, actions = self.incs, self.actions
+		self.incs, self.actions = [], []
+		if self.batch_size > 1: rpath.sync_files(incs)
+		else:
+			for inc in incs: inc.fsync_with_dir()
+		for action in actions: action()
+
+
+class IncrementPool:
+	"""Make the increments of changed regular files in worker threads
+
+	Making an increment reads both the new and the old mirror file
+	again and writes a delta, which IncrementITRB would otherwise do
+	for one file at a time.  With an IncrementPool, it only writes
+	each new file to a temp file, in order, and queues its increment
+	here.  The workers run increment.make_increment, which releases
+	the GIL in librsync and file I/O.
+
+	Each job comes with a function to finish it (recording the
+	increment and queueing the mirror change in the SyncBatch).
+	These, and the actions which end directories, run in the main
+	thread in the order queued, so the CCPP, statistics and
+	connection are never used from a worker.
+	At most max_jobs increments are unfinished at a time.
+
+	"""
+	def __init__(self, num_threads):
+		self.max_jobs = 2 * num_threads
+		self.jobs = [] # (index, IncrementJob, finish function) triples
+		self.queue = Queue.Queue()
+		self.threads = []
+		for i in range(num_threads):
+			thread = threading.Thread(target = self.worker)
+			thread.setDaemon(1)
+			thread.start()
+			self.threads.append(thread)
+
+	def worker(self):
+		"""Run queued jobs until given None"""
+		while 1:
+			job = self.queue.get()
+			if job is None: return
+			job.run()
+
+	def add(self, index, args, finish, threaded = 1):
+		"""Make increment.make_increment(*args), then call finish
+
+		finish is called with a function which returns the increment
+		or raises the exception from making it.  If threaded is
+		false, the increment is made right away, but still finished
+		in order.
+
+		"""
+		job = IncrementJob(args)
+		if threaded: self.queue.put(job)
+		else: job.run()
+		self.jobs.append((index, job, finish))
+		while self.jobs:
+			job = self.jobs[0][1]
+			if (job and not job.done.isSet() and
+				len(self.jobs) <= self.max_jobs): break
+			self.finish_first()
+
+	def add_action(self, index, action):
+		"""Call action once the jobs queued so far are finished"""
+		if not self.jobs: return action()
+		self.jobs.append((index, None, action))
+
+	def is_pending(self, index):
+		"""True if increments at or before index may be unfinished"""
+		return self.jobs and index >= self.jobs[0][0]
+
+	def finish_first(self):
+		"""Wait for the oldest job and finish it"""
+		index, job, finish = self.jobs.pop(0)
+		if job is None: return finish()
+		job.done.wait()
+		finish(job.get_result)
+
+	def flush(self):
+		"""Finish all jobs"""
+		while self.jobs: self.finish_first()
+
+	def close(self):
+		"""Stop the worker threads"""
+		for thread in self.threads: self.queue.put(None)
+
+
+class IncrementJob:
+	"""Increment of one file, made by an IncrementPool"""
+	def __init__(self, args):
+		self.args = args
+		self.done = threading.Event()
+		self.result = self.exc_info = None
+
+	def run(self):
+		"""Make the increment, keeping any exception for get_result"""
+		try: self.result = increment.make_increment(*self.args)
+		except: self.exc_info = sys.exc_info()
+		self.done.set()
+
+	def get_result(self, *args):
+		"""Return the increment, or raise the exception from making it
+
+		Any args are ignored.  They can be given so that
+		robust.check_common_error passes them to its error handler.
+
+		"""
+		if self.exc_info:
+			raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+		return self.result
+
+
 class PatchITRB(rorpiter.ITRBranch):
 	"""Patch an rpath with the given diff iters (use with IterTreeReducer)
 
@@ -518,6 +1095,7 @@ class PatchITRB(rorpiter.ITRBranch):
 		self.dir_replacement, self.dir_update = None, None
 		self.CCPP = CCPP
 		self.error_handler = robust.get_error_handler("UpdateError")
+		self.new_sig = None
 
 	def can_fast_process(self, index, diff_rorp):
 		"""True if diff_rorp and mirror are not directories"""
@@ -535,6 +1113,7 @@ class PatchITRB(rorpiter.ITRBranch):
 				if robust.check_common_error(self.error_handler, rpath.rename,
 						(tf, mirror_rp)) is None:
 					self.CCPP.flag_success(index)
+					self.store_sig(index, mirror_rp, self.new_sig)
 				else:
 					tf.delete()
 			elif mirror_rp and mirror_rp.lstat():
@@ -548,9 +1127,11 @@ class PatchITRB(rorpiter.ITRBranch):
 		"""Patch basis_rp, writing output in new, which doesn't exist yet
 
 		Returns true if able to write new as desired, false if
-		UpdateError or similar gets in the way.
+		UpdateError or similar gets in the way.  If the signature of
+		new was made while writing it, it is left in self.new_sig.
 
 		"""
+		self.new_sig = None
 		if diff_rorp.isflaglinked():
 			self.patch_hardlink_to_temp(diff_rorp, new)
 		elif diff_rorp.get_attached_filetype() == 'snapshot':
@@ -582,20 +1163,32 @@ class PatchITRB(rorpiter.ITRBranch):
 			rpath.copy_attribs(diff_rorp, new)
 			return 2
 		
-		report = robust.check_common_error(self.error_handler, rpath.copy,
-										   (diff_rorp, new))
+		sig_gen = sigcache.get_generator(diff_rorp)
+		if sig_gen:
+			report = robust.check_common_error(self.error_handler,
+				new.write_from_fileobj,
+				(librsync.SigTee(diff_rorp.open("rb"), sig_gen), None,
+				 diff_rorp.issparse()))
+		else:
+			report = robust.check_common_error(self.error_handler,
+											   rpath.copy, (diff_rorp, new))
 		if isinstance(report, hash.Report):
 			self.CCPP.update_hash(diff_rorp.index, report.sha1_digest)
+			if sig_gen: self.new_sig = sig_gen.getsig()
 			return 1
 		return report != 0 # if == 0, error_handler caught something
 
 	def patch_diff_to_temp(self, basis_rp, diff_rorp, new):
 		"""Apply diff_rorp to basis_rp, write output in new"""
 		assert diff_rorp.get_attached_filetype() == 'diff'
+		rename_basis_rp = self.CCPP.get_rename_basis(diff_rorp.index)
+		if rename_basis_rp: basis_rp = rename_basis_rp
+		sig_gen = sigcache.get_generator(diff_rorp)
 		report = robust.check_common_error(self.error_handler,
-			      Rdiff.patch_local, (basis_rp, diff_rorp, new))
+			      Rdiff.patch_local, (basis_rp, diff_rorp, new, None, sig_gen))
 		if isinstance(report, hash.Report):
 			self.CCPP.update_hash(diff_rorp.index, report.sha1_digest)
+			if sig_gen: self.new_sig = sig_gen.getsig()
 			return 1
 		return report != 0 # if report == 0, error
 
@@ -615,6 +1208,13 @@ class PatchITRB(rorpiter.ITRBranch):
 					  "temp file %s does not match source" % (new_rp.path,))
 		return 0
 
+	def store_sig(self, index, mirror_rp, sig):
+		"""Keep signature sig of new mirror_rp for the next session"""
+		if not sig: return
+		source_rorp = self.CCPP.get_source_rorp(index)
+		if source_rorp and source_rorp.has_sha1():
+			sigcache.store(index, mirror_rp, source_rorp.get_sha1(), sig)
+
 	def write_special(self, diff_rorp, new):
 		"""Write diff_rorp (which holds special file) to new"""
 		eh = robust.get_error_handler("SpecialFileError")
@@ -684,8 +1284,10 @@ class IncrementITRB(PatchITRB):
 	Like PatchITRB, but this time also write increments.
 
 	"""
-	def __init__(self, basis_root_rp, inc_root_rp, rorp_cache):
+	def __init__(self, basis_root_rp, inc_root_rp, rorp_cache, sync_batch,
+				 inc_pool = None):
 		self.inc_root_rp = inc_root_rp
+		self.sync_batch, self.inc_pool = sync_batch, inc_pool
 		PatchITRB.__init__(self, basis_root_rp, rorp_cache)
 
 	def fast_process(self, index, diff_rorp):
@@ -693,25 +1295,52 @@ class IncrementITRB(PatchITRB):
 		mirror_rp, inc_prefix = longname.get_mirror_inc_rps(
 			self.CCPP.get_rorps(index), self.basis_root_rp, self.inc_root_rp)
 		tf = TempFile.new(mirror_rp)
-		if self.patch_to_temp(mirror_rp, diff_rorp, tf):
-			inc = robust.check_common_error(self.error_handler,
-					increment.Increment, (tf, mirror_rp, inc_prefix))
-			if inc is not None and not isinstance(inc, int):
-				self.CCPP.set_inc(index, inc)
-				if inc.isreg():
-					inc.fsync_with_dir() # Write inc before rp changed
-				if tf.lstat():
-					if robust.check_common_error(self.error_handler,
-							rpath.rename, (tf, mirror_rp)) is None:
-						self.CCPP.flag_success(index)
-					else:
-						tf.delete()
-				elif mirror_rp.lstat():
-					mirror_rp.delete()
-					self.CCPP.flag_deleted(index)
-				return # normal return, otherwise error occurred
-		tf.setdata()
-		if tf.lstat(): tf.delete()
+		if not self.patch_to_temp(mirror_rp, diff_rorp, tf):
+			tf.setdata()
+			if tf.lstat(): tf.delete()
+			return
+		sig = self.new_sig
+		finish = lambda get_inc: self.finish_increment(get_inc, index, tf,
+											mirror_rp, inc_prefix, sig)
+		if self.inc_pool:
+			self.inc_pool.add(index, (tf, mirror_rp, inc_prefix), finish,
+							  tf.isreg() and mirror_rp.isreg())
+		else: finish(increment.make_increment)
+
+	def finish_increment(self, get_inc, index, tf, mirror_rp, inc_prefix,
+						 sig):
+		"""Record increment from get_inc, then queue the mirror change"""
+		inc = robust.check_common_error(self.error_handler, get_inc,
+										(tf, mirror_rp, inc_prefix))
+		if inc is not None and not isinstance(inc, int):
+			statistics.process_increment(inc)
+			self.CCPP.set_inc(index, inc)
+			if not inc.isreg(): inc = None
+			# Write inc before rp changed
+			self.sync_batch.add(index, inc,
+				lambda: self.replace_mirror(index, tf, mirror_rp, sig))
+		else:
+			tf.setdata()
+			if tf.lstat(): tf.delete()
+
+	def replace_mirror(self, index, tf, mirror_rp, sig):
+		"""Move tf over mirror_rp, or delete mirror_rp if tf is missing"""
+		if tf.lstat():
+			if robust.check_common_error(self.error_handler,
+					rpath.rename, (tf, mirror_rp)) is None:
+				self.CCPP.flag_success(index)
+				self.store_sig(index, mirror_rp, sig)
+			else:
+				tf.delete()
+		elif mirror_rp.lstat():
+			mirror_rp.delete()
+			self.CCPP.flag_deleted(index)
+
+	def patch_hardlink_to_temp(self, diff_rorp, new):
+		"""Hardlink diff_rorp to temp once the file linked to is in place"""
+		if self.inc_pool: self.inc_pool.flush()
+		self.sync_batch.flush()
+		PatchITRB.patch_hardlink_to_temp(self, diff_rorp, new)
 
 	def start_process(self, index, diff_rorp):
 		"""Start processing directory"""
@@ -734,4 +1363,11 @@ class IncrementITRB(PatchITRB):
 				self.CCPP.set_inc(index, inc)
 				self.CCPP.flag_success(index)
 
+	def end_process(self):
+		"""Finish processing directory after the changes queued inside it"""
+		action = lambda: self.sync_batch.add(self.base_rp.index, None,
+										lambda: PatchITRB.end_process(self))
+		if self.inc_pool: self.inc_pool.add_action(self.base_rp.index, action)
+		else: action()
+
 
@@ -28,6 +28,10 @@
 #include <unistd.h>
 #endif
 #include <errno.h>
+#if !defined(MS_WIN64) && !defined(MS_WIN32)
+#include <dirent.h>
+#include <fcntl.h>
+#endif
 
 
 /* Some of the following code to define major/minor taken from code by
@@ -44,6 +48,21 @@
 #endif
 /* End major/minor section */
 
+/* scan_dir needs the *at() calls to stat files relative to a directory */
+#if defined(AT_SYMLINK_NOFOLLOW) && !defined(MS_WINDOWS)
+#define HAVE_SCAN_DIR
+#endif
+
+/* copy_fd uses copy_file_range, if the kernel has it, and sendfile */
+#ifdef __linux__
+#include <sys/sendfile.h>
+#include <sys/syscall.h>
+#define HAVE_COPY_FD
+#ifdef SYS_syncfs
+#define HAVE_SYNCFS
+#endif
+#endif
+
 /* choose the appropriate stat and fstat functions and return structs */
 /* This code taken from Python's posixmodule.c */
 #undef STAT
@@ -75,40 +94,25 @@
 
 static PyObject *UnknownFileTypeError;
 static PyObject *c_make_file_dict(PyObject *self, PyObject *args);
+static PyObject *scan_dir(PyObject *self, PyObject *args);
+static PyObject *list_dir_chunks(PyObject *self, PyObject *args);
+static PyObject *copy_fd(PyObject *self, PyObject *args);
 static PyObject *long2str(PyObject *self, PyObject *args);
 static PyObject *str2long(PyObject *self, PyObject *args);
 static PyObject *my_sync(PyObject *self, PyObject *args);
+static PyObject *my_syncfs(PyObject *self, PyObject *args);
+static PyObject *parse_metadata(PyObject *self, PyObject *args);
+static PyObject *md_intern(const char *s, int len);
 
+#if !defined(MS_WINDOWS)
 /* Turn a stat structure into a python dictionary.  The preprocessor
-   stuff taken from Python's posixmodule.c */
-static PyObject *c_make_file_dict(self, args)
-	 PyObject *self;
-	 PyObject *args;
+   stuff taken from Python's posixmodule.c.  If dir_fd is not -1,
+   filename is relative to that directory (see scan_dir). */
+static PyObject *stat_to_dict(char *filename, STRUCT_STAT sbuf, int dir_fd)
 {
-#if defined(MS_WINDOWS)
-	PyErr_SetString(PyExc_AttributeError, "This function is not implemented on Windows.");
-	return NULL;
-#else
   PyObject *size, *inode, *mtime, *atime, *ctime, *devloc, *return_val;
-  char *filename, filetype[5];
-  STRUCT_STAT sbuf;
+  char filetype[5];
   long int mode, perms;
-  int res;
-
-  if (!PyArg_ParseTuple(args, "s", &filename)) return NULL;
-
-  Py_BEGIN_ALLOW_THREADS
-  res = LSTAT(filename, &sbuf);
-  Py_END_ALLOW_THREADS
-
-  if (res != 0) {
-	if (errno == ENOENT || errno == ENOTDIR)
-	  return Py_BuildValue("{s:s}", "type", NULL);
-	else {
-	  PyErr_SetFromErrnoWithFilename(PyExc_OSError, filename);
-	  return NULL;
-	}
-  }
 
 #ifdef HAVE_LARGEFILE_SUPPORT
   size = PyLong_FromLongLong((PY_LONG_LONG)sbuf.st_size);
@@ -156,7 +160,12 @@ static PyObject *c_make_file_dict(self, args)
   } else if S_ISLNK(mode) {
 	/* Symbolic links */
 	char linkname[1024];
-	int len_link = readlink(filename, linkname, 1023);
+	int len_link;
+#ifdef HAVE_SCAN_DIR
+	if (dir_fd != -1) len_link = readlinkat(dir_fd, filename, linkname, 1023);
+	else
+#endif
+	len_link = readlink(filename, linkname, 1023);
 	if (len_link < 0) {
 	  PyErr_SetFromErrno(PyExc_OSError);
 	  return_val = NULL;
@@ -210,9 +219,263 @@ static PyObject *c_make_file_dict(self, args)
   Py_DECREF(atime);
   Py_DECREF(ctime);
   return return_val;
+}
+#endif /* !defined(MS_WINDOWS) */
+
+/* Return the data dictionary for a file, given its name */
+static PyObject *c_make_file_dict(self, args)
+	 PyObject *self;
+	 PyObject *args;
+{
+#if defined(MS_WINDOWS)
+	PyErr_SetString(PyExc_AttributeError, "This function is not implemented on Windows.");
+	return NULL;
+#else
+  char *filename;
+  STRUCT_STAT sbuf;
+  int res;
+
+  if (!PyArg_ParseTuple(args, "s", &filename)) return NULL;
+
+  Py_BEGIN_ALLOW_THREADS
+  res = LSTAT(filename, &sbuf);
+  Py_END_ALLOW_THREADS
+
+  if (res != 0) {
+	if (errno == ENOENT || errno == ENOTDIR)
+	  return Py_BuildValue("{s:s}", "type", NULL);
+	else {
+	  PyErr_SetFromErrnoWithFilename(PyExc_OSError, filename);
+	  return NULL;
+	}
+  }
+  return stat_to_dict(filename, sbuf, -1);
 #endif /* defined(MS_WINDOWS) */
 }
 
+/* List a directory, returning a list of (filename, data) pairs where
+   data is the dictionary make_file_dict would return for the file.
+   The directory is opened once and each file is stat'ed relative to
+   it with fstatat, so the kernel doesn't resolve the whole path again
+   for each file.  data is None if the file couldn't be stat'ed or
+   its type is unknown, so the caller can deal with the error.  If the
+   optional max_entries is positive and the directory has more entries
+   than that, None is returned instead (see list_dir_chunks). */
+static PyObject *scan_dir(self, args)
+	 PyObject *self;
+	 PyObject *args;
+{
+#ifndef HAVE_SCAN_DIR
+  PyErr_SetString(PyExc_NotImplementedError,
+				  "scan_dir needs fstatat, not available on this system");
+  return NULL;
+#else
+  char *dirname, *name;
+  DIR *dir;
+  struct dirent *entry;
+  STRUCT_STAT sbuf;
+  PyObject *list, *data, *item, *name_str;
+  int dir_fd, res, max_entries = 0, num_entries = 0;
+
+  if (!PyArg_ParseTuple(args, "s|i", &dirname, &max_entries)) return NULL;
+
+  Py_BEGIN_ALLOW_THREADS
+  dir = opendir(dirname);
+  Py_END_ALLOW_THREADS
+  if (!dir) return PyErr_SetFromErrnoWithFilename(PyExc_OSError, dirname);
+  dir_fd = dirfd(dir);
+  if (!(list = PyList_New(0))) goto error;
+
+  while (1) {
+	errno = 0;
+	Py_BEGIN_ALLOW_THREADS
+	entry = readdir(dir);
+	Py_END_ALLOW_THREADS
+	if (!entry) {
+	  if (!errno) break;
+	  PyErr_SetFromErrnoWithFilename(PyExc_OSError, dirname);
+	  goto error;
+	}
+	name = entry->d_name;
+	if (name[0] == '.' && (!name[1] || (name[1] == '.' && !name[2])))
+	  continue;
+	if (max_entries > 0 && ++num_entries > max_entries) {
+	  Py_DECREF(list);
+	  closedir(dir);
+	  Py_INCREF(Py_None);
+	  return Py_None;
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+	res = fstatat(dir_fd, name, &sbuf, AT_SYMLINK_NOFOLLOW);
+	Py_END_ALLOW_THREADS
+	if (res == 0) data = stat_to_dict(name, sbuf, dir_fd);
+	else if (errno == ENOENT) data = Py_BuildValue("{s:s}", "type", NULL);
+	else data = NULL;
+	if (!data) {
+	  PyErr_Clear();
+	  Py_INCREF(Py_None);
+	  data = Py_None;
+	}
+	if (!(name_str = md_intern(name, strlen(name)))) {
+	  Py_DECREF(data);
+	  goto error;
+	}
+	if (!(item = Py_BuildValue("(NN)", name_str, data)) ||
+		PyList_Append(list, item) < 0) {
+	  Py_XDECREF(item);
+	  goto error;
+	}
+	Py_DECREF(item);
+  }
+  closedir(dir);
+  return list;
+
+ error:
+  Py_XDECREF(list);
+  closedir(dir);
+  return NULL;
+#endif /* HAVE_SCAN_DIR */
+}
+
+/* Read the filenames in a directory without keeping them all in
+   memory.  func is called with a list of up to chunk_size filenames
+   at a time, in directory order, and must not keep the list.  Used
+   to sort huge directories in runs (see rpath.listdir_sorted). */
+static PyObject *list_dir_chunks(self, args)
+	 PyObject *self;
+	 PyObject *args;
+{
+#if defined(MS_WIN64) || defined(MS_WIN32)
+  PyErr_SetString(PyExc_NotImplementedError,
+				  "list_dir_chunks not available on this system");
+  return NULL;
+#else
+  char *dirname, *name;
+  DIR *dir;
+  struct dirent *entry;
+  PyObject *func, *list, *item, *result;
+  int chunk_size;
+
+  if (!PyArg_ParseTuple(args, "siO", &dirname, &chunk_size, &func))
+	return NULL;
+  if (chunk_size < 1) {
+	PyErr_SetString(PyExc_ValueError, "chunk_size must be positive");
+	return NULL;
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  dir = opendir(dirname);
+  Py_END_ALLOW_THREADS
+  if (!dir) return PyErr_SetFromErrnoWithFilename(PyExc_OSError, dirname);
+  if (!(list = PyList_New(0))) goto error;
+
+  while (1) {
+	errno = 0;
+	Py_BEGIN_ALLOW_THREADS
+	entry = readdir(dir);
+	Py_END_ALLOW_THREADS
+	if (!entry) {
+	  if (!errno) break;
+	  PyErr_SetFromErrnoWithFilename(PyExc_OSError, dirname);
+	  goto error;
+	}
+	name = entry->d_name;
+	if (name[0] == '.' && (!name[1] || (name[1] == '.' && !name[2])))
+	  continue;
+
+	if (!(item = PyString_FromString(name)) ||
+		PyList_Append(list, item) < 0) {
+	  Py_XDECREF(item);
+	  goto error;
+	}
+	Py_DECREF(item);
+	if (PyList_GET_SIZE(list) >= chunk_size) {
+	  result = PyObject_CallFunction(func, "(O)", list);
+	  if (!result) goto error;
+	  Py_DECREF(result);
+	  Py_DECREF(list);
+	  if (!(list = PyList_New(0))) goto error;
+	}
+  }
+  if (PyList_GET_SIZE(list) > 0) {
+	result = PyObject_CallFunction(func, "(O)", list);
+	if (!result) goto error;
+	Py_DECREF(result);
+  }
+  Py_DECREF(list);
+  closedir(dir);
+  Py_INCREF(Py_None);
+  return Py_None;
+
+ error:
+  Py_XDECREF(list);
+  closedir(dir);
+  return NULL;
+#endif
+}
+
+/* Copy the rest of file descriptor in_fd to out_fd in the kernel.
+   copy_file_range is tried first, because filesystems can clone the
+   data or copy it on the server, then sendfile.  The copy starts at
+   both descriptors' offsets and leaves them at the end.  Returns the
+   number of bytes copied, or raises NotImplementedError if neither
+   call works on these files and nothing was copied.  The copy stops
+   when the kernel returns 0, which some files in /proc, /sys or on
+   FUSE filesystems do before their end, so the caller has to check
+   the total against the file size (see rpath.copy_fd_rest). */
+static PyObject *copy_fd(self, args)
+	 PyObject *self;
+	 PyObject *args;
+{
+#ifndef HAVE_COPY_FD
+  PyErr_SetString(PyExc_NotImplementedError,
+				  "copy_fd not available on this system");
+  return NULL;
+#else
+  int in_fd, out_fd, use_copy_range = 0;
+  ssize_t copied;
+  PY_LONG_LONG total = 0;
+  const size_t max_chunk = 1 << 30;
+
+  if (!PyArg_ParseTuple(args, "ii", &in_fd, &out_fd)) return NULL;
+#ifdef SYS_copy_file_range
+  use_copy_range = 1;
+#endif
+
+  while (1) {
+	Py_BEGIN_ALLOW_THREADS
+#ifdef SYS_copy_file_range
+	if (use_copy_range)
+	  copied = syscall(SYS_copy_file_range, in_fd, NULL,
+					   out_fd, NULL, max_chunk, 0);
+	else
+#endif
+	  copied = sendfile(out_fd, in_fd, NULL, max_chunk);
+	Py_END_ALLOW_THREADS
+	if (copied > 0) total += copied;
+	else if (copied == 0) {
+	  /* copy_file_range returns 0 at once on files it can't read,
+		 like those in /proc, where sendfile may still work */
+	  if (use_copy_range && total == 0) use_copy_range = 0;
+	  else break;
+	}
+	else if (errno == EINTR) continue;
+	else if (use_copy_range && total == 0 &&
+			 (errno == ENOSYS || errno == EXDEV || errno == EINVAL ||
+			  errno == EOPNOTSUPP || errno == EBADF))
+	  use_copy_range = 0;	/* fall back to sendfile */
+	else if (total == 0 && (errno == ENOSYS || errno == EINVAL)) {
+	  PyErr_SetString(PyExc_NotImplementedError,
+					  "copy_fd can't copy between these files");
+	  return NULL;
+	}
+	else return PyErr_SetFromErrno(PyExc_OSError);
+  }
+  return PyLong_FromLongLong(total);
+#endif
+}
+
 /* Convert python long into 7 byte string */
 static PyObject *long2str(self, args)
 	 PyObject *self;
@@ -240,6 +503,35 @@ static PyObject *my_sync(self, args)
 }
 
 
+/* Write out the filesystem holding fd with syncfs(), return None.
+   Raises NotImplementedError where syncfs isn't available (see
+   rpath.sync_files). */
+static PyObject *my_syncfs(self, args)
+	 PyObject *self;
+	 PyObject *args;
+{
+  int fd, result;
+
+  if (!PyArg_ParseTuple(args, "i", &fd)) return NULL;
+#ifndef HAVE_SYNCFS
+  PyErr_SetString(PyExc_NotImplementedError,
+				  "syncfs not available on this system");
+  return NULL;
+#else
+  Py_BEGIN_ALLOW_THREADS
+  result = syscall(SYS_syncfs, fd);
+  Py_END_ALLOW_THREADS
+  if (result == 0) return Py_BuildValue("");
+  if (errno == ENOSYS) {
+	PyErr_SetString(PyExc_NotImplementedError,
+					"syncfs not supported by the kernel");
+	return NULL;
+  }
+  return PyErr_SetFromErrno(PyExc_OSError);
+#endif
+}
+
+
 /* Reverse of above; convert 7 byte string into python long */
 static PyObject *str2long(self, args)
 	 PyObject *self;
@@ -411,14 +703,280 @@ posix_lchown(PyObject *self, PyObject *args)
 }
 #endif /* HAVE_LCHOWN */
 
+/* ------------- Metadata record parsing ----------------------------- */
+
+/* This is a faster version of metadata.Record2RORP, which is run on
+ * every record of every mirror_metadata file.  It takes a buffer
+ * holding any number of whole text records.  Each record is turned
+ * into a RORPath, or passed back as a string if it contains anything
+ * unusual (resource forks, unknown fields, malformed values), so that
+ * Record2RORP can deal with it (and complain about it) as before.
+ */
+
+#define MD_STRING 0			/* data stored as is */
+#define MD_INT 1			/* python int, like int(data) */
+#define MD_LONG 2			/* python long, like long(data) */
+#define MD_TYPE 3			/* file type, "None" means None */
+#define MD_NAME 4			/* user/group name, ":" means None */
+#define MD_PATH 5			/* path quoted by quote_path */
+#define MD_DEVNUMS 6		/* "<devchar> <major> <minor>" */
+
+static struct md_field {
+  char *name;
+  int name_len;
+  char *key;
+  int kind;
+  PyObject *key_obj;
+} md_fields[] = {
+  {"Type", 4, "type", MD_TYPE, NULL},
+  {"Size", 4, "size", MD_LONG, NULL},
+  {"ModTime", 7, "mtime", MD_LONG, NULL},
+  {"Uid", 3, "uid", MD_INT, NULL},
+  {"Uname", 5, "uname", MD_NAME, NULL},
+  {"Gid", 3, "gid", MD_INT, NULL},
+  {"Gname", 5, "gname", MD_NAME, NULL},
+  {"Permissions", 11, "perms", MD_INT, NULL},
+  {"SHA1Digest", 10, "sha1", MD_STRING, NULL},
+  {"NumHardLinks", 12, "nlink", MD_INT, NULL},
+  {"Inode", 5, "inode", MD_LONG, NULL},
+  {"DeviceLoc", 9, "devloc", MD_LONG, NULL},
+  {"SymData", 7, "linkname", MD_PATH, NULL},
+  {"DeviceNum", 9, "devnums", MD_DEVNUMS, NULL},
+  {"AlternateMirrorName", 19, "mirrorname", MD_STRING, NULL},
+  {"AlternateIncrementName", 22, "incname", MD_STRING, NULL},
+  {NULL, 0, NULL, 0, NULL}
+};
+
+/* Return interned python string.  Types, user/group names and
+   filenames repeat a lot, so this saves memory and makes later
+   comparisons quicker.  scan_dir uses it too, so the source and
+   metadata indicies share their filenames. */
+static PyObject *md_intern(const char *s, int len)
+{
+  PyObject *str = PyString_FromStringAndSize(s, len);
+
+  if (str) PyString_InternInPlace(&str);
+  return str;
+}
+
+/* Return python int or long of decimal number s, or NULL without
+   setting an exception if s isn't a plain decimal number */
+static PyObject *md_number(const char *s, int len, int as_long)
+{
+  char numbuf[32];
+  int i = 0;
+
+  if (len > 0 && s[0] == '-') i = 1;
+  if (len <= i || len >= (int) sizeof(numbuf)) return NULL;
+  for (; i < len; i++)
+	if (!isdigit((unsigned char) s[i])) return NULL;
+  memcpy(numbuf, s, len);
+  numbuf[len] = '\0';
+  if (as_long) return PyLong_FromString(numbuf, NULL, 10);
+  return PyInt_FromString(numbuf, NULL, 10);
+}
+
+/* Undo metadata.quote_path into out, which must have room for len
+   chars.  Return new length, or -1 if there is an unknown escape. */
+static int md_unquote(const char *s, int len, char *out)
+{
+  const char *end = s + len;
+  char *q = out;
+
+  for (; s < end; s++) {
+	if (*s != '\\') *q++ = *s;
+	else if (s + 1 < end && s[1] == 'n') { *q++ = '\n'; s++; }
+	else if (s + 1 < end && s[1] == '\\') { *q++ = '\\'; s++; }
+	else return -1;
+  }
+  return q - out;
+}
+
+/* Return unquoted path as python string, or NULL without an
+   exception if it can't be unquoted */
+static PyObject *md_path(const char *s, int len)
+{
+  PyObject *str;
+  int newlen;
+
+  if (!(str = PyString_FromStringAndSize(NULL, len))) return NULL;
+  newlen = md_unquote(s, len, PyString_AS_STRING(str));
+  if (newlen < 0) {
+	Py_DECREF(str);
+	return NULL;
+  }
+  if (newlen != len) _PyString_Resize(&str, newlen);
+  return str;
+}
+
+/* Return index tuple like metadata.quoted_filename_to_index */
+static PyObject *md_index(const char *s, int len)
+{
+  PyObject *index, *path, *comp;
+  char *p, *start, *end;
+  int n, i;
+
+  if (len == 1 && s[0] == '.') return PyTuple_New(0);
+  if (!(path = md_path(s, len))) return NULL;
+  start = PyString_AS_STRING(path);
+  end = start + PyString_GET_SIZE(path);
+  for (n = 1, p = start; p < end; p++)
+	if (*p == '/') n++;
+  if (!(index = PyTuple_New(n))) goto error;
+  for (i = 0, p = start; i < n; i++, start = p + 1) {
+	for (p = start; p < end && *p != '/'; p++);
+	if (!(comp = md_intern(start, p - start))) {
+	  Py_DECREF(index);
+	  goto error;
+	}
+	PyTuple_SET_ITEM(index, i, comp);
+  }
+  Py_DECREF(path);
+  return index;
+ error:
+  Py_DECREF(path);
+  return NULL;
+}
+
+/* Return value of field given its data, NULL without an exception
+   if the record should be passed back to python */
+static PyObject *md_value(struct md_field *field, const char *s, int len)
+{
+  const char *sp1, *sp2, *end = s + len;
+  PyObject *devchar, *major_num, *minor_num;
+
+  switch (field->kind) {
+  case MD_STRING:
+	return PyString_FromStringAndSize(s, len);
+  case MD_INT:
+	return md_number(s, len, 0);
+  case MD_LONG:
+	return md_number(s, len, 1);
+  case MD_TYPE:
+	if (len == 4 && !memcmp(s, "None", 4)) break;
+	return md_intern(s, len);
+  case MD_NAME:
+	if ((len == 1 && s[0] == ':') || (len == 4 && !memcmp(s, "None", 4)))
+	  break;
+	return md_intern(s, len);
+  case MD_PATH:
+	return md_path(s, len);
+  case MD_DEVNUMS:
+	if (!(sp1 = memchr(s, ' ', len)) || sp1 == s ||
+		!(sp2 = memchr(sp1 + 1, ' ', end - sp1 - 1)) ||
+		memchr(sp2 + 1, ' ', end - sp2 - 1)) return NULL;
+	if (!(major_num = md_number(sp1 + 1, sp2 - sp1 - 1, 0))) return NULL;
+	if (!(minor_num = md_number(sp2 + 1, end - sp2 - 1, 0))) {
+	  Py_DECREF(major_num);
+	  return NULL;
+	}
+	if (!(devchar = md_intern(s, sp1 - s))) {
+	  Py_DECREF(major_num);
+	  Py_DECREF(minor_num);
+	  return NULL;
+	}
+	return Py_BuildValue("(NNN)", devchar, major_num, minor_num);
+  }
+  Py_INCREF(Py_None);
+  return Py_None;
+}
+
+/* Parse a single record.  Return new RORPath, the record itself as a
+   string if python should parse it, or NULL on error. */
+static PyObject *md_record(const char *rec, int reclen, PyObject *rorp_class)
+{
+  const char *p, *end = rec + reclen, *line_end, *name, *data;
+  PyObject *index = NULL, *dict, *value, *result;
+  struct md_field *field;
+  int name_len;
+
+  if (!(dict = PyDict_New())) return NULL;
+  for (p = rec; p < end; p = line_end + 1) {
+	if (!(line_end = memchr(p, '\n', end - p))) line_end = end;
+	/* Lines must match "^ *([A-Za-z0-9]+) (.+)$", others are ignored */
+	for (name = p; name < line_end && *name == ' '; name++);
+	for (data = name; data < line_end && isalnum((unsigned char) *data);
+		 data++);
+	name_len = data - name;
+	if (!name_len || data + 1 >= line_end || *data != ' ') continue;
+	data++;
+
+	if (name_len == 4 && !memcmp(name, "File", 4)) {
+	  Py_XDECREF(index);
+	  if (!(index = md_index(data, line_end - data))) goto fallback;
+	  continue;
+	}
+	for (field = md_fields; field->name; field++)
+	  if (field->name_len == name_len && !memcmp(field->name, name, name_len))
+		break;
+	if (!field->name) goto fallback;
+	if (!(value = md_value(field, data, line_end - data))) goto fallback;
+	if (PyDict_SetItem(dict, field->key_obj, value) < 0) {
+	  Py_DECREF(value);
+	  goto error;
+	}
+	Py_DECREF(value);
+  }
+  if (!index) goto fallback;
+
+  result = PyObject_CallFunctionObjArgs(rorp_class, index, dict, NULL);
+  Py_DECREF(index);
+  Py_DECREF(dict);
+  return result;
+
+ fallback:
+  if (PyErr_Occurred()) goto error;
+  Py_XDECREF(index);
+  Py_DECREF(dict);
+  return PyString_FromStringAndSize(rec, reclen);
+ error:
+  Py_XDECREF(index);
+  Py_DECREF(dict);
+  return NULL;
+}
+
+/* Split buffer into records at "\nFile " and parse each one */
+static PyObject *parse_metadata(PyObject *self, PyObject *args)
+{
+  const char *buf, *start, *end, *p;
+  PyObject *rorp_class, *list, *item;
+  int buflen;
+
+  if (!PyArg_ParseTuple(args, "s#O:parse_metadata", &buf, &buflen,
+						&rorp_class)) return NULL;
+  if (!(list = PyList_New(0))) return NULL;
+  end = buf + buflen;
+  for (start = buf; start < end; start = p) {
+	for (p = start + 1; (p = memchr(p, '\n', end - p)); p++)
+	  if (end - p > 5 && !memcmp(p + 1, "File ", 5)) break;
+	p = p ? p + 1 : end;
+	if (!(item = md_record(start, p - start, rorp_class)) ||
+		PyList_Append(list, item) < 0) {
+	  Py_XDECREF(item);
+	  Py_DECREF(list);
+	  return NULL;
+	}
+	Py_DECREF(item);
+  }
+  return list;
+}
+
 /* ------------- Python export lists -------------------------------- */
 
 static PyMethodDef CMethods[] = {
   {"make_file_dict", c_make_file_dict, METH_VARARGS,
    "Make dictionary from file stat"},
+  {"scan_dir", scan_dir, METH_VARARGS,
+   "List directory, returning (filename, file stat dictionary) pairs"},
+  {"list_dir_chunks", list_dir_chunks, METH_VARARGS,
+   "Pass the filenames in a directory to a function in chunks"},
+  {"copy_fd", copy_fd, METH_VARARGS,
+   "Copy rest of one file descriptor to another in the kernel"},
   {"long2str", long2str, METH_VARARGS, "Convert python long to 7 byte string"},
   {"str2long", str2long, METH_VARARGS, "Convert 7 byte string to python long"},
   {"sync", my_sync, METH_VARARGS, "sync buffers to disk"},
+  {"syncfs", my_syncfs, METH_VARARGS,
+   "sync the filesystem holding a file descriptor to disk"},
   {"acl_quote", acl_quote, METH_VARARGS,
    "Quote string, escaping non-printables"},
   {"acl_unquote", acl_unquote, METH_VARARGS,
@@ -427,16 +985,21 @@ static PyMethodDef CMethods[] = {
   {"lchown", posix_lchown, METH_VARARGS,
    "Like chown, but don't follow symlinks"},
 #endif /* HAVE_LCHOWN */
+  {"parse_metadata", parse_metadata, METH_VARARGS,
+   "Parse buffer of metadata records into RORPaths"},
   {NULL, NULL, 0, NULL}
 };
 
 void initC(void)
 {
   PyObject *m, *d;
+  struct md_field *field;
 
   m = Py_InitModule("C", CMethods);
   d = PyModule_GetDict(m);
   UnknownFileTypeError = PyErr_NewException("C.UnknownFileTypeError",
 											NULL, NULL);
   PyDict_SetItemString(d, "UnknownFileTypeError", UnknownFileTypeError);
+  for (field = md_fields; field->name; field++)
+	field->key_obj = PyString_InternFromString(field->key);
 }
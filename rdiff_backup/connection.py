@@ -164,13 +164,13 @@ class LowLevelPipeConnection(Connection):
 
 		"""
 		rpath_repr = (rpath.conn.conn_number, rpath.base,
-					  rpath.index, rpath.data)
+					  rpath.index, rpath.data.copy())
 		self._write("R", cPickle.dumps(rpath_repr, 1), req_num)
 
 	def _putqrpath(self, qrpath, req_num):
 		"""Put a quoted rpath into the pipe (similar to _putrpath above)"""
 		qrpath_repr = (qrpath.conn.conn_number, qrpath.base,
-					   qrpath.index, qrpath.data)
+					   qrpath.index, qrpath.data.copy())
 		self._write("Q", cPickle.dumps(qrpath_repr, 1), req_num)
 
 	def _putrorpath(self, rorpath, req_num):
@@ -180,7 +180,7 @@ class LowLevelPipeConnection(Connection):
 		it must be excluded from the pickling
 
 		"""
-		rorpath_repr = (rorpath.index, rorpath.data)
+		rorpath_repr = (rorpath.index, rorpath.data.copy())
 		self._write("r", cPickle.dumps(rorpath_repr, 1), req_num)
 
 	def _putconn(self, pipeconn, req_num):
@@ -540,7 +540,7 @@ import Globals, Time, Rdiff, Hardlink, FilenameMapping, C, Security, \
 	   Main, rorpiter, selection, increment, statistics, manage, lazy, \
 	   iterfile, rpath, robust, restore, manage, backup, connection, \
 	   TempFile, SetConnections, librsync, log, regress, fs_abilities, \
-	   eas_acls, user_group, compare
+	   eas_acls, user_group, compare, metadata
 
 try: import win_acls
 except ImportError: pass
@@ -19,8 +19,12 @@
 
 """Provides functions and *ITR classes, for writing increment files"""
 
+import zlib
 import Globals, Time, rpath, Rdiff, log, statistics, robust
 
+# Files shorter than this are compressed without sampling them first
+min_sample_size = 1024
+
 
 def Increment(new, mirror, incpref):
 	"""Main file incrementing function, returns inc file created
@@ -32,6 +36,18 @@ def Increment(new, mirror, incpref):
 	This function basically moves the information about the mirror
 	file to incpref.
 
+	"""
+	incrp = make_increment(new, mirror, incpref)
+	statistics.process_increment(incrp)
+	return incrp
+
+def make_increment(new, mirror, incpref):
+	"""Like Increment, but don't add the increment to the statistics
+
+	When new and mirror are regular files this uses neither the
+	statistics nor the connection, so it can be run in a worker
+	thread (see backup.IncrementPool).
+
 	"""
 	log.Log("Incrementing mirror file " + mirror.path, 5)
 	if ((new and new.isdir()) or mirror.isdir()) and not incpref.lstat():
@@ -42,7 +58,6 @@ def Increment(new, mirror, incpref):
 	elif new.isreg() and mirror.isreg():
 		incrp = makediff(new, mirror, incpref)
 	else: incrp = makesnapshot(mirror, incpref)
-	statistics.process_increment(incrp)
 	return incrp
 
 def makemissing(incpref):
@@ -52,16 +67,50 @@ def makemissing(incpref):
 	return incrp
 
 def iscompressed(mirror):
-	"""Return true if mirror's increments should be compressed"""
-	return (Globals.compression and
-			not Globals.no_compression_regexp.match(mirror.path))
+	"""Return compression suffix if mirror's increments should be compressed
+
+	The suffix depends on Globals.compression_codec, see
+	rpath.compression_codecs.
+
+	"""
+	if (Globals.compression and
+		not Globals.no_compression_regexp.match(mirror.path)):
+		return rpath.get_compression_suffix()
+	return None
+
+def iscompressible(mirror):
+	"""Return false if a sample of mirror's data hardly compresses
+
+	The sample is the first Globals.compression_sample_size bytes,
+	compressed at zlib's fastest level.  Errors reading mirror are
+	ignored here, they will come up again when the increment is made.
+
+	"""
+	if not Globals.compression_sample_size or not mirror.isreg(): return 1
+	try:
+		fp = mirror.open("rb")
+		sample = fp.read(Globals.compression_sample_size)
+		fp.close()
+	except (IOError, OSError): return 1
+	if len(sample) < min_sample_size: return 1
+	ratio = float(len(sample)) / len(zlib.compress(sample, 1))
+	log.Log("Sample of %s compresses with ratio %.2f" %
+			(mirror.get_indexpath(), ratio), 7)
+	return ratio >= Globals.compression_min_ratio
+
+def get_compression(mirror):
+	"""Return (compression suffix or None, true if sampled incompressible)"""
+	compress = iscompressed(mirror)
+	if compress and not iscompressible(mirror): return (None, 1)
+	return (compress, 0)
 
 def makesnapshot(mirror, incpref):
 	"""Copy mirror to incfile, since new is quite different"""
-	compress = iscompressed(mirror)
+	compress, incompressible = get_compression(mirror)
 	if compress and mirror.isreg():
-		snapshotrp = get_inc(incpref, "snapshot.gz")
+		snapshotrp = get_inc(incpref, "snapshot." + compress)
 	else: snapshotrp = get_inc(incpref, "snapshot")
+	snapshotrp.incompressible = incompressible
 
 	if mirror.isspecial(): # check for errors when creating special increments
 		eh = robust.get_error_handler("SpecialFileError")
@@ -75,10 +124,6 @@ def makesnapshot(mirror, incpref):
 
 def makediff(new, mirror, incpref):
 	"""Make incfile which is a diff new -> mirror"""
-	compress = iscompressed(mirror)
-	if compress: diff = get_inc(incpref, "diff.gz")
-	else:  diff = get_inc(incpref, "diff")
-
 	old_new_perms, old_mirror_perms = (None, None)
 
 	if Globals.process_uid != 0:
@@ -89,6 +134,11 @@ def makediff(new, mirror, incpref):
 		if not mirror.readable():
 			old_mirror_perms = mirror.getperms()
 			mirror.chmod(0400 | old_mirror_perms)
+
+	compress, incompressible = get_compression(mirror)
+	if compress: diff = get_inc(incpref, "diff." + compress)
+	else:  diff = get_inc(incpref, "diff")
+	diff.incompressible = incompressible
 	
 	Rdiff.write_delta(new, mirror, diff, compress)
 
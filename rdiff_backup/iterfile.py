@@ -349,10 +349,10 @@ class MiscIterToFile(FileWrappingIter):
 	def addrorp(self, rorp):
 		"""Add a rorp to the buffer"""
 		if rorp.file:
-			pickle = cPickle.dumps((rorp.index, rorp.data, 1), 1)
+			pickle = cPickle.dumps((rorp.index, rorp.data.copy(), 1), 1)
 			self.next_in_line = rorp.file
 		else:
-			pickle = cPickle.dumps((rorp.index, rorp.data, 0), 1)
+			pickle = cPickle.dumps((rorp.index, rorp.data.copy(), 0), 1)
 			self.rorps_in_buffer += 1
 		self.array_buf.fromstring("r")
 		self.array_buf.fromstring(C.long2str(long(len(pickle))))
@@ -24,11 +24,28 @@ which is written in C.  The goal was to use C as little as possible...
 
 """
 
-import types, array
+import types, struct, tempfile, cStringIO, sys
 import _librsync
 
+try: import threading, Queue
+except ImportError: threading = None
+
 blocksize = _librsync.RS_JOB_BLOCKSIZE
 
+# A chunked delta (see ChunkedDeltaFile) starts with this instead of
+# librsync's delta magic "rs\x026"
+chunked_delta_magic = "rb\x026"
+
+# Length of the header at the start of a librsync signature (magic,
+# block length, and strong sum length)
+sig_header_length = 12
+
+# The makers' cycle_into() works on buffers that python 2.7 makes with
+# bytearray and memoryview.  Older pythons run the jobs with cycle(),
+# which takes and returns strings (see StringBuffer).
+try: use_buffers = memoryview and bytearray and 1
+except NameError: use_buffers = 0
+
 class librsyncError(Exception):
 	"""Signifies error in internal librsync processing (bad signature, etc.)
 
@@ -41,12 +58,89 @@ class librsyncError(Exception):
 	pass
 
 
+class RingBuffer:
+	"""Fixed-size buffer of bytes, read at the front and filled at the back
+
+	The bytearray is allocated once, and data is passed to and from
+	_librsync as memoryviews of it.  When there isn't enough free
+	space after the data, what is left (less than a block) is moved
+	back to the front, so the buffer goes round and round instead of
+	growing or being copied whole.
+
+	"""
+	def __init__(self, size):
+		self.data = bytearray(size)
+		self.start = self.end = 0
+
+	def __len__(self): return self.end - self.start
+
+	def get_view(self):
+		"""Return memoryview of the data in the buffer"""
+		return memoryview(self.data)[self.start:self.end]
+
+	def get_space(self, min_length):
+		"""Return memoryview of the free space, at least min_length long"""
+		if len(self.data) - self.end < min_length:
+			length = self.end - self.start
+			self.data[:length] = self.data[self.start:self.end]
+			self.start, self.end = 0, length
+		assert len(self.data) - self.end >= min_length
+		return memoryview(self.data)[self.end:]
+
+	def fill(self, length):
+		"""Mark length bytes at the start of the free space as data"""
+		self.end += length
+
+	def consume(self, length):
+		"""Drop the first length bytes of data"""
+		self.start += length
+		if self.start == self.end: self.start = self.end = 0
+
+	def read(self, length):
+		"""Return and drop the first length bytes of data, as a string"""
+		result = memoryview(self.data)[self.start:self.start+length].tobytes()
+		self.consume(len(result))
+		return result
+
+	def add(self, s):
+		"""Copy string or buffer s to the end of the data"""
+		length = len(s)
+		self.get_space(length)[:length] = s
+		self.fill(length)
+
+
+class StringBuffer:
+	"""Like RingBuffer, but keeps the data in a string
+
+	This is used when python doesn't have bytearray and memoryview, so
+	get_view returns the string, and data is only added with add.
+
+	"""
+	def __init__(self, size): self.data = ""
+
+	def __len__(self): return len(self.data)
+
+	def get_view(self): return self.data
+
+	def consume(self, length): self.data = self.data[length:]
+
+	def read(self, length):
+		result = self.data[:length]
+		self.consume(length)
+		return result
+
+	def add(self, s): self.data += s
+
+if use_buffers: Buffer = RingBuffer
+else: Buffer = StringBuffer
+
+
 class LikeFile:
 	"""File-like object used by SigFile, DeltaFile, and PatchFile"""
 	mode = "rb"
 
 	# This will be replaced in subclasses by an object with
-	# appropriate cycle() method
+	# appropriate cycle_into() and cycle() methods
 	maker = None
 
 	def __init__(self, infile, need_seek = None):
@@ -54,8 +148,11 @@ class LikeFile:
 		self.check_file(infile, need_seek)
 		self.infile = infile
 		self.closed = self.infile_closed = None
-		self.inbuf = ""
-		self.outbuf = array.array('c')
+		if use_buffers and type(infile) is types.FileType:
+			self.readinto = infile.readinto
+		else: self.readinto = None
+		self.inbuf = Buffer(2 * blocksize)
+		self.outbuf = Buffer(blocksize)
 		self.eof = self.infile_eof = None
 
 	def check_file(self, file, need_seek = None):
@@ -68,38 +165,50 @@ class LikeFile:
 			raise TypeError("Basis file must have a seek() method")
 
 	def read(self, length = -1):
-		"""Build up self.outbuf, return first length bytes"""
-		if length == -1:
-			while not self.eof: self._add_to_outbuf_once()
-			real_len = len(self.outbuf)
-		else:
-			while not self.eof and len(self.outbuf) < length:
+		"""Run the maker until length bytes are ready, and return them"""
+		pieces, size = [], 0
+		while length < 0 or size < length:
+			if not self.outbuf:
+				if self.eof: break
 				self._add_to_outbuf_once()
-			real_len = min(length, len(self.outbuf))
-			
-		return_val = self.outbuf[:real_len].tostring()
-		del self.outbuf[:real_len]
-		return return_val
+				continue
+			if length < 0: piece_len = len(self.outbuf)
+			else: piece_len = min(length - size, len(self.outbuf))
+			pieces.append(self.outbuf.read(piece_len))
+			size += piece_len
+		return "".join(pieces)
 
 	def _add_to_outbuf_once(self):
-		"""Add one cycle's worth of output to self.outbuf"""
+		"""Fill the empty self.outbuf with one cycle's worth of output"""
 		if not self.infile_eof: self._add_to_inbuf()
-		try: self.eof, len_inbuf_read, cycle_out = self.maker.cycle(self.inbuf)
+		try:
+			if use_buffers:
+				self.eof, len_inbuf_read, len_out = self.maker.cycle_into(
+					self.inbuf.get_view(), self.outbuf.get_space(blocksize))
+				self.outbuf.fill(len_out)
+			else:
+				self.eof, len_inbuf_read, cycle_out = self.maker.cycle(
+					self.inbuf.get_view())
+				self.outbuf.add(cycle_out)
 		except _librsync.librsyncError, e: raise librsyncError(str(e))
-		self.inbuf = self.inbuf[len_inbuf_read:]
-		self.outbuf.fromstring(cycle_out)
+		self.inbuf.consume(len_inbuf_read)
 
 	def _add_to_inbuf(self):
 		"""Make sure len(self.inbuf) >= blocksize"""
 		assert not self.infile_eof
 		while len(self.inbuf) < blocksize:
-			new_in = self.infile.read(blocksize)
- 			if not new_in:
+			if self.readinto:
+				len_in = self.readinto(self.inbuf.get_space(blocksize))
+				self.inbuf.fill(len_in)
+			else:
+				new_in = self.infile.read(blocksize)
+				len_in = len(new_in)
+				self.inbuf.add(new_in)
+			if not len_in:
 				self.infile_eof = 1
 				self.infile_closeval = self.infile.close()
 				self.infile_closed = 1
 				break
-			self.inbuf += new_in
 
 	def close(self):
 		"""Close infile and pass on infile close value"""
@@ -143,15 +252,18 @@ class DeltaFile(LikeFile):
 
 class PatchedFile(LikeFile):
 	"""File-like object which applies a librsync delta incrementally"""
-	def __init__(self, basis_file, delta_file):
+	def __init__(self, basis_file, delta_file, delta_start = ""):
 		"""PatchedFile initializer - call with basis delta
 
 		Here basis_file must be a true Python file, because we may
 		need to seek() around in it a lot, and this is done in C.
-		delta_file only needs read() and close() methods.
+		delta_file only needs read() and close() methods.  If the
+		start of the delta has already been read from delta_file, it
+		should be given as delta_start.
 
 		"""
 		LikeFile.__init__(self, delta_file)
+		if delta_start: self.inbuf.add(delta_start)
 		if hasattr(basis_file, 'file'):
 			basis_file = basis_file.file
 		if type(basis_file) is not types.FileType:
@@ -172,28 +284,374 @@ class SigGenerator:
 		try: self.sig_maker = _librsync.new_sigmaker(blocksize)
 		except _librsync.librsyncError, e: raise librsyncError(str(e))
 		self.gotsig = None
-		self.buffer = ""
-		self.sig_string = ""
+		self.inbuf = Buffer(2 * _librsync.RS_JOB_BLOCKSIZE)
+		if use_buffers: self.outbuf = bytearray(_librsync.RS_JOB_BLOCKSIZE)
+		self.sig_pieces = []
 
 	def update(self, buf):
-		"""Add buf to data that signature will be calculated over"""
+		"""Add buf to data that signature will be calculated over
+
+		Whole blocks of buf go to sig_maker directly; only a partial
+		block is copied to self.inbuf to wait for more data.
+
+		"""
 		if self.gotsig:
 			raise librsyncError("SigGenerator already provided signature")
-		self.buffer += buf
-		while len(self.buffer) >= blocksize:
-			if self.process_buffer():
+		if use_buffers: view = memoryview(buf)
+		else: view = buf
+		while len(view):
+			if not self.inbuf and len(view) >= blocksize:
+				eof, len_read = self.process_buffer(view)
+				view = view[len_read:]
+			else:
+				length = min(len(view), blocksize)
+				self.inbuf.add(view[:length])
+				view = view[length:]
+				eof = None
+				while not eof and len(self.inbuf) >= blocksize:
+					eof, len_read = self.process_buffer(self.inbuf.get_view())
+					self.inbuf.consume(len_read)
+			if eof:
 				raise librsyncError("Premature EOF received from sig_maker")
 
-	def process_buffer(self):
-		"""Run self.buffer through sig_maker, add to self.sig_string"""
-		try: eof, len_buf_read, cycle_out = self.sig_maker.cycle(self.buffer)
+	def process_buffer(self, view):
+		"""Run view through sig_maker, add output to self.sig_pieces
+
+		Returns the pair (eof, number of bytes of view used).
+
+		"""
+		try:
+			if use_buffers:
+				eof, len_read, len_out = self.sig_maker.cycle_into(view,
+																   self.outbuf)
+				sig_piece = memoryview(self.outbuf)[:len_out].tobytes()
+			else: eof, len_read, sig_piece = self.sig_maker.cycle(view)
 		except _librsync.librsyncError, e: raise librsyncError(str(e))
-		self.buffer = self.buffer[len_buf_read:]
-		self.sig_string += cycle_out
-		return eof
+		if sig_piece: self.sig_pieces.append(sig_piece)
+		return eof, len_read
 
 	def getsig(self):
 		"""Return signature over given data"""
-		while not self.process_buffer(): pass # keep running until eof
-		return self.sig_string
+		eof = None
+		while not eof: # keep running until eof
+			eof, len_read = self.process_buffer(self.inbuf.get_view())
+			self.inbuf.consume(len_read)
+		return "".join(self.sig_pieces)
+
+
+class SigTee:
+	"""File-like object which passes the data read through a SigGenerator
+
+	After the file has been read to the end, the signature of the data
+	is available from the SigGenerator's getsig().
+
+	"""
+	def __init__(self, infile, sig_gen):
+		self.infile, self.sig_gen = infile, sig_gen
+
+	def read(self, length = -1):
+		buf = self.infile.read(length)
+		self.sig_gen.update(buf)
+		return buf
+
+	def close(self): return self.infile.close()
+
+
+def get_patched_file(basis_file, delta_file):
+	"""Return file-like object applying delta_file to basis_file
+
+	This is a PatchedFile, or a ChunkedPatchedFile if delta_file holds
+	a chunked delta.
+
+	"""
+	magic = delta_file.read(len(chunked_delta_magic))
+	if magic == chunked_delta_magic:
+		return ChunkedPatchedFile(basis_file, delta_file)
+	return PatchedFile(basis_file, delta_file, magic)
+
+def get_num_chunks(file_len, chunk_size):
+	"""Return number of chunks a file of length file_len is split into"""
+	return max(1, (file_len + chunk_size - 1) // chunk_size)
+
+
+class FileChunk:
+	"""File-like object which reads at most length bytes from file
 
+	If length is None, read to the end of file.  file is only closed
+	by close() if close_file is true.
+
+	"""
+	def __init__(self, file, length = None, close_file = None):
+		self.file, self.left, self.close_file = file, length, close_file
+
+	def read(self, length = -1):
+		if self.left is not None and (length < 0 or length > self.left):
+			length = self.left
+		if not length: return ""
+		buf = self.file.read(length)
+		if self.left is not None: self.left -= len(buf)
+		return buf
+
+	def close(self):
+		if self.close_file: return self.file.close()
+
+
+class ChunkJob:
+	"""Result of running function on one chunk, see ChunkRunner"""
+	def __init__(self, function, chunk_num):
+		self.function, self.chunk_num = function, chunk_num
+		self.done = threading.Event()
+		self.result = self.exc_info = None
+
+	def run(self):
+		try: self.result = self.function(self.chunk_num)
+		except: self.exc_info = sys.exc_info()
+		self.done.set()
+
+	def get_result(self):
+		"""Wait for the result and return it, or raise the job's exception"""
+		self.done.wait()
+		if self.exc_info:
+			raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+		return self.result
+
+
+class ChunkRunner:
+	"""Run function(i) for each chunk i in worker threads
+
+	The results are returned in order, by iterating over the
+	ChunkRunner.  At most num_threads chunks are run ahead of the one
+	last returned.  If function raises an exception, it is raised
+	again when that chunk's result would be returned.
+
+	"""
+	def __init__(self, function, num_chunks, num_threads):
+		self.function, self.num_chunks = function, num_chunks
+		self.max_jobs = num_threads
+		self.next_chunk, self.jobs = 0, []
+		self.queue = Queue.Queue()
+		self.threads = []
+		for i in range(num_threads):
+			thread = threading.Thread(target = self.worker)
+			thread.setDaemon(1)
+			thread.start()
+			self.threads.append(thread)
+		self.add_jobs()
+
+	def worker(self):
+		"""Run queued jobs until given None"""
+		while 1:
+			job = self.queue.get()
+			if job is None: return
+			job.run()
+
+	def add_jobs(self):
+		"""Queue jobs for the next chunks, up to max_jobs"""
+		while (len(self.jobs) < self.max_jobs and
+			   self.next_chunk < self.num_chunks):
+			job = ChunkJob(self.function, self.next_chunk)
+			self.jobs.append(job)
+			self.queue.put(job)
+			self.next_chunk += 1
+
+	def __iter__(self): return self
+
+	def next(self):
+		if not self.jobs: raise StopIteration
+		job = self.jobs.pop(0)
+		self.add_jobs()
+		return job.get_result()
+
+	def close(self):
+		"""Stop the worker threads once they are done with queued jobs"""
+		self.next_chunk = self.num_chunks
+		for thread in self.threads: self.queue.put(None)
+
+
+class ChunkedSigFile:
+	"""File-like object which makes a librsync signature in chunks
+
+	The basis file, which is file_len bytes long, is split every
+	chunk_size bytes (rounded down to a multiple of blocksize), and
+	the chunks are signed in parallel by num_threads threads.
+	open_file() should return a new file object opened on the basis
+	file.  Since each block is summed on its own, joining the chunks'
+	signatures, without the header of all but the first, gives the
+	same signature SigFile would.
+
+	"""
+	def __init__(self, open_file, file_len, blocksize, chunk_size,
+				 num_threads):
+		self.open_file, self.blocksize = open_file, blocksize
+		self.chunk_size = max(blocksize, chunk_size - chunk_size % blocksize)
+		self.num_chunks = get_num_chunks(file_len, self.chunk_size)
+		self.runner = ChunkRunner(self.get_chunk_sig, self.num_chunks,
+								  num_threads)
+		self.buf = ""
+
+	def get_chunk_sig(self, chunk_num):
+		"""Return the signature of chunk chunk_num (run in a worker)"""
+		fp = self.open_file()
+		fp.seek(chunk_num * self.chunk_size)
+		if chunk_num == self.num_chunks - 1: length = None # read to end
+		else: length = self.chunk_size
+		sig_fp = SigFile(FileChunk(fp, length, 1), self.blocksize)
+		sig = sig_fp.read()
+		sig_fp.close()
+		if chunk_num: return sig[sig_header_length:]
+		return sig
+
+	def read(self, length = -1):
+		"""Return the next length bytes of the signature"""
+		while length < 0 or len(self.buf) < length:
+			try: self.buf += self.runner.next()
+			except StopIteration: break
+		if length < 0: result, self.buf = self.buf, ""
+		else: result, self.buf = self.buf[:length], self.buf[length:]
+		return result
+
+	def close(self): self.runner.close()
+
+
+class ChunkedDeltaFile:
+	"""File-like object which makes a chunked delta in parallel
+
+	Like DeltaFile, but the new file, which is file_len bytes long, is
+	split every chunk_size bytes, and the delta of each chunk against
+	the whole signature is made by one of num_threads threads.  Parts
+	of the basis file can be used anywhere, including across the
+	chunk boundaries.  open_new() should return a new file object
+	opened on the new file.  Finished deltas wait in temp files until
+	they are read.
+
+	The output is chunked_delta_magic, and then the librsync delta of
+	each chunk, preceded by its length as an 8 byte big-endian
+	number.  A length of 0 ends the delta.  See ChunkedPatchedFile.
+
+	If hash_file is given, it is read to the end in another thread,
+	and close() returns its close value.  This is used to hash the
+	new file, which can't be done in chunks.
+
+	"""
+	def __init__(self, signature, open_new, file_len, chunk_size,
+				 num_threads, hash_file = None):
+		if type(signature) is types.StringType: self.sig_string = signature
+		else:
+			self.sig_string = signature.read()
+			assert not signature.close()
+		self.open_new, self.chunk_size = open_new, chunk_size
+		self.num_chunks = get_num_chunks(file_len, chunk_size)
+		self.runner = ChunkRunner(self.get_chunk_delta, self.num_chunks,
+								  num_threads)
+		self.parts = self.get_parts()
+		self.part_fp = None
+		self.hash_thread = None
+		if hash_file:
+			self.hash_job = ChunkJob(lambda i: self.read_all(hash_file), 0)
+			self.hash_thread = threading.Thread(target = self.hash_job.run)
+			self.hash_thread.setDaemon(1)
+			self.hash_thread.start()
+
+	def read_all(self, file):
+		"""Read file to the end, return its close value"""
+		while file.read(blocksize): pass
+		return file.close()
+
+	def get_chunk_delta(self, chunk_num):
+		"""Write delta of chunk chunk_num to a temp file (run in a worker)
+
+		Returns the temp file, positioned at the start, and the length
+		of the delta.
+
+		"""
+		fp = self.open_new()
+		fp.seek(chunk_num * self.chunk_size)
+		if chunk_num == self.num_chunks - 1: length = None # read to end
+		else: length = self.chunk_size
+		delta_fp = DeltaFile(self.sig_string, FileChunk(fp, length, 1))
+		part_fp, part_len = tempfile.TemporaryFile(), 0
+		while 1:
+			buf = delta_fp.read(blocksize)
+			if not buf: break
+			part_fp.write(buf)
+			part_len += len(buf)
+		delta_fp.close()
+		part_fp.seek(0)
+		return part_fp, part_len
+
+	def get_parts(self):
+		"""Yield file objects holding the parts of the output in order"""
+		yield cStringIO.StringIO(chunked_delta_magic)
+		for part_fp, part_len in self.runner:
+			yield cStringIO.StringIO(struct.pack(">Q", part_len))
+			yield part_fp
+		yield cStringIO.StringIO(struct.pack(">Q", 0))
+
+	def read(self, length = -1):
+		"""Return the next length bytes of the chunked delta"""
+		pieces, size = [], 0
+		while length < 0 or size < length:
+			if not self.part_fp:
+				try: self.part_fp = self.parts.next()
+				except StopIteration: break
+			if length < 0: buf = self.part_fp.read()
+			else: buf = self.part_fp.read(length - size)
+			if not buf:
+				self.part_fp.close()
+				self.part_fp = None
+				continue
+			pieces.append(buf)
+			size += len(buf)
+		return "".join(pieces)
+
+	def close(self):
+		"""Stop making deltas, return close value of hash_file if any"""
+		self.runner.close()
+		if self.part_fp: self.part_fp.close()
+		if self.hash_thread: return self.hash_job.get_result()
+
+
+class ChunkedPatchedFile:
+	"""File-like object which applies a chunked delta (see ChunkedDeltaFile)
+
+	The chunks are patched in order, each by a PatchedFile using the
+	whole of basis_file.  delta_file should already be read past
+	chunked_delta_magic.
+
+	"""
+	def __init__(self, basis_file, delta_file):
+		self.basis_file, self.delta_file = basis_file, delta_file
+		self.part_delta = self.part = None
+		self.eof = None
+
+	def read(self, length = -1):
+		"""Return the next length bytes of the patched file"""
+		pieces, size = [], 0
+		while not self.eof and (length < 0 or size < length):
+			if not self.part:
+				self.start_part()
+				continue
+			if length < 0: buf = self.part.read()
+			else: buf = self.part.read(length - size)
+			if buf:
+				pieces.append(buf)
+				size += len(buf)
+			else:
+				self.part.close()
+				while self.part_delta.read(blocksize): pass
+				self.part = None
+		return "".join(pieces)
+
+	def start_part(self):
+		"""Read the length of the next part, and start patching it"""
+		header = self.delta_file.read(8)
+		if len(header) != 8: raise librsyncError("Chunked delta truncated")
+		part_len = struct.unpack(">Q", header)[0]
+		if not part_len: self.eof = 1
+		else:
+			self.part_delta = FileChunk(self.delta_file, part_len)
+			self.part = PatchedFile(self.basis_file, self.part_delta)
+
+	def close(self):
+		"""Close delta_file and pass on its close value"""
+		return self.delta_file.close()
@@ -52,11 +52,17 @@ File <filename>
 Where the lines are separated by newlines.  See the code below for the
 field names and values.
 
+Alternatively the metadata can be stored in a more compact binary
+format that is quicker to parse (see BinaryRorpCodec).  The format of
+each file is recognized when reading, so repositories can contain
+both.
+
 """
 
 from __future__ import generators
-import re, gzip, os, binascii, codecs
-import log, Globals, rpath, Time, robust, increment, static, rorpiter
+import re, gzip, os, binascii, codecs, bisect, struct, types
+import log, Globals, rpath, Time, robust, increment, static, rorpiter, C, \
+	   TempFile
 
 class ParsingError(Exception):
 	"""This is raised when bad or unparsable data is received"""
@@ -115,13 +121,14 @@ def RORP2Record(rorpath):
 			cfile = carbonfile2string(rorpath.get_carbonfile())
 			str_list.append("  CarbonFile %s\n" % (cfile,))
 
-		# If file is hardlinked, add that information
-		if Globals.preserve_hardlinks != 0:
-			numlinks = rorpath.getnumlinks()
-			if numlinks > 1:
-				str_list.append("  NumHardLinks %s\n" % numlinks)
-				str_list.append("  Inode %s\n" % rorpath.getinode())
-				str_list.append("  DeviceLoc %s\n" % rorpath.getdevloc())
+		# If file is hardlinked, add that information.  The inode is
+		# kept for all files so renamed ones can be found later.
+		if (Globals.preserve_hardlinks != 0 and
+			rorpath.getnumlinks() > 1):
+			str_list.append("  NumHardLinks %s\n" % rorpath.getnumlinks())
+		if rorpath.has_inode():
+			str_list.append("  Inode %s\n" % rorpath.getinode())
+			str_list.append("  DeviceLoc %s\n" % rorpath.getdevloc())
 
 		# Save any hashes, if available
 		if rorpath.has_sha1():
@@ -237,7 +244,7 @@ def unquote_path(quoted_string):
 def quoted_filename_to_index(quoted_filename):
 	"""Return tuple index given quoted filename"""
 	if quoted_filename == '.': return ()
-	else: return tuple(unquote_path(quoted_filename).split('/'))
+	else: return tuple(map(intern, unquote_path(quoted_filename).split('/')))
 
 class FlatExtractor:
 	"""Controls iterating objects from flat file"""
@@ -254,20 +261,31 @@ class FlatExtractor:
 	def __init__(self, fileobj):
 		self.fileobj = fileobj # holds file object we are reading from
 		self.buf = "" # holds the next part of the file
+		self.pos = 0 # position in self.buf of the current record
 		self.at_end = 0 # True if we are at the end of the file
-		self.blocksize = 32 * 1024
+		self.blocksize = Globals.metadata_blocksize
 
 	def get_next_pos(self):
 		"""Return position of next record in buffer, or end pos if none"""
 		while 1:
-			m = self.record_boundary_regexp.search(self.buf, 1)
+			m = self.record_boundary_regexp.search(self.buf, self.pos + 1)
 			if m: return m.start(1)
-			else: # add next block to the buffer, loop again
-				newbuf = self.fileobj.read(self.blocksize)
-				if not newbuf:
-					self.at_end = 1
-					return len(self.buf)
-				else: self.buf += newbuf
+			elif not self.read_block(): return len(self.buf)
+
+	def read_block(self):
+		"""Add next block to the buffer, return false at end of file
+
+		The part of the buffer before self.pos has already been read,
+		so it is dropped here, once per block instead of per record.
+
+		"""
+		newbuf = self.fileobj.read(self.blocksize)
+		if not newbuf:
+			self.at_end = 1
+			return None
+		self.buf = self.buf[self.pos:] + newbuf
+		self.pos = 0
+		return 1
 
 	def iterate(self):
 		"""Return iterator that yields all objects with records"""
@@ -282,10 +300,10 @@ class FlatExtractor:
 		while 1:
 			next_pos = self.get_next_pos()
 			if self.at_end:
-				if next_pos: yield self.buf[:next_pos]
+				if next_pos > self.pos: yield self.buf[self.pos:next_pos]
 				break
-			yield self.buf[:next_pos]
-			self.buf = self.buf[next_pos:]
+			yield self.buf[self.pos:next_pos]
+			self.pos = next_pos
 		assert not self.fileobj.close()
 
 	def skip_to_index(self, index):
@@ -299,17 +317,18 @@ class FlatExtractor:
 		while 1:
 			self.buf = self.fileobj.read(self.blocksize)
 			self.buf += self.fileobj.readline()
+			self.pos = 0
 			if not self.buf:
 				self.at_end = 1
 				return
 			while 1:
-				m = self.record_boundary_regexp.search(self.buf)
+				m = self.record_boundary_regexp.search(self.buf, self.pos)
 				if not m: break
 				cur_index = self.filename_to_index(m.group(2))
 				if cur_index >= index:
-					self.buf = self.buf[m.start(1):]
+					self.pos = m.start(1)
 					return
-				else: self.buf = self.buf[m.end(1):]
+				else: self.pos = m.end(1)
 
 	def iterate_starting_with(self, index):
 		"""Iterate objects whose index starts with given index"""
@@ -317,14 +336,14 @@ class FlatExtractor:
 		if self.at_end: return
 		while 1:
 			next_pos = self.get_next_pos()
-			try: obj = self.record_to_object(self.buf[:next_pos])
+			try: obj = self.record_to_object(self.buf[self.pos:next_pos])
 			except (ParsingError, ValueError), e:
 				log.Log("Error parsing metadata file: %s" % (e,), 2)
 			else:
 				if obj.index[:len(index)] != index: break
 				yield obj
 			if self.at_end: break
-			self.buf = self.buf[next_pos:]
+			self.pos = next_pos
 		assert not self.fileobj.close()
 
 	def filename_to_index(self, filename):
@@ -343,6 +362,424 @@ class RorpExtractor(FlatExtractor):
 	record_to_object = staticmethod(Record2RORP)
 	filename_to_index = staticmethod(quoted_filename_to_index)
 
+	def iterate(self):
+		"""Return iterator of rorps, parsing many records per C call
+
+		C.parse_metadata turns a buffer of whole records into RORPaths
+		in one go.  Records it can't handle are passed back as
+		strings and parsed by Record2RORP.
+
+		"""
+		if Globals.use_unicode_paths: # buffer is unicode, use old way
+			for rorp in FlatExtractor.iterate(self): yield rorp
+			return
+		while not self.at_end:
+			items = C.parse_metadata(self.get_whole_records(), rpath.RORPath)
+			for i in range(len(items)):
+				if type(items[i]) is not types.StringType:
+					yield items[i]
+					continue
+				try: yield Record2RORP(items[i])
+				except (ParsingError, ValueError), e:
+					# Ignore whitespace/bad records at end, as above
+					if self.at_end and i == len(items) - 1: break
+					log.Log("Error parsing flat file: %s" % (e,), 2)
+		assert not self.fileobj.close()
+
+	def get_whole_records(self):
+		"""Return buffer of whole records, keep rest in self.buf"""
+		while 1:
+			if not self.read_block():
+				result, self.buf, self.pos = self.buf[self.pos:], "", 0
+				return result
+			pos = self.buf.rfind("\nFile ")
+			if pos > 0:
+				self.pos = pos + 1
+				return self.buf[:self.pos]
+
+
+class TextRorpCodec:
+	"""Record codec for the default text mirror_metadata format
+
+	A record codec holds what is needed to write and read one format
+	of mirror_metadata file.  It is instantiated once per file being
+	written, because some formats keep state from record to record.
+
+	"""
+	header = "" # Every nonempty file in this format starts with this
+	extractor = RorpExtractor # FlatExtractor-like class to read records
+	text = 1 # True if records are text, and should go through MaybeUnicode
+
+	def object_to_record(self, rorp):
+		"""Return the record of rorp, as a string"""
+		return RORP2Record(rorp)
+
+	def reset(self):
+		"""Forget any state, return record that tells readers to do same
+
+		This is called at each restart point in the file, so readers
+		starting there don't need anything from earlier in the file.
+
+		"""
+		return ""
+
+
+class BinaryRorpCodec(TextRorpCodec):
+	"""Record codec for the compact binary mirror_metadata format
+
+	The file is a sequence of records, each a 4 byte big-endian length
+	followed by that many bytes.  The first byte of a record gives its
+	kind:
+
+	M - header, the rest is the format name and version
+	N - defines the next user or group name, which can be used by
+	    later records as its number.  Names are numbered from 1, and 0
+	    means no name.
+	R - reset, forget all names defined so far
+	F - file record.  This starts with the fixed width fields in
+	    file_struct and the path, followed by the optional fields
+	    given by the flags and the type specific fields, in the order
+	    object_to_record writes them.  Strings are stored as a 4 byte
+	    length and then the data.
+
+	"""
+	header_data = "Mrdiff-backup binary metadata 1"
+	header = struct.pack(">I", len(header_data)) + header_data
+	text = None
+
+	# kind, type, flags, perms, uid, gid, uname, gname, size, mtime
+	file_struct = ">cBHHqqIIqq"
+	file_struct_len = struct.calcsize(file_struct)
+	path_pos = file_struct_len + 4 # where the path data starts
+
+	type_codes = {None: 0, "reg": 1, "dir": 2, "sym": 3, "dev": 4,
+				  "fifo": 5, "sock": 6}
+	type_names = [None, "reg", "dir", "sym", "dev", "fifo", "sock"]
+
+	# Optional fields present in file record
+	HAS_MTIME, HAS_HARDLINKS, HAS_SHA1, HAS_RESOURCEFORK, HAS_CARBONFILE, \
+			   HAS_MIRRORNAME, HAS_INCNAME, HAS_INODE = \
+			   1, 2, 4, 8, 16, 32, 64, 128
+
+	def __init__(self):
+		self.names = {} # maps user/group names to their numbers
+		self.wrote_header = None
+
+	def reset(self):
+		self.names = {}
+		return self.pack_record("R")
+
+	def pack_record(self, data):
+		"""Return data prefixed by its length"""
+		return struct.pack(">I", len(data)) + data
+
+	def pack_string(self, s):
+		"""Return (possibly unicode) string s with length prefix"""
+		if type(s) is types.UnicodeType: s = s.encode('utf-8')
+		return struct.pack(">I", len(s)) + s
+
+	def get_name_num(self, name, record_list):
+		"""Return number of name, adding name record if necessary"""
+		if name is None: return 0
+		try: return self.names[name]
+		except KeyError: pass
+		num = len(self.names) + 1
+		self.names[name] = num
+		if type(name) is types.UnicodeType: name = name.encode('utf-8')
+		record_list.append(self.pack_record("N" + name))
+		return num
+
+	def object_to_record(self, rorp):
+		"""Return binary record of rorp, including any needed name records"""
+		record_list = []
+		if not self.wrote_header:
+			record_list.append(self.header)
+			self.wrote_header = 1
+		type = rorp.gettype()
+		if type is None:
+			record_list.append(self.pack_record(
+				struct.pack(self.file_struct, "F", 0, 0, 0, 0, 0, 0, 0, 0, 0) +
+				self.pack_string("/".join(rorp.index))))
+			return "".join(record_list)
+
+		flags, size, mtime, extra_list = 0, 0, 0, []
+		if type == "reg":
+			size = rorp.getsize()
+			if Globals.preserve_hardlinks != 0 and rorp.getnumlinks() > 1:
+				flags |= self.HAS_HARDLINKS
+				extra_list.append(struct.pack(">IQQ", rorp.getnumlinks(),
+									rorp.getinode(), rorp.getdevloc()))
+			elif rorp.has_inode():
+				flags |= self.HAS_INODE
+				extra_list.append(struct.pack(">QQ", rorp.getinode(),
+											  rorp.getdevloc()))
+			if rorp.has_sha1():
+				flags |= self.HAS_SHA1
+				extra_list.append(binascii.unhexlify(rorp.get_sha1()))
+			if rorp.has_resource_fork():
+				flags |= self.HAS_RESOURCEFORK
+				extra_list.append(self.pack_string(
+					rorp.get_resource_fork() or ""))
+			if rorp.has_carbonfile():
+				flags |= self.HAS_CARBONFILE
+				extra_list.append(self.pack_string(
+					carbonfile2string(rorp.get_carbonfile())))
+		elif type == "sym": extra_list.append(self.pack_string(rorp.readlink()))
+		elif type == "dev":
+			major, minor = rorp.getdevnums()
+			if rorp.isblkdev(): devchar = "b"
+			else:
+				assert rorp.ischardev()
+				devchar = "c"
+			extra_list.append(struct.pack(">cII", devchar, major, minor))
+		if type != "sym" and type != "dev":
+			flags |= self.HAS_MTIME
+			mtime = rorp.getmtime()
+		if rorp.has_alt_mirror_name():
+			flags |= self.HAS_MIRRORNAME
+			extra_list.append(self.pack_string(rorp.get_alt_mirror_name()))
+		elif rorp.has_alt_inc_name():
+			flags |= self.HAS_INCNAME
+			extra_list.append(self.pack_string(rorp.get_alt_inc_name()))
+
+		uid, gid = rorp.getuidgid()
+		unum = self.get_name_num(rorp.getuname(), record_list)
+		gnum = self.get_name_num(rorp.getgname(), record_list)
+		record_list.append(self.pack_record("".join(
+			[struct.pack(self.file_struct, "F", self.type_codes[type], flags,
+						 rorp.getperms(), uid, gid, unum, gnum, size, mtime),
+			 self.pack_string("/".join(rorp.index))] + extra_list)))
+		return "".join(record_list)
+
+
+class BinaryRorpExtractor:
+	"""Iterate rorps from a binary metadata file
+
+	Has the same interface as FlatExtractor, see BinaryRorpCodec for
+	the format.
+
+	"""
+	codec = BinaryRorpCodec
+
+	def __init__(self, fileobj):
+		self.fileobj = fileobj
+		self.buf, self.pos = "", 0
+		self.at_end = 0
+		self.blocksize = Globals.metadata_blocksize
+		self.names = [None] # name number n is self.names[n]
+
+	def get_record(self):
+		"""Return next record, without length prefix, or None if at end"""
+		while len(self.buf) - self.pos < 4:
+			if not self.read_block(): return None
+		length, = struct.unpack(">I", self.buf[self.pos:self.pos+4])
+		while len(self.buf) - self.pos < length + 4:
+			if not self.read_block():
+				raise ParsingError("Truncated record at end of file")
+		end = self.pos + 4 + length
+		record = self.buf[self.pos+4:end]
+		self.pos = end
+		return record
+
+	def read_block(self):
+		"""Add next block from file to buffer, return false at end"""
+		newbuf = self.fileobj.read(self.blocksize)
+		if not newbuf:
+			self.at_end = 1
+			return None
+		self.buf = self.buf[self.pos:] + newbuf
+		self.pos = 0
+		return 1
+
+	def iterate_records(self):
+		"""Yield all records in order"""
+		while 1:
+			record = self.get_record()
+			if record is None: break
+			yield record
+		assert not self.fileobj.close()
+
+	def iterate(self):
+		"""Return iterator that yields all objects with records"""
+		for record in self.iterate_file_records():
+			try: yield self.record_to_object(record)
+			except (ParsingError, ValueError, struct.error), e:
+				log.Log("Error parsing binary metadata: %s" % (e,), 2)
+
+	def iterate_file_records(self):
+		"""Yield file records, handling the other kinds along the way"""
+		try:
+			for record in self.iterate_records():
+				kind = record[:1]
+				if kind == "F": yield record
+				elif kind == "N": self.names.append(self.decode(record[1:]))
+				elif kind == "R": self.names = [None]
+				elif kind == "M":
+					if record[1:] != self.codec.header_data[1:]:
+						raise ParsingError("Unknown format %s" % record[1:])
+				else: raise ParsingError("Unknown record kind %s" % kind)
+		except ParsingError, e:
+			log.Log("Error reading binary metadata: %s" % (e,), 2)
+
+	def get_index(self, record):
+		"""Return index of file record"""
+		length, = struct.unpack(">I", record[self.codec.path_pos-4:
+											 self.codec.path_pos])
+		path = record[self.codec.path_pos:self.codec.path_pos+length]
+		if not path: return ()
+		return tuple(map(rpath.intern_filename, self.decode(path).split('/')))
+
+	def decode(self, s):
+		"""Return string as it would have been read in a text record"""
+		if Globals.use_unicode_paths: return unicode(s, 'utf-8')
+		return s
+
+	def get_string(self, record, pos):
+		"""Return (string, next position) of string at pos in record"""
+		length, = struct.unpack(">I", record[pos:pos+4])
+		return record[pos+4:pos+4+length], pos+4+length
+
+	def record_to_object(self, record):
+		"""Return RORPath from file record
+
+		Like Record2RORP, this writes the data dictionary directly, and
+		should leave it exactly as Record2RORP would.
+
+		"""
+		codec = self.codec
+		(kind, typecode, flags, perms, uid, gid, unum, gnum, size,
+		 mtime) = struct.unpack(codec.file_struct,
+								record[:codec.file_struct_len])
+		index = self.get_index(record)
+		type = codec.type_names[typecode]
+		if type is None: return rpath.RORPath(index, {'type': None})
+		data_dict = {'type': type, 'perms': perms, 'uid': uid, 'gid': gid,
+					 'uname': self.names[unum], 'gname': self.names[gnum]}
+		pos = codec.path_pos + struct.unpack(">I",
+							record[codec.path_pos-4:codec.path_pos])[0]
+		if flags & codec.HAS_MTIME: data_dict['mtime'] = mtime
+		if type == "reg":
+			data_dict['size'] = size
+			if flags & codec.HAS_HARDLINKS:
+				(data_dict['nlink'], data_dict['inode'],
+				 data_dict['devloc']) = struct.unpack(">IQQ",
+													  record[pos:pos+20])
+				pos += 20
+			elif flags & codec.HAS_INODE:
+				data_dict['inode'], data_dict['devloc'] = \
+						struct.unpack(">QQ", record[pos:pos+16])
+				pos += 16
+			if flags & codec.HAS_SHA1:
+				data_dict['sha1'] = binascii.hexlify(record[pos:pos+20])
+				pos += 20
+			if flags & codec.HAS_RESOURCEFORK:
+				data_dict['resourcefork'], pos = self.get_string(record, pos)
+			if flags & codec.HAS_CARBONFILE:
+				cfile, pos = self.get_string(record, pos)
+				if cfile == "None": data_dict['carbonfile'] = None
+				else: data_dict['carbonfile'] = string2carbonfile(cfile)
+		elif type == "sym":
+			linkname, pos = self.get_string(record, pos)
+			data_dict['linkname'] = self.decode(linkname)
+		elif type == "dev":
+			data_dict['devnums'] = struct.unpack(">cII", record[pos:pos+9])
+			pos += 9
+		if flags & codec.HAS_MIRRORNAME:
+			name, pos = self.get_string(record, pos)
+			data_dict['mirrorname'] = self.decode(name)
+		elif flags & codec.HAS_INCNAME:
+			name, pos = self.get_string(record, pos)
+			data_dict['incname'] = self.decode(name)
+		return rpath.RORPath(index, data_dict)
+
+	def iterate_starting_with(self, index):
+		"""Iterate objects whose index starts with given index"""
+		for record in self.iterate_file_records():
+			cur_index = self.get_index(record)
+			if cur_index < index: continue
+			if cur_index[:len(index)] != index:
+				assert not self.fileobj.close()
+				break
+			try: yield self.record_to_object(record)
+			except (ParsingError, ValueError, struct.error), e:
+				log.Log("Error parsing binary metadata: %s" % (e,), 2)
+
+BinaryRorpCodec.extractor = BinaryRorpExtractor
+
+# Maps names of mirror_metadata formats to their record codecs
+meta_codecs = {"text": TextRorpCodec, "binary": BinaryRorpCodec}
+
+
+class OffsetIndex:
+	"""Sidecar list of restart points in a compressed flat file
+
+	While a flat file is being written, the gzip stream is fully
+	flushed about every FlatFile._offsets_interval bytes of records,
+	and the index of the next record is noted along with the offset of
+	the compressed file at that point.  Decompression can begin at any
+	of these offsets, so to find a given index a reader only has to
+	inflate from the nearest preceding restart point.
+
+	The sidecar is a small text file with the format:
+
+	FlatFile <filename of flat file> <size of flat file>
+	<offset> <quoted filename>
+	...
+	End
+
+	If the first line doesn't match the flat file, or the End line is
+	missing, the sidecar is ignored and the flat file scanned as usual.
+
+	"""
+	def __init__(self):
+		self.offsets, self.indicies = [], []
+
+	def add(self, offset, index):
+		"""Add restart point, indicies should be added in order"""
+		self.offsets.append(offset)
+		self.indicies.append(index)
+
+	def lookup(self, index):
+		"""Return offset of last restart point at or before index
+
+		Returns None if there is no such restart point, meaning the
+		flat file should be read from the beginning.
+
+		"""
+		i = bisect.bisect_right(self.indicies, index)
+		if i: return self.offsets[i-1]
+		return None
+
+	def write(self, rp, flatrp):
+		"""Write the index to rp, describing flat file flatrp"""
+		fp = rpath.MaybeUnicode(rp.open("wb"))
+		fp.write("FlatFile %s %s\n" % (quote_path(flatrp.dirsplit()[1]),
+										flatrp.getsize()))
+		for offset, index in zip(self.offsets, self.indicies):
+			fp.write("%s %s\n" % (offset, quote_path("/".join(index) or ".")))
+		fp.write("End\n")
+		assert not fp.close()
+		rp.setdata()
+
+	def read(self, rp, flatrp):
+		"""Read index in rp, return true if it is valid for flatrp"""
+		fp = rpath.MaybeUnicode(rp.open("rb"))
+		lines = fp.read().split("\n")
+		assert not fp.close()
+		if (len(lines) < 3 or lines[-2] != "End" or lines[0] !=
+			"FlatFile %s %s" % (quote_path(flatrp.dirsplit()[1]),
+								flatrp.getsize())):
+			return None
+		for line in lines[1:-2]:
+			offset, filename = line.split(" ", 1)
+			self.add(long(offset), quoted_filename_to_index(filename))
+		return 1
+
+
+def get_offsets_rp(rp, offsets_prefix):
+	"""Return rp of the OffsetIndex sidecar of increment file rp"""
+	return rp.get_parent_rp().append("%s.%s.data" %
+									 (offsets_prefix, rp.inc_timestr))
 
 class FlatFile:
 	"""Manage a flat (probably text) file containing info on various files
@@ -359,6 +796,8 @@ class FlatFile:
 	_extractor = FlatExtractor # Override to class that iterates objects
 	_object_to_record = None # Set to function converting object to record
 	_prefix = None # Set to required prefix
+	# If set, write an OffsetIndex to a data file with this prefix
+	_offsets_prefix, _offsets_interval = None, 1024 * 1024
 	def __init__(self, rp_base, mode, check_path = 1, compress = 1,
 				 callback = None):
 		"""Open rp (or rp+'.gz') for reading ('r') or writing ('w')
@@ -370,41 +809,114 @@ class FlatFile:
 		self.mode = mode
 		self.callback = callback
 		self._record_buffer = []
+		self._offsets, self._offsets_pending = None, 0
+		self._use_offsets = (check_path and self._offsets_prefix and
+							 rp_base.conn is Globals.local_connection)
 		if check_path:
 			assert (rp_base.isincfile() and
 					rp_base.getincbase_str() == self._prefix), rp_base
 			compress = 1
+		self._use_threads = (compress and Globals.metadata_threads and
+							 rpath.threading and
+							 rp_base.conn is Globals.local_connection)
 		if mode == 'r':
 			self.rp = rp_base
-			self.fileobj = rpath.MaybeUnicode(self.rp.open("rb", compress))
+			self.fileobj = self.wrap_fileobj(
+				self.thread_fileobj(self.rp.open("rb", compress), mode))
 		else:
 			assert mode == 'w'
 			if compress and check_path and not rp_base.isinccompressed():
 				def callback(rp): self.rp = rp
-				self.fileobj = rpath.MaybeUnicode(rpath.MaybeGzip(rp_base,
-												callback))
+				fileobj = rpath.MaybeGzip(rp_base, callback)
 			else:
 				self.rp = rp_base
 				assert not self.rp.lstat(), self.rp
-				self.fileobj = rpath.MaybeUnicode(self.rp.open("wb", 
-												compress = compress))
+				fileobj = self.rp.open("wb", compress = compress)
+			self.fileobj = self.wrap_fileobj(self.thread_fileobj(fileobj,
+																 mode))
+			if self._use_offsets: self._offsets = OffsetIndex()
+
+	def wrap_fileobj(self, fileobj):
+		"""Return file object records are read from or written to"""
+		return rpath.MaybeUnicode(fileobj)
+
+	def thread_fileobj(self, fileobj, mode):
+		"""Move (de)compression of fileobj to another thread if possible
+
+		Then gzip can work while the main thread walks the tree or
+		compares metadata.  Only local files are done this way, as
+		connections can't be used from more than one thread.
+
+		"""
+		if not self._use_threads: return fileobj
+		if mode == 'r':
+			return rpath.ThreadedReader(fileobj, Globals.metadata_blocksize)
+		return rpath.ThreadedWriter(fileobj)
 
 	def write_record(self, record):
 		"""Write a (text) record into the file"""
+		self._offsets_pending += len(record)
 		if self._buffering_on:
 			self._record_buffer.append(record)
 			if len(self._record_buffer) >= self._max_buffer_size:
-				self.fileobj.write("".join(self._record_buffer))
-				self._record_buffer = []
+				self._flush_record_buffer()
 		else: self.fileobj.write(record)
 
+	def _flush_record_buffer(self):
+		"""Write any buffered records to the file"""
+		if self._record_buffer:
+			self.fileobj.write("".join(self._record_buffer))
+			self._record_buffer = []
+
 	def write_object(self, object):
 		"""Convert one object to record and write to file"""
+		if (self._offsets is not None and
+			self._offsets_pending >= self._offsets_interval):
+			self._add_restart_point(object.index)
 		self.write_record(self._object_to_record(object))
 
+	def _add_restart_point(self, index):
+		"""Make gzip restart point before record of index, note offset"""
+		self._flush_record_buffer()
+		offset = self.fileobj.set_restart_point()
+		if offset is not None: self._offsets.add(offset, index)
+		self.write_record(self.get_reset_record())
+		self._offsets_pending = 0
+
+	def get_reset_record(self):
+		"""Return record telling readers to forget any earlier records"""
+		return ""
+
+	def get_offsets_rp(self, rp = None):
+		"""Return rp of the OffsetIndex sidecar file for this file (or rp)"""
+		if rp is None: rp = self.rp
+		return get_offsets_rp(rp, self._offsets_prefix)
+
+	def seek_index(self, index):
+		"""Reopen fileobj at last restart point before index if possible"""
+		if not self._use_offsets or not self.rp.isinccompressed(): return
+		offsets_rp = self.get_offsets_rp()
+		if not offsets_rp.isreg(): return
+		offsets = OffsetIndex()
+		try: valid = offsets.read(offsets_rp, self.rp)
+		except (IOError, OSError, ValueError), e:
+			log.Log("Error reading offset index %s: %s" %
+					(offsets_rp.path, e), 2)
+			return
+		if not valid:
+			log.Log("Ignoring stale offset index %s" % (offsets_rp.path,), 4)
+			return
+		offset = offsets.lookup(index)
+		if offset is None: return
+		log.Log("Reading %s from offset %s" % (self.rp.path, offset), 8)
+		assert not self.fileobj.close()
+		self.fileobj = self.wrap_fileobj(self.thread_fileobj(
+			rpath.GzipRestartFile(self.rp.path, offset), 'r'))
+
 	def get_objects(self, restrict_index = None):
 		"""Return iterator of objects records from file rp"""
 		if not restrict_index: return self._extractor(self.fileobj).iterate()
+		self.seek_index(restrict_index)
 		extractor = self._extractor(self.fileobj)
 		return extractor.iterate_starting_with(restrict_index)
 
@@ -415,21 +927,88 @@ class FlatFile:
 	def close(self):
 		"""Close file, for when any writing is done"""
 		assert self.fileobj, "File already closed"
-		if self._buffering_on and self._record_buffer: 
-			self.fileobj.write("".join(self._record_buffer))
-			self._record_buffer = []
+		self._flush_record_buffer()
 		result = self.fileobj.close()
 		self.fileobj = None
 		self.rp.fsync_with_dir()
 		self.rp.setdata()
+		if self._use_offsets: self.write_offsets()
 		if self.callback: self.callback(self.rp)
 		return result
 
+	def write_offsets(self):
+		"""Write OffsetIndex sidecar, replacing any old one at this time"""
+		assert self.rp.isincfile(), self.rp # also sets self.rp.inc_timestr
+		offsets_rp = self.get_offsets_rp()
+		if offsets_rp.lstat(): offsets_rp.delete()
+		if self._offsets.offsets: self._offsets.write(offsets_rp, self.rp)
+
 class MetadataFile(FlatFile):
-	"""Store/retrieve metadata from mirror_metadata as rorps"""
+	"""Store/retrieve metadata from mirror_metadata as rorps
+
+	The file may be in any of the formats in meta_codecs.  When
+	reading, the format is found by looking at the start of the file.
+
+	"""
 	_prefix = "mirror_metadata"
+	_offsets_prefix = "metadata_offsets"
 	_extractor = RorpExtractor
 	_object_to_record = staticmethod(RORP2Record)
+	def __init__(self, rp_base, mode, check_path = 1, compress = 1,
+				 callback = None, format = "text"):
+		"""Like FlatFile.__init__, format is only used when writing"""
+		if mode == 'r':
+			format = self.get_format(rp_base, check_path or compress)
+		self.format = format
+		self.codec = meta_codecs[format]()
+		self._extractor = self.codec.extractor
+		self._object_to_record = self.codec.object_to_record
+		FlatFile.__init__(self, rp_base, mode, check_path, compress, callback)
+
+	def get_format(self, rp, compress):
+		"""Return name of format of existing metadata file rp"""
+		fp = rp.open("rb", compress)
+		start = fp.read(len(BinaryRorpCodec.header))
+		assert not fp.close()
+		for format, codec in meta_codecs.items():
+			if codec.header and start == codec.header: return format
+		return "text"
+
+	def wrap_fileobj(self, fileobj):
+		"""Binary records must not go through MaybeUnicode"""
+		if self.codec.text: return rpath.MaybeUnicode(fileobj)
+		return fileobj
+
+	def get_reset_record(self):
+		return self.codec.reset()
+
+
+class TempMetadataFile(MetadataFile):
+	"""MetadataFile written to a temp file and renamed to rp on closing
+
+	This way an interruption never leaves a partly written file at rp.
+	The OffsetIndex, if the file is compressed, is written after the
+	rename.
+
+	"""
+	def __init__(self, rp, format):
+		assert rp.isincfile() and rp.getincbase_str() == self._prefix, rp
+		self.final_rp = rp
+		MetadataFile.__init__(self, TempFile.new_in_dir(rp.get_parent_rp()),
+							  'w', check_path = 0,
+							  compress = rp.isinccompressed(), format = format)
+		if rp.isinccompressed(): self._offsets = OffsetIndex()
+
+	def close(self):
+		"""Close temp file and rename it, replacing any old file at rp"""
+		result = MetadataFile.close(self)
+		offsets_rp = self.get_offsets_rp(self.final_rp)
+		if offsets_rp.lstat(): offsets_rp.delete()
+		rpath.rename(self.rp, self.final_rp)
+		self.final_rp.setdata()
+		if self._offsets and self._offsets.offsets:
+			self._offsets.write(offsets_rp, self.final_rp)
+		return result
 
 
 class CombinedWriter:
@@ -470,7 +1049,38 @@ class Manager:
 		for filename in Globals.rbdir.listdir():
 			rp = Globals.rbdir.append(filename)
 			if rp.isincfile(): self.add_incrp(rp)
-				
+		self.set_meta_format()
+
+	def set_meta_format(self):
+		"""Set self.meta_format, the format new mirror_metadata is written in
+
+		The format is recorded in the metadata_format file in the
+		rdiff-backup-data directory, and defaults to text.
+		Globals.metadata_format overrides the recorded format, and is
+		recorded itself the next time metadata is written.
+
+		"""
+		format_rp = Globals.rbdir.append("metadata_format")
+		if format_rp.lstat():
+			self.recorded_meta_format = format_rp.get_data().strip()
+		else: self.recorded_meta_format = "text"
+		self.meta_format = (Globals.metadata_format or
+							self.recorded_meta_format)
+		if not meta_codecs.has_key(self.meta_format):
+			log.Log.FatalError("Unknown metadata format %s" %
+							   (self.meta_format,))
+
+	def record_meta_format(self):
+		"""Write self.meta_format to the metadata_format file if needed"""
+		if self.meta_format == self.recorded_meta_format: return
+		format_rp = Globals.rbdir.append("metadata_format")
+		log.Log("Writing metadata format %s to %s" %
+				(self.meta_format, format_rp.path), 4)
+		if format_rp.lstat(): format_rp.delete()
+		format_rp.write_string(self.meta_format + "\n")
+		format_rp.fsync_with_dir()
+		self.recorded_meta_format = self.meta_format
+
 	def add_incrp(self, rp):
 		"""Add rp to list of inc rps in the rbdir"""
 		assert rp.isincfile(), rp
@@ -542,7 +1152,7 @@ class Manager:
 
 		return cur_iter
 
-	def _writer_helper(self, prefix, flatfileclass, typestr, time):
+	def _writer_helper(self, prefix, flatfileclass, typestr, time, **kwargs):
 		"""Used in the get_xx_writer functions, returns a writer class"""
 		if time is None: timestr = Time.curtimestr
 		else: timestr = Time.timetostring(time)		
@@ -550,12 +1160,13 @@ class Manager:
 		rp = Globals.rbdir.append(filename)
 		assert not rp.lstat(), "File %s already exists!" % (rp.path,)
 		assert rp.isincfile()
-		return flatfileclass(rp, 'w', callback = self.add_incrp)
+		return flatfileclass(rp, 'w', callback = self.add_incrp, **kwargs)
 
 	def get_meta_writer(self, typestr, time):
 		"""Return MetadataFile object opened for writing at given time"""
+		self.record_meta_format()
 		return self._writer_helper(self.meta_prefix, MetadataFile,
-								   typestr, time)
+								   typestr, time, format = self.meta_format)
 
 	def get_ea_writer(self, typestr, time):
 		"""Return ExtendedAttributesFile opened for writing"""
@@ -605,6 +1216,7 @@ class PatchDiffMan(Manager):
 
 	"""
 	max_diff_chain = 9 # After this many diffs, make a new snapshot
+	meta_diff = None # (diff writer, old snapshot rp) set by open_meta_diff
 
 	def get_diffiter(self, new_iter, old_iter):
 		"""Iterate meta diffs of new_iter -> old_iter"""
@@ -637,8 +1249,53 @@ class PatchDiffMan(Manager):
 		if chainlen >= self.max_diff_chain: return (None, None)
 		return (newrp, oldrp)
 
+	def open_meta_diff(self, time):
+		"""Start writing the diff which will replace the snapshot at time
+
+		This is called when backing up, if the old metadata comes from
+		the latest snapshot, at the previous backup time.  The backup
+		then passes each pair of new and old rorps to write_meta_diff
+		while the new snapshot is written, and ConvertMetaToDiff only
+		has to close the diff and delete the old snapshot, instead of
+		reading both snapshots again.
+
+		"""
+		inclist = self.sorted_prefix_inclist(self.meta_prefix)
+		if (not inclist or inclist[0].getinctime() != time or
+			inclist[0].getinctype() != 'snapshot'): return
+		chainlen = 1
+		for rp in inclist[1:]:
+			if rp.getinctype() != 'diff': break
+			chainlen += 1
+		if chainlen >= self.max_diff_chain: return
+		self.meta_diff = (self.get_meta_writer('diff', time), inclist[0])
+
+	def write_meta_diff(self, new_rorp, old_rorp):
+		"""Add the diff record for one index, see open_meta_diff
+
+		new_rorp was written to the new snapshot and old_rorp read from
+		the old one; either may be None.  Like get_diffiter, but
+		records are compared because the old rorps may have ea/acl
+		information joined to them.
+
+		"""
+		if not self.meta_diff: return
+		if old_rorp and not old_rorp.lstat(): old_rorp = None
+		if not old_rorp:
+			if new_rorp:
+				self.meta_diff[0].write_object(rpath.RORPath(new_rorp.index))
+		elif not new_rorp or RORP2Record(new_rorp) != RORP2Record(old_rorp):
+			self.meta_diff[0].write_object(old_rorp)
+
 	def ConvertMetaToDiff(self):
 		"""Replace a mirror snapshot with a diff if it's appropriate"""
+		if self.meta_diff:
+			diff_writer, oldrp = self.meta_diff
+			self.meta_diff = None
+			log.Log("Finishing mirror_metadata diff", 6)
+			self.replace_snapshot(oldrp, diff_writer)
+			return
+
 		newrp, oldrp = self.check_needs_diff()
 		if not newrp: return
 		log.Log("Writing mirror_metadata diff", 6)
@@ -648,16 +1305,40 @@ class PatchDiffMan(Manager):
 		old_iter = MetadataFile(oldrp, 'r').get_objects()
 		for diff_rorp in self.get_diffiter(new_iter, old_iter):
 			diff_writer.write_object(diff_rorp)
+		self.replace_snapshot(oldrp, diff_writer)
+
+	def replace_snapshot(self, oldrp, diff_writer):
+		"""Close diff_writer, then delete snapshot oldrp and its offsets
+
+		The diff may write an OffsetIndex sidecar of its own, with the
+		same name as the snapshot's, so the old one is deleted first.
+
+		"""
+		assert oldrp.isincfile(), oldrp # also sets oldrp.inc_timestr
+		offsets_rp = get_offsets_rp(oldrp, MetadataFile._offsets_prefix)
+		if offsets_rp.lstat(): offsets_rp.delete()
 		diff_writer.close() # includes sync
 		oldrp.delete()
 
 	def get_meta_at_time(self, time, restrict_index):
-		"""Get metadata rorp iter, possibly by patching with diffs"""
+		"""Get metadata rorp iter, possibly by patching with diffs
+
+		Patched metadata is read from, or else saved to, the
+		MetadataCache.  Only complete (unrestricted) iters are saved.
+
+		"""
+		inclist = self.relevant_meta_incs(time)
+		if len(inclist) > 1:
+			cache = MetadataCache(self)
+			cached_iter = cache.get_objects(inclist[-1], restrict_index)
+			if cached_iter: return cached_iter
 		meta_iters = [MetadataFile(rp, 'r').get_objects(restrict_index)
-					  for rp in self.relevant_meta_incs(time)]
+					  for rp in inclist]
 		if not meta_iters: return None
 		if len(meta_iters) == 1: return meta_iters[0]
-		return self.iterate_patched_meta(meta_iters)
+		patched_iter = self.iterate_patched_meta(meta_iters)
+		if restrict_index: return patched_iter
+		return cache.write_through(inclist, patched_iter)
 
 	def relevant_meta_incs(self, time):
 		"""Return list [snapshotrp, diffrps ...] time sorted"""
@@ -684,6 +1365,130 @@ class PatchDiffMan(Manager):
 					break # move to next index
 			else: assert 0, "No valid rorps"
 
+class MetadataCache:
+	"""Cache of metadata snapshots made by patching diffs
+
+	Reading the metadata at an older time can mean collating and
+	patching up to PatchDiffMan.max_diff_chain files.  The result is
+	saved as an ordinary mirror_metadata snapshot in the metadata_cache
+	directory of rdiff-backup-data, so later restores, compares, and
+	listings at that time only read one file.
+
+	The entries are named like increments, so remove-older-than
+	deletes the ones of removed sessions along with the rest.  If the
+	entries take up more than Globals.metadata_cache_size bytes, the
+	least recently used are deleted.
+
+	"""
+	def __init__(self, manager):
+		self.manager = manager
+		self.dirrp = Globals.rbdir.append("metadata_cache")
+
+	def get_cache_rp(self, inc_rp):
+		"""Return rp of cache entry for metadata at time of inc_rp"""
+		return self.dirrp.append("%s.%s.snapshot.gz" %
+								 (self.manager.meta_prefix, inc_rp.inc_timestr))
+
+	def is_writable(self):
+		"""True if we may write to the cache"""
+		return (Globals.metadata_cache_size > 0 and
+				Globals.security_level != "read-only" and
+				self.dirrp.conn is Globals.local_connection)
+
+	def get_objects(self, inc_rp, restrict_index):
+		"""Return iter of cached metadata at time of inc_rp, or None"""
+		rp = self.get_cache_rp(inc_rp)
+		if not rp.isreg(): return None
+		log.Log("Reading metadata from cache file %s" % (rp.path,), 5)
+		if self.is_writable():
+			try: os.utime(rp.path, None) # mark as recently used
+			except (IOError, OSError): pass
+		return MetadataFile(rp, 'r').get_objects(restrict_index)
+
+	def write_through(self, inclist, rorp_iter):
+		"""Yield rorps from rorp_iter, saving them as a new entry
+
+		inclist is the list of files rorp_iter was made from, with the
+		snapshot first.  If something goes wrong writing the entry,
+		it is dropped, but rorp_iter is still passed through.
+
+		"""
+		writer = self.get_writer(inclist)
+		for rorp in rorp_iter:
+			if writer:
+				try: writer.write_object(rorp)
+				except (IOError, OSError), exc:
+					writer = self.discard(writer, exc)
+			yield rorp
+		if not writer: return
+		try: writer.close()
+		except (IOError, OSError), exc: self.discard(writer, exc)
+		else: self.prune()
+
+	def get_writer(self, inclist):
+		"""Return TempMetadataFile for the new entry, or None"""
+		if (not self.is_writable() or
+			inclist[0].getsize() > Globals.metadata_cache_size): return None
+		try:
+			if not self.dirrp.isdir(): self.dirrp.mkdir()
+			return TempMetadataFile(self.get_cache_rp(inclist[-1]),
+									self.manager.meta_format)
+		except (IOError, OSError), exc:
+			log.Log("Unable to write metadata cache file: %s" % (exc,), 3)
+			return None
+
+	def discard(self, writer, exc):
+		"""Log exc, delete the temp file of writer, return None"""
+		log.Log("Error writing metadata cache file %s: %s" %
+				(writer.final_rp.path, exc), 2)
+		if writer.fileobj:
+			try: writer.fileobj.close()
+			except (IOError, OSError): pass
+		writer.rp.setdata()
+		if writer.rp.lstat(): writer.rp.delete()
+		return None
+
+	def prune(self):
+		"""Delete least recently used entries until under the size limit
+
+		The files of an entry share its time string.  Anything else
+		in the directory is a temp file left by an interrupted write.
+
+		"""
+		def get_entry_key(rp):
+			if rp.isincfile(): return rp.inc_timestr
+			return None
+		robust.prune_lru_dir(self.dirrp, Globals.metadata_cache_size,
+							 get_entry_key, "metadata cache")
+
+
+def ConvertFormat(format):
+	"""Rewrite all mirror_metadata files in rbdir in the given format
+
+	Each file is written to a temp file which is then renamed over the
+	original, so an interruption leaves every file in either its old
+	or new format, both readable.  The format is also recorded as the
+	repository's setting, so later backups keep using it.
+
+	"""
+	assert Globals.rbdir.conn is Globals.local_connection
+	if not meta_codecs.has_key(format):
+		log.Log.FatalError("Unknown metadata format %s" % (format,))
+	manager = SetManager()
+	manager.meta_format = format
+	manager.record_meta_format()
+	for rp in manager.sorted_prefix_inclist(manager.meta_prefix):
+		old_file = MetadataFile(rp, 'r')
+		if old_file.format == format or not rp.getsize():
+			log.Log("Not converting %s" % (rp.path,), 5)
+			assert not old_file.fileobj.close()
+			continue
+		log.Log("Converting %s to %s format" % (rp.path, format), 4)
+		writer = TempMetadataFile(rp, format)
+		for rorp in old_file.get_objects(): writer.write_object(rorp)
+		writer.close()
+	if Globals.fsync_directories: Globals.rbdir.fsync()
+
 ManagerObj = None # Set this later to Manager instance
 def SetManager():
 	global ManagerObj
@@ -143,7 +143,8 @@ def recreate_meta(meta_manager):
 	"""
 	temprp = [TempFile.new_in_dir(Globals.rbdir)]
 	def callback(rp): temprp[0] = rp
-	writer = metadata.MetadataFile(temprp[0], 'w', check_path = 0, callback = callback)
+	writer = metadata.MetadataFile(temprp[0], 'w', check_path = 0,
+						callback = callback, format = meta_manager.meta_format)
 	for rorp in meta_manager.get_meta_at_time(regress_time, None):
 		writer.write_object(rorp)
 	writer.close()
@@ -287,7 +288,8 @@ class RegressITRB(rorpiter.ITRBranch):
 		assert rf.metadata_rorp.isreg()
 		if rf.mirror_rp.isreg():
 			tf = TempFile.new(rf.mirror_rp)
-			tf.write_from_fileobj(rf.get_restore_fp())
+			tf.write_from_fileobj(rf.get_restore_fp(),
+								  sparse = rpath.has_holes(rf.mirror_rp))
 			tf.fsync_with_dir() # make sure tf fully written before move
 			rpath.copy_attribs(rf.metadata_rorp, tf)
 			rpath.rename(tf, rf.mirror_rp) # move is atomic
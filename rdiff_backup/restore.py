@@ -259,6 +259,8 @@ class MirrorStruct:
 			expanded_index = cls.mirror_base.index + mir_rorp.index
 			file_fp = cls.rf_cache.get_fp(expanded_index, mir_rorp)
 			mir_rorp.setfile(hash.FileWrapper(file_fp))
+			if rpath.has_holes(cls.mirror_base.new_index(expanded_index)):
+				mir_rorp.set_sparse()
 		mir_rorp.set_attached_filetype('snapshot')
 		return mir_rorp
 
@@ -495,7 +497,7 @@ rdiff-backup destination directory, or a bug in rdiff-backup""" %
 
 		# current_fp must be a real (uncompressed) file
 		current_fp = tempfile.TemporaryFile()
-		fp = first_inc.open("rb", compress = 1)
+		fp = first_inc.open("rb", first_inc.isinccompressed())
 		rpath.copyfileobj(fp, current_fp)
 		assert not fp.close()
 		current_fp.seek(0)
@@ -524,8 +526,8 @@ rdiff-backup destination directory, or a bug in rdiff-backup""" %
 	def yield_mirrorrps(self, mirrorrp):
 		"""Yield mirrorrps underneath given mirrorrp"""
 		assert mirrorrp.isdir()
-		for filename in robust.listrp(mirrorrp):
-			rp = mirrorrp.append(filename)
+		for filename, data in robust.listrp_data(mirrorrp):
+			rp = mirrorrp.append_with_data(filename, data)
 			if rp.index != ('rdiff-backup-data',): yield rp
 
 	def yield_inc_complexes(self, inc_rpath):
@@ -538,37 +540,34 @@ rdiff-backup destination directory, or a bug in rdiff-backup""" %
 		if not inc_rpath.isdir(): return
 
 		def get_inc_pairs():
-			"""Return unsorted list of (basename, inc_filenames) pairs"""
-			inc_dict = {} # dictionary of basenames:inc_filenames
-			dirlist = robust.listrp(inc_rpath)
+			"""Return unsorted list of (basename, inc_rps) pairs"""
+			inc_dict = {} # dictionary of basenames:inc_rps
+			other_dict = {} # dictionary of filenames:rps of non-increments
 
-			def add_to_dict(filename):
+			def add_to_dict(filename, data):
 				"""Add filename to the inc tuple dictionary"""
-				rp = inc_rpath.append(filename)
+				rp = inc_rpath.append_with_data(filename, data)
 				if rp.isincfile() and rp.getinctype() != 'data':
 					basename = rp.getincbase_str()
-					inc_filename_list = inc_dict.setdefault(basename, [])
-					inc_filename_list.append(filename)
-				elif rp.isdir(): inc_dict.setdefault(filename, [])
-
-			for filename in dirlist: add_to_dict(filename)
-			return inc_dict.items()
-
-		def inc_filenames2incrps(filenames):
-			"""Map list of filenames into increment rps"""
-			l = []
-			for filename in filenames:
-				rp = inc_rpath.append(filename)
-				assert rp.isincfile(), rp.path
-				l.append(rp)
-			return l
-
-		items = get_inc_pairs()
+					inc_rp_list = inc_dict.setdefault(basename, [])
+					inc_rp_list.append(rp)
+				else:
+					if rp.isdir(): inc_dict.setdefault(filename, [])
+					other_dict[filename] = rp
+
+			for filename, data in robust.listrp_data(inc_rpath):
+				add_to_dict(filename, data)
+			return inc_dict.items(), other_dict
+
+		items, other_dict = get_inc_pairs()
 		items.sort() # Sorting on basis of basename now
-		for (basename, inc_filenames) in items:
-			sub_inc_rpath = inc_rpath.append(basename)
+		for (basename, inc_rps) in items:
+			# The listing shows whether the prefix exists, no need to stat
+			try: sub_inc_rpath = other_dict[basename]
+			except KeyError: sub_inc_rpath = inc_rpath.new_index_empty(
+										inc_rpath.index + (basename,))
 			yield rorpiter.IndexedTuple(sub_inc_rpath.index,
-					  (sub_inc_rpath, inc_filenames2incrps(inc_filenames)))
+										(sub_inc_rpath, inc_rps))
 
 
 class PatchITRB(rorpiter.ITRBranch):
@@ -19,7 +19,7 @@
 
 """Catch various exceptions given system call"""
 
-import errno, signal, exceptions, zlib
+import errno, signal, exceptions, zlib, itertools
 import librsync, C, static, rpath, Globals, log, statistics, connection
 
 def check_common_error(error_handler, function, args = []):
@@ -101,6 +101,62 @@ def listrp(rp):
 	dir_listing.sort()
 	return dir_listing
 
+def listrp_iter(rp):
+	"""Like listrp but may return an iterator, see rpath.listdir_sorted"""
+	def error_handler(exc, rp):
+		log.Log("Error listing directory %s" % rp.path, 2)
+		return []
+	return check_common_error(error_handler, rpath.listdir_sorted, (rp,))
+
+def listrp_data(rp):
+	"""Like listrp_iter but return (filename, data) pairs
+
+	data is the file's data dictionary if rpath.scan_dir read it while
+	listing, and None otherwise (see RPath.append_with_data).
+
+	"""
+	def error_handler(exc, rp):
+		log.Log("Error listing directory %s" % rp.path, 2)
+		return []
+	listing = check_common_error(error_handler, rpath.scan_dir, (rp,))
+	if listing is not None: return listing
+	return itertools.imap(lambda filename: (filename, None), listrp_iter(rp))
+
+def prune_lru_dir(dir_rp, max_size, get_entry_key, name):
+	"""Delete least recently used entries of cache dir_rp over max_size
+
+	get_entry_key(rp) returns the key of the cache entry a regular
+	file belongs to, or None if it is a temp file left by an
+	interrupted write, which is deleted.  The files of an entry are
+	deleted together, in order of their latest mtime, until the
+	directory holds at most max_size bytes.  name describes the cache
+	in log messages.
+
+	"""
+	entries, total_size = {}, 0
+	for filename, data in listrp_data(dir_rp):
+		rp = dir_rp.append_with_data(filename, data)
+		if rp.isreg(): key = get_entry_key(rp)
+		else: key = None
+		if key is None:
+			log.Log("Deleting stray %s file %s" % (name, rp.path), 5)
+			rp.delete()
+			continue
+		total_size += rp.getsize()
+		if entries.has_key(key): entries[key].append(rp)
+		else: entries[key] = [rp]
+
+	lru_list = []
+	for rps in entries.values():
+		lru_list.append((max([rp.getmtime() for rp in rps]), rps))
+	lru_list.sort()
+	for mtime, rps in lru_list:
+		if total_size <= max_size: break
+		for rp in rps:
+			log.Log("Deleting %s file %s" % (name, rp.path), 6)
+			total_size -= rp.getsize()
+			rp.delete()
+
 def signal_handler(signum, frame):
 	"""This is called when signal signum is caught"""
 	raise SignalException(signum)
@@ -35,8 +35,17 @@ are dealing with are local or remote.
 
 """
 
-import os, stat, re, sys, shutil, gzip, socket, time, errno, codecs
-import Globals, Time, static, log, user_group, C
+import os, stat, re, sys, shutil, gzip, socket, time, errno, codecs, zlib, \
+	   types, bisect, tempfile, itertools
+import Globals, Time, static, log, user_group, hash, C
+try: import threading, Queue
+except ImportError: threading = None
+try: import bz2
+except ImportError: bz2 = None
+try: import lzma
+except ImportError:
+	try: from backports import lzma
+	except ImportError: lzma = None
 
 try:
 	import win32file, winnt
@@ -55,14 +64,236 @@ class SkipFileException(Exception):
 
 class RPathException(Exception): pass
 
-def copyfileobj(inputfp, outputfp):
-	"""Copies file inputfp to outputfp in blocksize intervals"""
+def copyfileobj(inputfp, outputfp, sparse = None):
+	"""Copies file inputfp to outputfp in blocksize intervals
+
+	If both are plain local files, the kernel copies the data instead,
+	see copy_fd_local.  Local copies of files with holes are written
+	sparsely, see copy_sparse.  If sparse is true, pages of zeros are
+	skipped in a local outputfp whatever inputfp is, as when a file
+	with holes is patched or sent over the connection.
+
+	"""
+	if Globals.kernel_copy and copy_fd_local(inputfp, outputfp): return
+	if Globals.sparse_files and type(outputfp) is types.FileType:
+		if copy_sparse(inputfp, outputfp): return
+		if sparse: return copy_zeros_sparse(inputfp, outputfp)
 	blocksize = Globals.blocksize
 	while 1:
 		inbuf = inputfp.read(blocksize)
 		if not inbuf: break
 		outputfp.write(inbuf)
 
+def copy_fd_local(inputfp, outputfp):
+	"""Copy the rest of inputfp to outputfp in the kernel if possible
+
+	Returns true if the data was copied, or false if the caller should
+	copy it.  Both must be python file objects, and no data may be left
+	in inputfp's read buffer.  C.copy_fd then copies the data with
+	copy_file_range or sendfile, so it doesn't go through python.
+
+	inputfp may also be a hash.FileWrapper around such a file, see
+	copy_fd_hashing.  Files with holes are left to copy_sparse when
+	Globals.sparse_files is set, because the kernel may fill them in.
+
+	"""
+	hash_fp = None
+	if isinstance(inputfp, hash.FileWrapper):
+		hash_fp, inputfp = inputfp, inputfp.fileobj
+	if type(outputfp) is not types.FileType: return 0
+	start = get_fd_offset(inputfp)
+	if start is None: return 0
+	if Globals.sparse_files and get_holes(inputfp.fileno(), start, 1):
+		return 0
+	outputfp.flush()
+	if hash_fp: return copy_fd_hashing(hash_fp, outputfp, start)
+	return copy_fd_rest(inputfp, outputfp, start)
+
+def copy_fd_rest(inputfp, outputfp, start):
+	"""Copy inputfp, at offset start, to outputfp with C.copy_fd
+
+	Returns false if the kernel can't copy these files.  The kernel
+	may also stop early, as it does for some files in /proc, /sys or
+	on FUSE filesystems, so unless C.copy_fd copied as much as fstat
+	says is left, the rest is copied in python.  Both file objects are
+	left at the end of the data.
+
+	"""
+	in_fd, out_fd = inputfp.fileno(), outputfp.fileno()
+	try: copied = C.copy_fd(in_fd, out_fd)
+	except NotImplementedError: return 0
+	# Bring the python file objects up to date with the descriptors
+	inputfp.seek(os.lseek(in_fd, 0, os.SEEK_CUR))
+	outputfp.seek(os.lseek(out_fd, 0, os.SEEK_CUR))
+	if copied == 0 or start + copied != os.fstat(in_fd)[stat.ST_SIZE]:
+		while 1:
+			inbuf = inputfp.read(Globals.blocksize)
+			if not inbuf: break
+			outputfp.write(inbuf)
+	return 1
+
+def copy_fd_hashing(hash_fp, outputfp, start):
+	"""Copy hash.FileWrapper's file from offset start, hash the copy
+
+	The SHA1 has to be of the data actually written, which reading the
+	source again wouldn't give if it changed during the copy.  So
+	after copy_fd_rest, the new data is read back from outputfp's
+	file, usually from the page cache, into hash_fp's digest.  Returns
+	false without copying if that file can't be opened by name, or
+	the kernel can't copy these files.
+
+	"""
+	out_fd = outputfp.fileno()
+	try: read_fd = os.open(outputfp.name, os.O_RDONLY)
+	except (OSError, TypeError): return 0
+	try:
+		out_stat, read_stat = os.fstat(out_fd), os.fstat(read_fd)
+		if (out_stat[stat.ST_INO] != read_stat[stat.ST_INO] or
+			out_stat[stat.ST_DEV] != read_stat[stat.ST_DEV]): return 0
+		out_start = os.lseek(out_fd, 0, os.SEEK_CUR)
+		if not copy_fd_rest(hash_fp.fileobj, outputfp, start): return 0
+		outputfp.flush()
+		os.lseek(read_fd, out_start, os.SEEK_SET)
+		while 1:
+			buf = os.read(read_fd, Globals.blocksize)
+			if not buf: break
+			hash_fp.sha1.update(buf)
+	finally: os.close(read_fd)
+	return 1
+
+def get_fd_offset(fp):
+	"""Return offset of fp's descriptor, or None if it can't be used
+
+	fp must be a python file object, not a pipe, with no data in its
+	read buffer, so the data from the offset on can be read from the
+	descriptor directly.
+
+	"""
+	if type(fp) is not types.FileType: return None
+	try: offset = fp.tell()
+	except IOError: return None # a pipe, for instance
+	if os.lseek(fp.fileno(), 0, os.SEEK_CUR) != offset: return None
+	return offset
+
+# lseek whence values to find data and holes in files, where supported
+if sys.platform.startswith("linux") or sys.platform.startswith("freebsd") \
+   or sys.platform.startswith("sunos"):
+	SEEK_DATA, SEEK_HOLE = 3, 4
+else: SEEK_DATA = SEEK_HOLE = None
+
+def get_holes(fd, start = 0, max_holes = None):
+	"""Return list of (offset, length) pairs of the holes in file fd
+
+	Only the part of the file from offset start is looked at, and at
+	most max_holes holes are returned.  The list is empty if the file
+	has no holes or the system can't find them with SEEK_HOLE.  The
+	offset of fd is restored.
+
+	"""
+	if SEEK_HOLE is None: return []
+	holes = []
+	size = os.fstat(fd)[stat.ST_SIZE]
+	offset = start
+	try:
+		while offset < size and (max_holes is None or
+								 len(holes) < max_holes):
+			hole = os.lseek(fd, offset, SEEK_HOLE)
+			if hole >= size: break
+			try: offset = os.lseek(fd, hole, SEEK_DATA)
+			except OSError, exc:
+				if exc.errno != errno.ENXIO: raise
+				offset = size # the file ends in a hole
+			holes.append((hole, offset - hole))
+	except OSError, exc:
+		if exc.errno not in (errno.EINVAL, errno.ENXIO): raise
+		holes = [] # SEEK_HOLE not supported here
+	os.lseek(fd, start, os.SEEK_SET)
+	return holes
+
+def copy_sparse(inputfp, outputfp):
+	"""Copy inputfp to the local file outputfp if it has holes
+
+	Like cp --sparse=auto, this only happens if inputfp is a plain
+	local file, or a hash.FileWrapper around one, and get_holes finds
+	holes in it.  Those are skipped, without reading them unless the
+	data is hashed, and other blocks of zeros aren't written either.
+	Returns false without copying anything otherwise, so fully
+	allocated files, like preallocated database images, stay so.
+
+	"""
+	if isinstance(inputfp, hash.FileWrapper): fp = inputfp.fileobj
+	else: fp = inputfp
+	start = get_fd_offset(fp)
+	if start is None: return 0
+	holes = get_holes(fp.fileno(), start)
+	if not holes: return 0
+	if fp is not inputfp: holes = [] # read zeros to hash them
+
+	blocksize = Globals.blocksize
+	skipped = 0
+	for hole_start, hole_length in holes + [(None, None)]:
+		if hole_start is None: left = None # copy to the end
+		else: left = hole_start - inputfp.tell()
+		while left is None or left > 0:
+			if left is None: inbuf = inputfp.read(blocksize)
+			else: inbuf = inputfp.read(min(left, blocksize))
+			if not inbuf: break
+			if left is not None: left -= len(inbuf)
+			skipped = write_sparse(outputfp, inbuf) or skipped
+		if hole_start is not None:
+			inputfp.seek(hole_start + hole_length)
+			outputfp.seek(hole_length, os.SEEK_CUR)
+			skipped = 1
+	if skipped: outputfp.truncate() # set size if it ends in a hole
+	return 1
+
+def copy_zeros_sparse(inputfp, outputfp):
+	"""Copy inputfp to the local file outputfp, skipping pages of zeros"""
+	skipped = 0
+	while 1:
+		inbuf = inputfp.read(Globals.blocksize)
+		if not inbuf: break
+		skipped = write_sparse(outputfp, inbuf) or skipped
+	if skipped: outputfp.truncate() # set size if it ends in a hole
+
+def has_holes(rp):
+	"""True if rp is a local regular file with holes, see get_holes
+
+	Copies and patches of such files are written sparsely even when
+	the data doesn't come from the file itself.  Always false if
+	Globals.sparse_files isn't set.
+
+	"""
+	if (not Globals.sparse_files or rp.conn is not Globals.local_connection
+		or not rp.isreg()): return 0
+	try: fd = os.open(rp.path, os.O_RDONLY)
+	except OSError: return 0
+	try: return len(get_holes(fd, 0, 1))
+	finally: os.close(fd)
+
+def write_sparse(outputfp, buf, pagesize = 4096):
+	"""Write buf to outputfp, seeking over pages of zeros
+
+	Returns true if anything was skipped.  Pages are counted from the
+	start of buf, which is aligned when it is read in blocks.
+
+	"""
+	zeros = buf.count("\0")
+	if zeros == len(buf):
+		outputfp.seek(len(buf), os.SEEK_CUR)
+		return 1
+	if zeros < pagesize:
+		outputfp.write(buf)
+		return 0
+	skipped = 0
+	for i in range(0, len(buf), pagesize):
+		page = buf[i:i + pagesize]
+		if page.count("\0") == len(page):
+			outputfp.seek(len(page), os.SEEK_CUR)
+			skipped = 1
+		else: outputfp.write(page)
+	return skipped
+
 def cmpfileobj(fp1, fp2):
 	"""True if file objects fp1 and fp2 contain same data"""
 	blocksize = Globals.blocksize
@@ -130,7 +361,8 @@ def copy_reg_file(rpin, rpout, compress = 0):
 			return v
 	except AttributeError: pass
 	try:
-		return rpout.write_from_fileobj(rpin.open("rb"), compress = compress)
+		return rpout.write_from_fileobj(rpin.open("rb"), compress = compress,
+										sparse = rpin.issparse())
 	except IOError, e:
 		if (e.errno == errno.ERANGE):
 			log.Log.FatalError("'IOError - Result too large' while reading %s. "
@@ -243,6 +475,38 @@ def copy_with_attribs(rpin, rpout, compress = 0):
 	copy(rpin, rpout, compress)
 	if rpin.lstat(): copy_attribs(rpin, rpout)
 
+def sync_files(rps):
+	"""Make the local files in rps, and their directory entries, durable
+
+	Where C.syncfs works this is one syncfs() per filesystem, which is
+	much cheaper than an fsync of every file and directory when there
+	are many of them.  Otherwise each file and each of their
+	directories is fsync'd once.
+
+	"""
+	dir_rps = {}
+	for rp in rps:
+		assert rp.conn is Globals.local_connection
+		dirname = rp.dirsplit()[0]
+		if not dir_rps.has_key(dirname):
+			dir_rps[dirname] = rp.get_parent_rp()
+	try: syncfs_dirs(dir_rps.values())
+	except (NotImplementedError, OSError), exc:
+		if isinstance(exc, OSError) and exc.errno not in \
+		   (errno.EPERM, errno.EACCES, errno.EBADF, errno.EINVAL): raise
+		for rp in rps: rp.fsync()
+		if Globals.fsync_directories:
+			for dir_rp in dir_rps.values(): dir_rp.fsync()
+
+def syncfs_dirs(dir_rps):
+	"""Run C.syncfs once for each filesystem holding one of dir_rps"""
+	devices = {}
+	for dir_rp in dir_rps: devices[dir_rp.getdevloc()] = dir_rp
+	for dir_rp in devices.values():
+		fd = os.open(dir_rp.path, os.O_RDONLY)
+		try: C.syncfs(fd)
+		finally: os.close(fd)
+
 def rename(rp_source, rp_dest):
 	"""Rename rp_source to rp_dest"""
 	assert rp_source.conn is rp_dest.conn
@@ -274,6 +538,19 @@ def rename(rp_source, rp_dest):
 		rp_dest.data = rp_source.data
 		rp_source.data = {'type': None}
 
+# Number of calls this process made to read file information, by kind
+# ('lstat', 'scan_dir', 'fstatat' for the files scan_dir stats, 'ea',
+# 'acl'), see count_stat.  Main logs them after a backup or restore.
+stat_counts = {}
+
+def count_stat(kind, n = 1):
+	"""Add n calls of given kind to stat_counts"""
+	stat_counts[kind] = stat_counts.get(kind, 0) + n
+
+def get_stat_counts():
+	"""Return copy of stat_counts, so other connections can read them"""
+	return stat_counts.copy()
+
 def make_file_dict(filename):
 	"""Generate the data dictionary for the given RPath
 
@@ -282,6 +559,7 @@ def make_file_dict(filename):
 	filename over the network, thus avoiding the need to pickle an
 	(incomplete) rpath object.
 	"""
+	count_stat('lstat')
 	if os.name != 'nt':
 		try:
 			if type(filename) == unicode:
@@ -294,6 +572,147 @@ def make_file_dict(filename):
 
 	return make_file_dict_python(filename)
 
+def can_scan_dir(rpath):
+	"""False if scan_dir can't be used on Windows, for remote or quoted
+	rpaths, or with unicode paths"""
+	return not (os.name == 'nt' or rpath.conn is not Globals.local_connection
+				or rpath.__class__ is not RPath or Globals.use_unicode_paths)
+
+def scan_dir(rpath):
+	"""Return sorted list of (filename, data) pairs for directory rpath
+
+	data is what make_file_dict would return for the file, or None if
+	it couldn't be read that way.  This uses C.scan_dir, which only
+	stats each file relative to the open directory, so it is quicker
+	than listdir and then make_file_dict on every full path.  Returns
+	None if it can't be used for rpath, see can_scan_dir, or if the
+	directory has more than Globals.listdir_run_size entries, so huge
+	directories are left to listdir_sorted.
+
+	"""
+	if not can_scan_dir(rpath): return None
+	try: listing = C.scan_dir(rpath.path, Globals.listdir_run_size)
+	except NotImplementedError: return None
+	count_stat('scan_dir')
+	if listing is not None:
+		count_stat('fstatat', len(listing))
+		listing.sort()
+	return listing
+
+def listdir_sorted(rpath):
+	"""Return sorted filenames in directory rpath, using bounded memory
+
+	Usually a sorted list is returned, like rpath.listdir() but
+	sorted.  If the directory has more than Globals.listdir_run_size
+	entries, the filenames are read in chunks of that size with
+	C.list_dir_chunks, each chunk is sorted and written to a temp
+	file, and an iterator merging these runs is returned instead.
+	The filenames are interned, see intern_filename.
+
+	"""
+	if not can_scan_dir(rpath) or Globals.listdir_run_size <= 0:
+		return sort_list(rpath.listdir())
+	runs = SortedRuns()
+	try: C.list_dir_chunks(rpath.path, Globals.listdir_run_size, runs.add)
+	except NotImplementedError: return sort_list(rpath.listdir())
+	names = runs.get_sorted()
+	if type(names) is types.ListType: return map(intern_filename, names)
+	return itertools.imap(intern_filename, names)
+
+def sort_list(l):
+	"""Sort list l of filenames and return it, interned"""
+	l.sort()
+	return map(intern_filename, l)
+
+def intern_filename(filename):
+	"""Return the shared copy of filename
+
+	The selection walker and the metadata readers make their indicies
+	out of these (C.scan_dir and C.parse_metadata intern too).  Then
+	each name is only kept in memory once, however many iterators or
+	cached rorps refer to it, and comparing indicies, as Collate2Iters
+	does, is mostly identity checks.  Python drops an interned string
+	when nothing else uses it, so the table only holds names in use.
+	Unicode filenames can't be interned and are returned as is.
+
+	"""
+	if type(filename) is types.StringType: return intern(filename)
+	return filename
+
+class SortedRuns:
+	"""Sort strings in chunks, spilling the sorted runs to temp files
+
+	Strings are added a chunk at a time with add().  The last chunk is
+	kept in memory, so if there was only one it is simply returned
+	sorted.  Strings can't contain null characters, which separate
+	them in the temp files, but filenames never do.
+
+	"""
+	blocksize = 64 * 1024
+	def __init__(self):
+		self.run_files = []
+		self.last_chunk = None
+
+	def add(self, chunk):
+		"""Add list of strings, sorting it in place"""
+		if self.last_chunk: self.spill(self.last_chunk)
+		chunk.sort()
+		self.last_chunk = chunk
+
+	def spill(self, chunk):
+		"""Write sorted chunk to a new temp file"""
+		fp = tempfile.TemporaryFile()
+		fp.write("\0".join(chunk))
+		fp.write("\0")
+		fp.seek(0)
+		self.run_files.append(fp)
+
+	def read_run(self, fp):
+		"""Yield the strings in run file fp, then close it"""
+		rest = ""
+		while 1:
+			buf = fp.read(self.blocksize)
+			if not buf: break
+			strings = (rest + buf).split("\0")
+			rest = strings.pop()
+			for s in strings: yield s
+		fp.close()
+
+	def get_sorted(self):
+		"""Return sorted list or iterator of all the strings added"""
+		if not self.run_files: return self.last_chunk or []
+		runs = map(self.read_run, self.run_files)
+		runs.append(iter(self.last_chunk))
+		self.run_files = self.last_chunk = None
+		return self.merge(runs)
+
+	def merge(self, runs):
+		"""Merge the sorted iterators in runs"""
+		heads = [] # sorted list of (string, run number) pairs
+		for i in range(len(runs)):
+			try: heads.append((runs[i].next(), i))
+			except StopIteration: pass
+		heads.sort()
+		while heads:
+			s, i = heads.pop(0)
+			yield s
+			try: bisect.insort(heads, (runs[i].next(), i))
+			except StopIteration: pass
+
+def normalize_path(path):
+	"""Return path without redundant /'s and .'s, see RPath.normalize"""
+	newpath = "/".join(filter(lambda x: x and x != ".", path.split("/")))
+	if path[0] == "/": newpath = "/" + newpath
+	elif not newpath: newpath = "."
+	return newpath
+
+def split_path(path):
+	"""Return (dirname, basename) of path, see RPath.dirsplit"""
+	normed = normalize_path(path)
+	if normed.find("/") == -1: return (".", normed)
+	comps = normed.split("/")
+	return "/".join(comps[:-1]), comps[-1]
+
 def make_file_dict_python(filename):
 	"""Create the data dictionary using a Python call to os.lstat
 	
@@ -364,10 +783,10 @@ def make_socket_local(rpath):
 	except socket.error, exc:
 		raise SkipFileException("Socket error: " + str(exc))
 
-def gzip_open_local_read(rpath):
-	"""Return open GzipFile.  See security note directly above"""
+def compressed_open_local_read(rpath, compress = 1):
+	"""Return open compressed file.  See security note directly above"""
 	assert rpath.conn is Globals.local_connection
-	return GzipFile(rpath.path, "rb")
+	return open_compressed(rpath.path, "rb", compress)
 
 def open_local_read(rpath):
 	"""Return open file (provided for security reasons)"""
@@ -378,8 +797,8 @@ def get_incfile_info(basename):
 	"""Returns None or tuple of 
 	(is_compressed, timestr, type, and basename)"""
 	dotsplit = basename.split(".")
-	if dotsplit[-1] == "gz":
-		compressed = 1
+	if dotsplit[-1] in compression_suffixes:
+		compressed = dotsplit[-1]
 		if len(dotsplit) < 4: return None
 		timestring, ext = dotsplit[-3:-1]
 	else:
@@ -403,7 +822,15 @@ def delete_dir_no_files(rp):
 	rp.delete()
 
 
-class RORPath:
+# Keys of the data dictionary which RORPath keeps in slots.  Others,
+# like carbonfile or resourcefork, go in its extra dictionary.
+rorp_fields = ('type', 'size', 'perms', 'uid', 'gid', 'uname', 'gname',
+			   'inode', 'devloc', 'nlink', 'mtime', 'atime', 'ctime',
+			   'linkname', 'devnums', 'sha1', 'acl', 'ea', 'win_acl')
+is_rorp_field = {}
+for key in rorp_fields: is_rorp_field[key] = 1
+
+class RORPath(object):
 	"""Read Only RPath - carry information about a path
 
 	These contain information about a file, and possible the file's
@@ -411,22 +838,89 @@ class RORPath:
 	changed.  The advantage of these objects is that they can be
 	communicated by encoding their index and data dictionary.
 
+	Since millions of these are made and thousands may be kept at
+	once, the data isn't stored in a dictionary.  The keys in
+	rorp_fields are slots, unset if the key is missing, and any other
+	keys are kept in self.extra, which is None until needed.  The
+	data attribute is a RORPathData, which works like the old data
+	dictionary.
+
 	"""
+	__slots__ = ('index', 'file', 'file_already_open', 'extra') + rorp_fields
+
 	def __init__(self, index, data = None):
 		self.index = index
-		if data: self.data = data
-		else: self.data = {'type':None} # signify empty file
+		self.extra = None
+		if data:
+			if isinstance(data, RORPathData): data = data.copy()
+			self.add_data(data)
+		else: self.type = None # signify empty file
 		self.file = None
 
+	def get_data_view(self):
+		"""Return RORPathData for self, see the data attribute"""
+		return RORPathData(self)
+
+	def set_data_dict(self, data):
+		"""Set all the data from dictionary data"""
+		if isinstance(data, RORPathData): data = data.copy()
+		for key in rorp_fields:
+			try: delattr(self, key)
+			except AttributeError: pass
+		self.extra = None
+		if data is not None: self.add_data(data)
+
+	def add_data(self, data):
+		"""Set the keys in dictionary data, leaving the others alone"""
+		for key, value in data.iteritems():
+			if key in is_rorp_field: setattr(self, key, value)
+			else:
+				if self.extra is None: self.extra = {}
+				self.extra[key] = value
+
+	data = property(get_data_view, set_data_dict)
+
+	def get_data_item(self, key):
+		"""Return value of key in data, raising KeyError if missing"""
+		if is_rorp_field.has_key(key):
+			try: return getattr(self, key)
+			except AttributeError: raise KeyError(key)
+		if self.extra is None: raise KeyError(key)
+		return self.extra[key]
+
+	def set_data_item(self, key, value):
+		"""Set value of key in data"""
+		if is_rorp_field.has_key(key): setattr(self, key, value)
+		else:
+			if self.extra is None: self.extra = {}
+			self.extra[key] = value
+
+	def del_data_item(self, key):
+		"""Remove key from data, raising KeyError if missing"""
+		if is_rorp_field.has_key(key):
+			try: delattr(self, key)
+			except AttributeError: raise KeyError(key)
+		elif self.extra is None: raise KeyError(key)
+		else: del self.extra[key]
+
+	def get_data_items(self):
+		"""Return list of (key, value) pairs in data"""
+		items = []
+		for key in rorp_fields:
+			try: items.append((key, getattr(self, key)))
+			except AttributeError: pass
+		if self.extra: items.extend(self.extra.items())
+		return items
+
 	def zero(self):
 		"""Set inside of self to type None"""
-		self.data = {'type': None}
+		self.set_data_dict({'type': None})
 		self.file = None
 
 	def make_zero_dir(self, dir_rp):
 		"""Set self.data the same as dir_rp.data but with safe permissions"""
-		self.data = dir_rp.data.copy()
-		self.data['perms'] = 0700
+		self.set_data_dict(dir_rp.data.copy())
+		self.perms = 0700
 
 	def __nonzero__(self): return 1
 
@@ -434,7 +928,7 @@ class RORPath:
 		"""True iff the two rorpaths are equivalent"""
 		if self.index != other.index: return None
 
-		for key in self.data.keys(): # compare dicts key by key
+		for key, value in self.get_data_items(): # compare key by key
 			if self.issym() and key in ('uid', 'gid', 'uname', 'gname'):
 				pass # Don't compare gid/uid for symlinks
 			elif key == 'atime' and not Globals.preserve_atime: pass
@@ -451,16 +945,16 @@ class RORPath:
 				# here for legacy reasons - 0.12.x didn't store u/gnames
 				other_name = other.data.get(key, None)
 				if (other_name and other_name != "None" and
-					other_name != self.data[key]): return None
+					other_name != value): return None
 			elif ((key == 'inode' or key == 'devloc') and
 				  (not self.isreg() or self.getnumlinks() == 1 or
 				   not Globals.compare_inode or
 				   not Globals.preserve_hardlinks)):
 				pass
 			else:
-				try: other_val = other.data[key]
+				try: other_val = other.get_data_item(key)
 				except KeyError: return None
-				if self.data[key] != other_val: return None
+				if value != other_val: return None
 		return 1
 
 	def equal_loose(self, other):
@@ -472,7 +966,7 @@ class RORPath:
 		original rpath.
 
 		"""
-		for key in self.data.keys(): # compare dicts key by key
+		for key, value in self.get_data_items(): # compare key by key
 			if key in ('uid', 'gid', 'uname', 'gname'): pass
 			elif (key == 'type' and self.isspecial() and
 				  other.isreg() and other.getsize() == 0):
@@ -490,9 +984,10 @@ class RORPath:
 				pass
 			elif key == 'sha1': pass # one or other may not have set
 			elif key == 'mirrorname' or key == 'incname': pass
-			elif (not other.data.has_key(key) or
-				  self.data[key] != other.data[key]):
-				return 0
+			else:
+				try: other_val = other.get_data_item(key)
+				except KeyError: return 0
+				if value != other_val: return 0
 
 		if self.lstat() and not self.issym() and Globals.change_ownership:
 			# Now compare ownership.  Symlinks don't have ownership
@@ -565,11 +1060,13 @@ class RORPath:
 		file object, which can't/shouldn't be pickled.
 
 		"""
-		return (self.index, self.data)
+		return (self.index, self.data.copy())
 
 	def __setstate__(self, rorp_state):
 		"""Reproduce RORPath from __getstate__ output"""
-		self.index, self.data = rorp_state
+		self.index, data = rorp_state
+		self.set_data_dict(data)
+		self.file = None
 
 	def getRORPath(self):
 		"""Return new rorpath based on self"""
@@ -584,106 +1081,110 @@ class RORPath:
 		symlink.
 		
 		"""
-		return self.data['type']
+		return self.type
 	gettype = lstat
 
 	def isdir(self):
 		"""True if self is a dir"""
-		return self.data['type'] == 'dir'
+		return self.type == 'dir'
 
 	def isreg(self):
 		"""True if self is a regular file"""
-		return self.data['type'] == 'reg'
+		return self.type == 'reg'
 
 	def issym(self):
 		"""True if path is of a symlink"""
-		return self.data['type'] == 'sym'
+		return self.type == 'sym'
 
 	def isfifo(self):
 		"""True if path is a fifo"""
-		return self.data['type'] == 'fifo'
+		return self.type == 'fifo'
 
 	def ischardev(self):
 		"""True if path is a character device file"""
-		return self.data['type'] == 'dev' and self.data['devnums'][0] == 'c'
+		return self.type == 'dev' and self.devnums[0] == 'c'
 
 	def isblkdev(self):
 		"""True if path is a block device file"""
-		return self.data['type'] == 'dev' and self.data['devnums'][0] == 'b'
+		return self.type == 'dev' and self.devnums[0] == 'b'
 
 	def isdev(self):
 		"""True if path is a device file"""
-		return self.data['type'] == 'dev'
+		return self.type == 'dev'
 
 	def issock(self):
 		"""True if path is a socket"""
-		return self.data['type'] == 'sock'
+		return self.type == 'sock'
 
 	def isspecial(self):
 		"""True if the file is a sock, symlink, device, or fifo"""
-		type = self.data['type']
+		type = self.type
 		return (type == 'dev' or type == 'sock' or
 				type == 'fifo' or type == 'sym')
 
 	def getperms(self):
 		"""Return permission block of file"""
-		if self.data.has_key('perms'): return self.data['perms']
-		else: return 0
+		try: return self.perms
+		except AttributeError: return 0
 
 	def getuname(self):
 		"""Return username that owns the file"""
-		try: return self.data['uname']
-		except KeyError: return None
+		try: return self.uname
+		except AttributeError: return None
 
 	def getgname(self):
 		"""Return groupname that owns the file"""
-		try: return self.data['gname']
-		except KeyError: return None
+		try: return self.gname
+		except AttributeError: return None
 
 	def hassize(self):
 		"""True if rpath has a size parameter"""
-		return self.data.has_key('size')
+		return hasattr(self, 'size')
 
 	def getsize(self):
 		"""Return length of file in bytes"""
-		return self.data['size']
+		return self.get_data_item('size')
 
 	def getuidgid(self):
 		"""Return userid/groupid of file"""
-		return self.data['uid'], self.data['gid']
+		return self.get_data_item('uid'), self.get_data_item('gid')
 
 	def getatime(self):
 		"""Return access time in seconds"""
-		return self.data['atime']
+		return self.get_data_item('atime')
 
 	def getmtime(self):
 		"""Return modification time in seconds"""
-		return self.data['mtime']
+		return self.get_data_item('mtime')
 
 	def getctime(self):
 		"""Return change time in seconds"""
-		return self.data['ctime']
+		return self.get_data_item('ctime')
 	
 	def getinode(self):
 		"""Return inode number of file"""
-		return self.data['inode']
+		return self.get_data_item('inode')
 
 	def getdevloc(self):
 		"""Device number file resides on"""
-		return self.data['devloc']
+		return self.get_data_item('devloc')
 
 	def getnumlinks(self):
 		"""Number of places inode is linked to"""
-		if self.data.has_key('nlink'): return self.data['nlink']
-		else: return 1
+		try: return self.nlink
+		except AttributeError: return 1
+
+	def has_inode(self):
+		"""True iff the inode and device of self are known"""
+		return hasattr(self, 'inode')
 
 	def readlink(self):
 		"""Wrapper around os.readlink()"""
-		return self.data['linkname']
+		return self.get_data_item('linkname')
 
 	def getdevnums(self):
 		"""Return a devices major/minor numbers from dictionary"""
-		return self.data['devnums'][1:]
+		return self.get_data_item('devnums')[1:]
 
 	def setfile(self, file):
 		"""Right now just set self.file to be the already opened file"""
@@ -708,11 +1209,11 @@ class RORPath:
 		something, and 'diff' for an rdiff style diff.
 
 		"""
-		return self.data['filetype']
+		return self.get_data_item('filetype')
 	
 	def set_attached_filetype(self, type):
 		"""Set the type of the attached file"""
-		self.data['filetype'] = type
+		self.set_data_item('filetype', type)
 
 	def isflaglinked(self):
 		"""True if rorp is a signature/diff for a hardlink file
@@ -721,15 +1222,28 @@ class RORPath:
 		because it is hardlinked on the remote side.
 
 		"""
-		return self.data.has_key('linked')
+		return self.extra is not None and self.extra.has_key('linked')
 
 	def get_link_flag(self):
 		"""Return previous index that a file is hard linked to"""
-		return self.data['linked']
+		return self.get_data_item('linked')
 
 	def flaglinked(self, index):
 		"""Signal that rorp is a signature/diff for a hardlink file"""
-		self.data['linked'] = index
+		self.set_data_item('linked', index)
+
+	def issparse(self):
+		"""True if the attached file is the data of a file with holes
+
+		The data is then written sparsely on the other side, see
+		has_holes and copyfileobj.
+
+		"""
+		return self.extra is not None and self.extra.has_key('sparse')
+
+	def set_sparse(self):
+		"""Signal that the attached file should be written sparsely"""
+		self.set_data_item('sparse', 1)
 
 	def open(self, mode):
 		"""Return file type object if any was given using self.setfile"""
@@ -750,68 +1264,69 @@ class RORPath:
 
 	def set_acl(self, acl):
 		"""Record access control list in dictionary.  Does not write"""
-		self.data['acl'] = acl
+		self.acl = acl
 
 	def get_acl(self):
 		"""Return access control list object from dictionary"""
-		try: return self.data['acl']
-		except KeyError:
-			acl = self.data['acl'] = get_blank_acl(self.index)
+		try: return self.acl
+		except AttributeError:
+			acl = self.acl = get_blank_acl(self.index)
 			return acl
 
 	def set_ea(self, ea):
 		"""Record extended attributes in dictionary.  Does not write"""
-		self.data['ea'] = ea
+		self.ea = ea
 
 	def get_ea(self):
 		"""Return extended attributes object"""
-		try: return self.data['ea']
-		except KeyError:
-			ea = self.data['ea'] = get_blank_ea(self.index)
+		try: return self.ea
+		except AttributeError:
+			ea = self.ea = get_blank_ea(self.index)
 			return ea
 
 	def has_carbonfile(self):
 		"""True if rpath has a carbonfile parameter"""
-		return self.data.has_key('carbonfile')
+		return self.extra is not None and self.extra.has_key('carbonfile')
 
 	def get_carbonfile(self):
 		"""Returns the carbonfile data"""
-		return self.data['carbonfile']
+		return self.get_data_item('carbonfile')
 
 	def set_carbonfile(self, cfile):
 		"""Record carbonfile data in dictionary.  Does not write."""
-		self.data['carbonfile'] = cfile
+		self.set_data_item('carbonfile', cfile)
 
 	def has_resource_fork(self):
 		"""True if rpath has a resourcefork parameter"""
-		return self.data.has_key('resourcefork')
+		return (self.extra is not None and
+				self.extra.has_key('resourcefork'))
 
 	def get_resource_fork(self):
 		"""Return the resource fork in binary data"""
-		return self.data['resourcefork']
+		return self.get_data_item('resourcefork')
 
 	def set_resource_fork(self, rfork):
 		"""Record resource fork in dictionary.  Does not write"""
-		self.data['resourcefork'] = rfork
+		self.set_data_item('resourcefork', rfork)
 
 	def set_win_acl(self, acl):
 		"""Record Windows access control list in dictionary. Does not write"""
-		self.data['win_acl'] = acl
+		self.win_acl = acl
 
 	def get_win_acl(self):
 		"""Return access control list object from dictionary"""
-		try: return self.data['win_acl']
-		except KeyError:
-			acl = self.data['win_acl'] = get_blank_win_acl(self.index)
+		try: return self.win_acl
+		except AttributeError:
+			acl = self.win_acl = get_blank_win_acl(self.index)
 			return acl
 
 	def has_alt_mirror_name(self):
 		"""True if rorp has an alternate mirror name specified"""
-		return self.data.has_key('mirrorname')
+		return self.extra is not None and self.extra.has_key('mirrorname')
 
 	def get_alt_mirror_name(self):
 		"""Return alternate mirror name (for long filenames)"""
-		return self.data['mirrorname']
+		return self.get_data_item('mirrorname')
 
 	def set_alt_mirror_name(self, filename):
 		"""Set alternate mirror name to filename
@@ -821,15 +1336,15 @@ class RORPath:
 		directory.
 
 		"""
-		self.data['mirrorname'] = filename
+		self.set_data_item('mirrorname', filename)
 
 	def has_alt_inc_name(self):
 		"""True if rorp has an alternate increment base specified"""
-		return self.data.has_key('incname')
+		return self.extra is not None and self.extra.has_key('incname')
 
 	def get_alt_inc_name(self):
 		"""Return alternate increment base (used for long name support)"""
-		return self.data['incname']
+		return self.get_data_item('incname')
 
 	def set_alt_inc_name(self, name):
 		"""Set alternate increment name to name
@@ -839,19 +1354,67 @@ class RORPath:
 		should be set to the same.
 
 		"""
-		self.data['incname'] = name
+		self.set_data_item('incname', name)
 
 	def has_sha1(self):
 		"""True iff self has its sha1 digest set"""
-		return self.data.has_key('sha1')
+		return hasattr(self, 'sha1')
 
 	def get_sha1(self):
 		"""Return sha1 digest.  Causes exception unless set_sha1 first"""
-		return self.data['sha1']
+		return self.get_data_item('sha1')
 
 	def set_sha1(self, digest):
 		"""Set sha1 hash (should be in hexdecimal)"""
-		self.data['sha1'] = digest
+		self.sha1 = digest
+
+
+class RORPathData(object):
+	"""Dictionary-like view of the data of a RORPath
+
+	This is what rorp.data returns, so code written for the data
+	dictionary still works: changes go to the RORPath.  Use copy() to
+	get a real dictionary.  A RORPathData pickles as a dictionary too.
+
+	"""
+	__slots__ = ('rorp',)
+	def __init__(self, rorp): self.rorp = rorp
+	def __getitem__(self, key): return self.rorp.get_data_item(key)
+	def __setitem__(self, key, value): self.rorp.set_data_item(key, value)
+	def __delitem__(self, key): self.rorp.del_data_item(key)
+	def __len__(self): return len(self.rorp.get_data_items())
+	def __iter__(self): return iter(self.keys())
+
+	def has_key(self, key):
+		"""True if key is in data"""
+		try: self.rorp.get_data_item(key)
+		except KeyError: return 0
+		return 1
+
+	__contains__ = has_key
+
+	def get(self, key, default = None):
+		"""Return value of key, or default if missing"""
+		try: return self.rorp.get_data_item(key)
+		except KeyError: return default
+
+	def keys(self): return map(lambda pair: pair[0], self.items())
+	def values(self): return map(lambda pair: pair[1], self.items())
+	def items(self): return self.rorp.get_data_items()
+	def copy(self): return dict(self.items())
+
+	def update(self, d):
+		"""Set the keys in dictionary d"""
+		if isinstance(d, RORPathData): d = d.copy()
+		self.rorp.add_data(d)
+
+	def __eq__(self, other):
+		if isinstance(other, RORPathData): other = other.copy()
+		return self.copy() == other
+
+	def __ne__(self, other): return not self.__eq__(other)
+	def __repr__(self): return repr(self.copy())
+	def __reduce__(self): return (dict, (self.copy(),))
 
 
 class RPath(RORPath):
@@ -864,6 +1427,9 @@ class RPath(RORPath):
 
 	"""
 	regex_chars_to_quote = re.compile("[\\\\\\\"\\$`]")
+	# Set on increments by increment.py if they were stored uncompressed
+	# because a sample of the file's data didn't compress well
+	incompressible = 0
 
 	def __init__(self, connection, base, index = (), data = None):
 		"""RPath constructor
@@ -901,11 +1467,14 @@ class RPath(RORPath):
 		file won't be saved.
 
 		"""
-		return (self.conn.conn_number, self.base, self.index, self.data)
+		return (self.conn.conn_number, self.base, self.index,
+				self.data.copy())
 
 	def __setstate__(self, rpath_state):
 		"""Reproduce RPath from __getstate__ output"""
-		conn_number, self.base, self.index, self.data = rpath_state
+		conn_number, self.base, self.index, data = rpath_state
+		self.set_data_dict(data)
+		self.file = None
 		self.conn = Globals.connection_dict[conn_number]
 		self.path = "/".join((self.base,) + self.index)
 
@@ -921,11 +1490,11 @@ class RPath(RORPath):
 		of sync and you need to find out where it happened.
 
 		"""
-		temptype = self.data['type']
+		temptype = self.type
 		self.setdata()
-		assert temptype == self.data['type'], \
+		assert temptype == self.type, \
 			   "\nName: %s\nOld: %s --> New: %s\n" % \
-			   (self.path, temptype, self.data['type'])
+			   (self.path, temptype, self.type)
 
 	def chmod(self, permissions, loglevel = 2):
 		"""Wrapper around os.chmod"""
@@ -943,7 +1512,7 @@ class RPath(RORPath):
 											  & 06777 & Globals.permission_mask)
 			else:
 				raise
-		self.data['perms'] = permissions
+		self.perms = permissions
 
 	def settime(self, accesstime, modtime):
 		"""Change file modification times"""
@@ -954,8 +1523,8 @@ class RPath(RORPath):
 					"64->32bit conversion" %
 					(self.path, (accesstime, modtime)), 2)
 		else:
-			self.data['atime'] = accesstime
-			self.data['mtime'] = modtime
+			self.atime = accesstime
+			self.mtime = modtime
 
 	def setmtime(self, modtime):
 		"""Set only modtime (access time to present)"""
@@ -971,7 +1540,7 @@ class RPath(RORPath):
 			# directories on Windows.
 		    if self.conn.os.name != 'nt' or not self.isdir():
 		        raise
-		else: self.data['mtime'] = modtime
+		else: self.mtime = modtime
 
 	def chown(self, uid, gid):
 		"""Set file's uid and gid"""
@@ -981,8 +1550,8 @@ class RPath(RORPath):
 				log.Log("Warning: lchown missing, cannot change ownership "
 						"of symlink " + self.path, 2)
 		else: os.chown(self.path, uid, gid)
-		self.data['uid'] = uid
-		self.data['gid'] = gid
+		self.uid = uid
+		self.gid = gid
 
 	def mkdir(self):
 		log.Log("Making directory " + self.path, 6)
@@ -1064,12 +1633,12 @@ class RPath(RORPath):
 		except AttributeError:
 		    return True # Windows doesn't have getuid(), so hope for the best
 		return uid == 0 or \
-			   (self.data.has_key('uid') and uid == self.data['uid'])
+			   (hasattr(self, 'uid') and uid == self.uid)
 
 	def isgroup(self):
 		"""Return true if process has group of rp"""
-		return (self.data.has_key('gid') and \
-				self.data['gid'] in self.conn.Globals.get('process_groups'))
+		return (hasattr(self, 'gid') and
+				self.gid in self.conn.Globals.get('process_groups'))
 
 	def delete(self):
 		"""Delete file at self.path.  Recursively deletes directories."""
@@ -1120,11 +1689,7 @@ class RPath(RORPath):
 		be retained.
 
 		"""
-		newpath = "/".join(filter(lambda x: x and x != ".",
-								  self.path.split("/")))
-		if self.path[0] == "/": newpath = "/" + newpath
-		elif not newpath: newpath = "."
-		return self.newpath(newpath)
+		return self.newpath(normalize_path(self.path))
 
 	def dirsplit(self):
 		"""Returns a tuple of strings (dirname, basename)
@@ -1138,10 +1703,7 @@ class RPath(RORPath):
 		'.'.
 
 		"""
-		normed = self.normalize()
-		if normed.path.find("/") == -1: return (".", normed.path)
-		comps = normed.path.split("/")
-		return "/".join(comps[:-1]), comps[-1]
+		return split_path(self.path)
 
 	def get_parent_rp(self):
 		"""Return new RPath of directory self is in"""
@@ -1151,6 +1713,20 @@ class RPath(RORPath):
 		if dirname: return self.__class__(self.conn, dirname)
 		else: return self.__class__(self.conn, "/")
 
+	def new_sibling(self, filename):
+		"""Return new RPath of filename in the same directory as self
+
+		Unlike get_parent_rp().append(filename), the directory isn't
+		stat'd.
+
+		"""
+		if self.index:
+			return self.__class__(self.conn, self.base,
+								  self.index[:-1] + (filename,))
+		dirname = self.dirsplit()[0]
+		if not dirname: dirname = "/"
+		return self.__class__(self.conn, dirname, (filename,))
+
 	def newpath(self, newpath, index = ()):
 		"""Return new RPath with the same connection but different path"""
 		return self.__class__(self.conn, newpath, index)
@@ -1159,6 +1735,16 @@ class RPath(RORPath):
 		"""Return new RPath with same connection by adjoing ext"""
 		return self.__class__(self.conn, self.base, self.index + (ext,))
 
+	def append_with_data(self, ext, data):
+		"""Like append, but data is from make_file_dict, see scan_dir
+
+		If data is None, the file is stat'd as usual.
+
+		"""
+		rp = self.__class__(self.conn, self.base, self.index + (ext,), data)
+		if data and rp.lstat(): self.conn.rpath.setdata_local(rp)
+		return rp
+
 	def append_path(self, ext, new_index = ()):
 		"""Like append, but add ext to path instead of to index"""
 		return self.__class__(self.conn, "/".join((self.base, ext)), new_index)
@@ -1174,36 +1760,39 @@ class RPath(RORPath):
 	def open(self, mode, compress = None):
 		"""Return open file.  Supports modes "w" and "r".
 
-		If compress is true, data written/read will be gzip
-		compressed/decompressed on the fly.  The extra complications
-		below are for security reasons - try to make the extent of the
-		risk apparent from the remote call.
+		If compress is true, data written/read will be compressed/
+		decompressed on the fly, see open_compressed for its values.
+		The extra complications below are for security reasons - try
+		to make the extent of the risk apparent from the remote call.
 
 		"""
 		if self.conn is Globals.local_connection:
-			if compress: return GzipFile(self.path, mode)
+			if compress: return open_compressed(self.path, mode, compress)
 			else: return open(self.path, mode)
 
 		if compress:
 			if mode == "r" or mode == "rb":
-				return self.conn.rpath.gzip_open_local_read(self)
-			else: return self.conn.rpath.GzipFile(self.path, mode)
+				return self.conn.rpath.compressed_open_local_read(self,
+																  compress)
+			else: return self.conn.rpath.open_compressed(self.path, mode,
+														 compress)
 		else:
 			if mode == "r" or mode == "rb":
 				return self.conn.rpath.open_local_read(self)
 			else: return self.conn.open(self.path, mode)
 
-	def write_from_fileobj(self, fp, compress = None):
+	def write_from_fileobj(self, fp, compress = None, sparse = None):
 		"""Reads fp and writes to self.path.  Closes both when done
 
-		If compress is true, fp will be gzip compressed before being
-		written to self.  Returns closing value of fp.
+		If compress is true, fp will be compressed before being
+		written to self.  If sparse is true, pages of zeros are left
+		as holes, see copyfileobj.  Returns closing value of fp.
 
 		"""
 		log.Log("Writing file object to " + self.path, 7)
 		assert not self.lstat(), "File %s already exists" % self.path
 		outfp = self.open("wb", compress = compress)
-		copyfileobj(fp, outfp)
+		copyfileobj(fp, outfp, sparse)
 		if outfp.close(): raise RPathException("Error closing file")
 		self.setdata()
 		return fp.close()
@@ -1235,7 +1824,7 @@ class RPath(RORPath):
 			return None
 
 	def isinccompressed(self):
-		"""Return true if inc file is compressed"""
+		"""Return compression suffix ("gz", "bz2"...) or None if not"""
 		return self.inc_compressed
 
 	def getinctype(self):
@@ -1255,9 +1844,8 @@ class RPath(RORPath):
 
 	def getincbase_str(self):
 		"""Return the base filename string of an increment file"""
-		rp = self.getincbase()
-		if rp.index: return rp.index[-1]
-		else: return rp.dirsplit()[1]
+		if self.index: return self.inc_basestr
+		else: return split_path(self.inc_basestr)[1]
 
 	def makedev(self, type, major, minor):
 		"""Make a special file with specified type, and major/minor nums"""
@@ -1334,8 +1922,8 @@ class RPath(RORPath):
 
 	def get_acl(self):
 		"""Return access control list object, setting if necessary"""
-		try: acl = self.data['acl']
-		except KeyError: acl = self.data['acl'] = acl_get(self)
+		try: acl = self.acl
+		except AttributeError: acl = self.acl = acl_get(self)
 		return acl
 
 	def write_acl(self, acl, map_names = 1):
@@ -1345,18 +1933,18 @@ class RPath(RORPath):
 
 		"""
 		acl.write_to_rp(self, map_names)
-		self.data['acl'] = acl
+		self.acl = acl
 
 	def get_ea(self):
 		"""Return extended attributes object, setting if necessary"""
-		try: ea = self.data['ea']
-		except KeyError: ea = self.data['ea'] = ea_get(self)
+		try: ea = self.ea
+		except AttributeError: ea = self.ea = ea_get(self)
 		return ea
 
 	def write_ea(self, ea):
 		"""Change extended attributes of rp"""
 		ea.write_to_rp(self)
-		self.data['ea'] = ea
+		self.ea = ea
 
 	def write_carbonfile(self, cfile):
 		"""Write new carbon data to self."""
@@ -1387,7 +1975,7 @@ class RPath(RORPath):
 	def get_resource_fork(self):
 		"""Return resource fork data, setting if necessary"""
 		assert self.isreg()
-		try: rfork = self.data['resourcefork']
+		try: rfork = self.get_data_item('resourcefork')
 		except KeyError:
 			try:
 				rfork_fp = self.conn.open(os.path.join(self.path, '..namedfork', 'rsrc'),
@@ -1395,7 +1983,7 @@ class RPath(RORPath):
 				rfork = rfork_fp.read()
 				assert not rfork_fp.close()
 			except (IOError, OSError), e: rfork = ''
-			self.data['resourcefork'] = rfork
+			self.set_data_item('resourcefork', rfork)
 		return rfork
 
 	def write_resource_fork(self, rfork_data):
@@ -1408,14 +1996,14 @@ class RPath(RORPath):
 
 	def get_win_acl(self):
 		"""Return Windows access control list, setting if necessary"""
-		try: acl = self.data['win_acl']
-		except KeyError: acl = self.data['win_acl'] = win_acl_get(self)
+		try: acl = self.win_acl
+		except AttributeError: acl = self.win_acl = win_acl_get(self)
 		return acl
 
 	def write_win_acl(self, acl):
 		"""Change access control list of rp"""
 		write_win_acl(self, acl)
-		self.data['win_acl'] = acl
+		self.win_acl = acl
 
 class MaybeUnicode:
 	""" Wraps a RPath and reads/writes unicode if Globals.use_unicode_paths is on. """
@@ -1442,6 +2030,9 @@ class MaybeUnicode:
 			buf = buf.encode('utf-8')
 		return self.fileobj.write(buf)
 
+	def set_restart_point(self):
+		return self.fileobj.set_restart_point()
+
 	def close(self):
 		return self.fileobj.close()
 
@@ -1468,7 +2059,7 @@ class GzipFile(gzip.GzipFile):
 	messages.  Use this class instead to clean those up.
 
 	"""
-	def __init__(self, filename=None, mode=None):
+	def __init__(self, filename=None, mode=None, compresslevel=None):
 		""" This is needed because we need to write an
 		encoded filename to the file, but use normal
 		unicode with the filename."""
@@ -1478,13 +2069,123 @@ class GzipFile(gzip.GzipFile):
 			filename = unicode(filename, 'utf-8')
 		fileobj = open(filename, mode or 'rb')
 		gzip.GzipFile.__init__(self, filename.encode('utf-8'),
-							mode=mode, fileobj=fileobj)
+							mode=mode, compresslevel=compresslevel or 9,
+							fileobj=fileobj)
 
 	def __del__(self): pass
 	def __getattr__(self, name):
 		if name == 'fileno': return self.fileobj.fileno
 		else: raise AttributeError(name)
 
+	def set_restart_point(self):
+		"""Fully flush the compressor, return offset in underlying file
+
+		After a full flush the deflate stream does not refer back to
+		any earlier data, so a GzipRestartFile can start inflating at
+		the returned offset.  Only meaningful when writing.
+
+		"""
+		self.fileobj.write(self.compress.flush(zlib.Z_FULL_FLUSH))
+		return self.fileobj.tell()
+
+
+class BZ2File:
+	"""Read or write a bzip2 compressed file, see compression_codecs"""
+	def __init__(self, filename, mode = "rb", compresslevel = None):
+		if mode[0] == 'r': self.file = bz2.BZ2File(filename, mode)
+		else: self.file = bz2.BZ2File(filename, mode, 0, compresslevel or 9)
+
+	def read(self, length = -1): return self.file.read(length)
+	def readline(self, length = -1): return self.file.readline(length)
+	def write(self, buf): return self.file.write(buf)
+	def close(self): return self.file.close()
+
+
+class LZMAFile(BZ2File):
+	"""Read or write an xz compressed file, see compression_codecs"""
+	def __init__(self, filename, mode = "rb", compresslevel = None):
+		if mode[0] == 'r': self.file = lzma.LZMAFile(filename, mode)
+		else: self.file = lzma.LZMAFile(filename, mode,
+										preset = compresslevel or 6)
+
+
+# The codecs increments may be compressed with.  Maps the codec names
+# used with --compression-codec to the suffix added to the increment
+# filename, the module needed, and the class that reads and writes
+# the file.  The suffix is recorded in the filename so restoring
+# knows which class to use.
+compression_codecs = {"gzip": ("gz", gzip, GzipFile),
+					  "bz2": ("bz2", bz2, BZ2File),
+					  "lzma": ("xz", lzma, LZMAFile)}
+compression_suffixes = ("gz", "bz2", "xz")
+
+def get_compression_suffix(codec = None):
+	"""Return the increment suffix of codec, default Globals' codec"""
+	return compression_codecs[codec or Globals.compression_codec][0]
+
+def open_compressed(filename, mode, compress):
+	"""Return file object reading or writing compressed filename
+
+	compress is one of the suffixes in compression_codecs, or any
+	other true value for gzip.  Files are written at
+	Globals.compression_level, or the codec's default if that is None.
+
+	"""
+	for suffix, module, fileclass in compression_codecs.values():
+		if compress == suffix: break
+	else: module, fileclass = gzip, GzipFile
+	if not module:
+		raise RPathException("Python module needed to read or write "
+							 "%s files not found" % (compress,))
+	if mode[0] == 'r': return fileclass(filename, mode)
+	return fileclass(filename, mode, Globals.compression_level)
+
+
+class GzipRestartFile:
+	"""Read a gzip file starting from a restart point
+
+	The offset should have been returned by GzipFile.set_restart_point
+	when the file was written.  Because reading starts in the middle
+	of the member, the header is skipped and the trailing crc cannot
+	be checked.  Only read() and readline() are supported.
+
+	"""
+	def __init__(self, filename, offset):
+		self.fileobj = open(filename, "rb")
+		self.fileobj.seek(offset)
+		self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+		self.buf = ""
+		self.at_end = 0
+
+	def _fill(self, length = -1, delimiter = None):
+		"""Add data to buffer until length or delimiter or end reached"""
+		while not self.at_end:
+			if length >= 0 and len(self.buf) >= length: break
+			if delimiter and self.buf.find(delimiter) >= 0: break
+			compressed = self.fileobj.read(Globals.blocksize)
+			if compressed:
+				self.buf += self.decompressor.decompress(compressed)
+				if not self.decompressor.unused_data: continue
+			else: self.buf += self.decompressor.flush()
+			self.at_end = 1 # gzip trailer reached, or file truncated
+
+	def read(self, length = -1):
+		self._fill(length)
+		if length < 0: length = len(self.buf)
+		data, self.buf = self.buf[:length], self.buf[length:]
+		return data
+
+	def readline(self, length = -1):
+		self._fill(length, "\n")
+		pos = self.buf.find("\n") + 1
+		if not pos: pos = len(self.buf)
+		if length >= 0: pos = min(pos, length)
+		data, self.buf = self.buf[:pos], self.buf[pos:]
+		return data
+
+	def close(self):
+		return self.fileobj.close()
+
 
 class MaybeGzip:
 	"""Represent a file object that may or may not be compressed
@@ -1525,6 +2226,11 @@ class MaybeGzip:
 		self.fileobj = new_rp.open("wb", compress = 1)
 		return self.fileobj.write(buf)
 
+	def set_restart_point(self):
+		"""Set gzip restart point and return offset, None if not open"""
+		if self.fileobj: return self.fileobj.set_restart_point()
+		return None
+
 	def close(self):
 		"""Close related fileobj, pass return value"""
 		if self.closed: return None
@@ -1534,6 +2240,138 @@ class MaybeGzip:
 		self.base_rp.touch()
 
 
+class ThreadedReader:
+	"""Read a file object in a separate thread
+
+	A worker thread reads blocks from fileobj (usually a GzipFile, so
+	the decompression is done there too) and passes them through a
+	bounded queue, so the reading can overlap with whatever is done
+	with the data.  Errors are re-raised when read() is called.
+
+	"""
+	queue_size = 8 # maximum number of blocks read in advance
+	def __init__(self, fileobj, blocksize):
+		self.fileobj, self.blocksize = fileobj, blocksize
+		self.queue = Queue.Queue(self.queue_size)
+		self.buf = ""
+		self.at_end = self.closing = 0
+		self.thread = threading.Thread(target = self._reader_thread)
+		self.thread.setDaemon(1)
+		self.thread.start()
+
+	def _reader_thread(self):
+		"""Put blocks of fileobj on the queue, then "" at the end"""
+		try:
+			while not self.closing:
+				data = self.fileobj.read(self.blocksize)
+				self.queue.put(data)
+				if not data: return
+			self.queue.put("")
+		except: self.queue.put(sys.exc_info())
+
+	def _get_block(self):
+		"""Add next block to buffer, return false at end of file"""
+		if self.at_end: return None
+		data = self.queue.get()
+		if type(data) is types.TupleType:
+			self.at_end = 1
+			raise data[0], data[1], data[2]
+		if not data:
+			self.at_end = 1
+			return None
+		self.buf += data
+		return 1
+
+	def read(self, length = -1):
+		while (length < 0 or len(self.buf) < length) and self._get_block():
+			pass
+		if length < 0: length = len(self.buf)
+		data, self.buf = self.buf[:length], self.buf[length:]
+		return data
+
+	def readline(self, length = -1):
+		while self.buf.find("\n") < 0 and self._get_block(): pass
+		pos = self.buf.find("\n") + 1
+		if not pos: pos = len(self.buf)
+		if length >= 0: pos = min(pos, length)
+		data, self.buf = self.buf[:pos], self.buf[pos:]
+		return data
+
+	def close(self):
+		"""Stop reader thread, then close fileobj"""
+		self.closing = 1
+		while not self.at_end:
+			data = self.queue.get()
+			if not data or type(data) is types.TupleType: self.at_end = 1
+		self.thread.join()
+		return self.fileobj.close()
+
+
+class ThreadedWriter:
+	"""Write to a file object in a separate thread
+
+	Data given to write() is put on a bounded queue and written to
+	fileobj (usually a GzipFile or MaybeGzip, so compression happens
+	there) by a worker thread.  set_restart_point() and close() wait
+	for the thread to finish everything before them.  An error while
+	writing is re-raised by the next call.
+
+	"""
+	queue_size = 8 # maximum number of writes waiting for the thread
+	def __init__(self, fileobj):
+		self.fileobj = fileobj
+		self.queue = Queue.Queue(self.queue_size)
+		self.results = Queue.Queue() # results of restart points and close
+		self.exc_info = None
+		self.thread = threading.Thread(target = self._writer_thread)
+		self.thread.setDaemon(1)
+		self.thread.start()
+
+	def _writer_thread(self):
+		"""Carry out requests from the queue until closed"""
+		while 1:
+			request, arg = self.queue.get()
+			try:
+				if request == "write":
+					if not self.exc_info: self.fileobj.write(arg)
+				elif request == "restart":
+					self._check_error()
+					self.results.put((None, self.fileobj.set_restart_point()))
+				else:
+					assert request == "close", request
+					result = self.fileobj.close()
+					self._check_error()
+					self.results.put((None, result))
+			except:
+				if not self.exc_info: self.exc_info = sys.exc_info()
+				if request != "write": self.results.put((self.exc_info, None))
+			if request == "close": return
+
+	def _check_error(self):
+		if self.exc_info:
+			raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+	def _wait_for(self, request):
+		"""Queue request and return its result from the thread"""
+		self.queue.put((request, None))
+		exc_info, result = self.results.get()
+		if exc_info: raise exc_info[0], exc_info[1], exc_info[2]
+		return result
+
+	def write(self, buf):
+		self._check_error()
+		self.queue.put(("write", buf))
+
+	def set_restart_point(self):
+		return self._wait_for("restart")
+
+	def close(self):
+		"""Finish writing and close fileobj, then stop the thread"""
+		try: result = self._wait_for("close")
+		finally: self.thread.join()
+		return result
+
+
 def setdata_local(rpath):
 	"""Set eas/acls, uid/gid, resource fork in data dictionary
 
@@ -1547,16 +2385,19 @@ def setdata_local(rpath):
 		reset_perms = True
 		rpath.chmod(0400 | rpath.getperms())
 
-	rpath.data['uname'] = user_group.uid2uname(rpath.data['uid'])
-	rpath.data['gname'] = user_group.gid2gname(rpath.data['gid'])
-	if Globals.eas_conn: rpath.data['ea'] = ea_get(rpath)
-	if Globals.acls_conn: rpath.data['acl'] = acl_get(rpath)
-	if Globals.win_acls_conn:
-		rpath.data['win_acl'] = win_acl_get(rpath)
+	rpath.uname = user_group.uid2uname(rpath.uid)
+	rpath.gname = user_group.gid2gname(rpath.gid)
+	if Globals.eas_conn:
+		count_stat('ea')
+		rpath.ea = ea_get(rpath)
+	if Globals.acls_conn:
+		count_stat('acl')
+		rpath.acl = acl_get(rpath)
+	if Globals.win_acls_conn: rpath.win_acl = win_acl_get(rpath)
 	if Globals.resource_forks_conn and rpath.isreg():
 		rpath.get_resource_fork()
 	if Globals.carbonfile_conn and rpath.isreg():
-		rpath.data['carbonfile'] = carbonfile_get(rpath)
+		rpath.set_data_item('carbonfile', carbonfile_get(rpath))
 
 	if reset_perms: rpath.chmod(rpath.getperms() & ~0400)
 
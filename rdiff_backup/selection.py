@@ -25,8 +25,10 @@ documentation on what this code does can be found on the man page.
 """
 
 from __future__ import generators
-import re
+import re, bisect, types
 import FilenameMapping, robust, rpath, Globals, log, rorpiter
+try: import threading
+except ImportError: threading = None
 
 
 class SelectError(Exception):
@@ -75,6 +77,13 @@ class Select:
 	to signal an error if the last function only includes, which would
 	be redundant and presumably isn't what the user intends.
 
+	Tuple and glob selection functions also have f.index (see
+	glob_get_index), so with many of them a SelectionIndex can find
+	the few that may match a given rpath instead of trying them all.
+	Filelist selection functions have f.ordered, because they keep
+	their place in the sorted filelist and so must be called on the
+	rpaths in order.
+
 	"""
 	# This re should not match normal filenames, but usually just globs
 	glob_re = re.compile("(.*[*?[\\\\]|ignorecase\\:)", re.I | re.S)
@@ -83,6 +92,7 @@ class Select:
 		"""Select initializer.  rpath is the root directory"""
 		assert isinstance(rootrp, rpath.RPath)
 		self.selection_functions = []
+		self.selection_index = None # made by Select when first needed
 		self.rpath = rootrp
 		self.prefix = self.rpath.path
 
@@ -115,9 +125,16 @@ class Select:
 			and should be included iff something inside is included.
 
 			"""
-			for filename in self.listdir(rpath):
-				new_rpath = robust.check_common_error(error_handler,
+			listing = prefetcher and prefetcher.get(rpath)
+			if listing is None: listing = self.listdir_data(rpath)
+			if prefetcher and type(listing) is types.ListType:
+				prefetcher.prefetch(rpath, listing)
+			for filename, data in listing:
+				if data is None:
+					new_rpath = robust.check_common_error(error_handler,
 										rpath.append, (filename,))
+				else: new_rpath = robust.check_common_error(error_handler,
+										rpath.append_with_data, (filename, data))
 				if new_rpath and new_rpath.lstat():
 					s = sel_func(new_rpath)
 					if s == 1: yield (new_rpath, 0)
@@ -125,6 +142,7 @@ class Select:
 
 		yield rpath
 		if not rpath.isdir(): return
+		prefetcher = self.get_prefetcher(rpath, sel_func)
 		diryield_stack = [diryield(rpath)]
 		delayed_rp_stack = []
 
@@ -143,6 +161,18 @@ class Select:
 			elif val == 1:
 				delayed_rp_stack.append(rpath)
 				diryield_stack.append(diryield(rpath))
+		if prefetcher: prefetcher.close()
+
+	def get_prefetcher(self, rootrp, sel_func):
+		"""Return DirPrefetcher for walking rootrp, or None if not used"""
+		if (Globals.walker_threads <= 0 or not threading or
+			not rpath.can_scan_dir(rootrp)): return None
+		if sel_func == self.Select:
+			self.get_functions(rootrp) # make index before threads start
+			dir_filter = self.may_descend
+		else: dir_filter = None
+		return DirPrefetcher(Globals.walker_threads, Globals.walker_prefetch,
+							 dir_filter)
 
 	def Iterate(self, rp, rec_func, sel_func):
 		"""Return iterator yielding rpaths in rpath
@@ -173,13 +203,40 @@ class Select:
 		else: assert 0, "Invalid selection result %s" % (str(s),)
 
 	def listdir(self, dir_rp):
-		"""List directory rpath with error logging"""
-		def error_handler(exc):
+		"""List directory rpath with error logging
+
+		Returns a sorted list, or an iterator for huge directories (see
+		rpath.listdir_sorted).
+
+		"""
+		def error_handler(exc, dir_rp):
 			log.ErrorLog.write_if_open("ListError", dir_rp, exc)
 			return []
-		dir_listing = robust.check_common_error(error_handler, dir_rp.listdir)
-		dir_listing.sort()
-		return dir_listing
+		return robust.check_common_error(error_handler, rpath.listdir_sorted,
+										 (dir_rp,))
+
+	def listdir_data(self, dir_rp):
+		"""Like listdir, but return list of (filename, data) pairs
+
+		If possible the data dictionaries of the files are read while
+		listing the directory (see rpath.scan_dir).  Otherwise data is
+		None and the caller has to read it.
+
+		"""
+		def error_handler(exc, dir_rp):
+			log.ErrorLog.write_if_open("ListError", dir_rp, exc)
+			return []
+		listing = robust.check_common_error(error_handler, rpath.scan_dir,
+											(dir_rp,))
+		if listing is not None: return listing
+		listing = self.listdir(dir_rp)
+		if type(listing) is types.ListType:
+			return map(lambda filename: (filename, None), listing)
+		return self.add_none_data(listing)
+
+	def add_none_data(self, filenames):
+		"""Yield (filename, None) pairs for iterator filenames"""
+		for filename in filenames: yield (filename, None)
 
 	def iterate_in_dir(self, rpath, rec_func, sel_func):
 		"""Iterate the rpaths in directory rpath."""
@@ -207,16 +264,40 @@ class Select:
 		for rp in rp_iter: ITR(rp.index, rp)
 		ITR.Finish()
 
+	def get_functions(self, rp):
+		"""Return list of the selection functions that may match rp"""
+		if self.selection_index is None:
+			self.selection_index = SelectionIndex(self.selection_functions)
+		if self.selection_index.active:
+			return self.selection_index.get_functions(rp)
+		return self.selection_functions
+
 	def Select(self, rp):
 		"""Run through the selection functions and return dominant val 0/1/2"""
+		sel_funcs = self.get_functions(rp)
 		scanned = 0 # 0, by default, or 2 if prev sel func scanned rp
-		for sf in self.selection_functions:
+		for sf in sel_funcs:
 			result = sf(rp)
 			if result == 1: return 1
 			elif result == 0: return scanned
 			elif result == 2: scanned = 2
 		return 1
 
+	def may_descend(self, dir_rp):
+		"""False if Select surely won't descend into directory dir_rp
+
+		Unlike Select this may be called out of order, and from other
+		threads, so when an ordered selection function would be reached
+		the answer is true.
+
+		"""
+		for sf in self.get_functions(dir_rp):
+			if getattr(sf, 'ordered', None): return 1
+			result = sf(dir_rp)
+			if result == 1 or result == 2: return 1
+			elif result == 0: return 0
+		return 1
+
 	def ParseArgs(self, argtuples, filelists):
 		"""Create selection functions based on list of tuples
 
@@ -324,6 +405,7 @@ probably isn't what you meant.""" %
 		"""Add another selection function at the end or beginning"""
 		if add_to_start: self.selection_functions.insert(0, sel_func)
 		else: self.selection_functions.append(sel_func)
+		self.selection_index = None
 
 	def filelist_get_sf(self, filelist_fp, inc_default, filelist_name):
 		"""Return selection function by reading list of files
@@ -354,6 +436,7 @@ probably isn't what you meant.""" %
 
 		selection_function.exclude = something_excluded or inc_default == 0
 		selection_function.name = "Filelist: " + filelist_name
+		selection_function.ordered = 1
 		return selection_function
 
 	def filelist_read(self, filelist_fp, include, filelist_name):
@@ -545,7 +628,11 @@ probably isn't what you meant.""" %
 		if glob_str == "**": sel_func = lambda rp: include
 		elif not self.glob_re.match(glob_str): # normal file
 			sel_func = self.glob_get_filename_sf(glob_str, include)
-		else: sel_func = self.glob_get_normal_sf(glob_str, include)
+		else:
+			sel_func = self.glob_get_normal_sf(glob_str, include)
+			sel_func.index = self.glob_get_index(glob_str)
+			sel_func.include = include
+			sel_func.quoted = 1
 
 		sel_func.exclude = not include
 		sel_func.name = "Command-line %s glob: %s" % \
@@ -584,6 +671,8 @@ probably isn't what you meant.""" %
 		elif include == 0: sel_func = exclude_sel_func
 		sel_func.exclude = not include
 		sel_func.name = "Tuple select %s" % (tuple,)
+		sel_func.index, sel_func.include, sel_func.quoted = tuple, include, 0
+		sel_func.definite = 1
 		return sel_func
 
 	def glob_get_normal_sf(self, glob_str, include):
@@ -630,6 +719,25 @@ probably isn't what you meant.""" %
 		if include: return include_sel_func
 		else: return exclude_sel_func
 
+	def glob_get_index(self, glob_str):
+		"""Return index of the directories glob_str starts with, or None
+
+		These are the whole path components before the first special
+		character.  The selection function of glob_str can then only
+		match rpaths whose index starts with this tuple, or is an
+		initial part of it.  None is returned for ignorecase globs and
+		globs like **/foo which don't start with the prefix.
+
+		"""
+		if glob_str.lower().startswith("ignorecase:"): return None
+		literal = re.match("[^*?[\\\\]*", glob_str).group()
+		literal = literal[:max(literal.rfind("/"), 0)]
+		if literal == self.prefix: return ()
+		if not literal.startswith(self.prefix): return None
+		if (not self.prefix.endswith("/") and
+			literal[len(self.prefix)] != "/"): return None
+		return tuple(filter(lambda x: x, literal[len(self.prefix):].split("/")))
+
 	def glob_get_prefix_res(self, glob_str):
 		"""Return list of regexps equivalent to prefixes of glob_str"""
 		glob_parts = glob_str.split("/")
@@ -681,6 +789,214 @@ probably isn't what you meant.""" %
 		return res
 
 
+class DirPrefetcher:
+	"""Read directory listings in worker threads before they are needed
+
+	On network filesystems each lstat is a round trip, so a serial
+	walk spends most of its time waiting.  Select.Iterate_fast passes
+	each listing to prefetch(), and worker threads then read the
+	subdirectories (with rpath.scan_dir, which also gets the stat
+	data), and the subdirectories of those, while the walk goes on.
+	get() returns a listing read ahead, waiting for it if necessary.
+
+	Workers always read the pending directory with the lowest index,
+	which is the one the walk will need first.  The walk itself and
+	its selection calls are unchanged, so rpaths are iterated in the
+	same sorted order.  At most max_listings directories are kept or
+	being read at once.  Since get() is called in index order, every
+	listing with a lower index than the one asked for won't be used,
+	for instance because the directory was excluded, and is dropped.
+
+	If given, dir_filter (usually Select.may_descend) is called on
+	each subdirectory before it is queued, so excluded trees like
+	/proc are not read at all.
+
+	"""
+	def __init__(self, num_threads, max_listings, dir_filter = None):
+		self.max_listings = max_listings
+		self.dir_filter = dir_filter
+		self.lock = threading.Condition()
+		self.slots = {} # index -> [done event, rpath, listing]
+		self.indicies = [] # sorted indicies of slots
+		self.pending = [] # sorted indicies of slots not being read yet
+		self.closed = None
+		for i in range(num_threads):
+			thread = threading.Thread(target = self.worker)
+			thread.setDaemon(1)
+			thread.start()
+
+	def worker(self):
+		"""Read pending directories until closed"""
+		while 1:
+			self.lock.acquire()
+			try:
+				while not self.pending and not self.closed: self.lock.wait()
+				if self.closed: return
+				index = self.pending.pop(0)
+				slot = self.slots[index]
+			finally: self.lock.release()
+
+			try:
+				listing = rpath.scan_dir(slot[1])
+				if listing: subdirs = self.get_subdirs(slot[1], listing)
+			except Exception: listing = None # listed again when needed
+			self.lock.acquire()
+			try:
+				slot[2] = listing
+				if listing and self.slots.has_key(index):
+					self.add_subdirs(subdirs)
+			finally: self.lock.release()
+			slot[0].set()
+
+	def get_subdirs(self, dir_rp, listing):
+		"""Return list of rpaths of the subdirectories in listing to read"""
+		subdirs = []
+		for filename, data in listing:
+			if len(subdirs) >= self.max_listings: break
+			if not data or data['type'] != 'dir': continue
+			subdir_rp = dir_rp.append_with_data(filename, data)
+			if self.dir_filter and not self.dir_filter(subdir_rp): continue
+			subdirs.append(subdir_rp)
+		return subdirs
+
+	def add_subdirs(self, subdirs):
+		"""Add slots for the rpaths in subdirs, lock must be held"""
+		for subdir_rp in subdirs:
+			if len(self.slots) >= self.max_listings: break
+			index = subdir_rp.index
+			if self.slots.has_key(index): continue
+			self.slots[index] = [threading.Event(), subdir_rp, None]
+			bisect.insort(self.indicies, index)
+			bisect.insort(self.pending, index)
+			self.lock.notify()
+
+	def prefetch(self, dir_rp, listing):
+		"""Start reading the subdirectories in listing of dir_rp"""
+		subdirs = self.get_subdirs(dir_rp, listing)
+		self.lock.acquire()
+		try: self.add_subdirs(subdirs)
+		finally: self.lock.release()
+
+	def get(self, dir_rp):
+		"""Return listing of dir_rp, or None if it isn't being read"""
+		index = dir_rp.index
+		self.lock.acquire()
+		try:
+			i = bisect.bisect_left(self.indicies, index)
+			for old_index in self.indicies[:i]: del self.slots[old_index]
+			del self.indicies[:i]
+			del self.pending[:bisect.bisect_left(self.pending, index)]
+
+			slot = self.slots.get(index)
+			if not slot: return None
+			del self.slots[index]
+			del self.indicies[0]
+			if self.pending and self.pending[0] == index:
+				del self.pending[0] # not started, quicker to list it now
+				return None
+		finally: self.lock.release()
+		slot[0].wait()
+		return slot[2]
+
+	def close(self):
+		"""Drop all listings and stop the worker threads"""
+		self.lock.acquire()
+		try:
+			self.closed = 1
+			self.slots, self.indicies, self.pending = {}, [], []
+			self.lock.notifyAll()
+		finally: self.lock.release()
+
+
+class SelectionIndex:
+	"""Find the selection functions that may match an rpath
+
+	With thousands of include and exclude options, Select would try
+	thousands of selection functions on every file.  But most are
+	tuple or glob selection functions with an index attribute (see
+	Select.glob_get_index): they can only match rpaths whose index
+	starts with sf.index, and only includes can match rpaths whose
+	index is an initial part of sf.index.  So here these functions
+	are put in a tree of path components, and get_functions walks
+	down the rpath's index to collect the ones which may match, plus
+	all functions without an index, in their original order.
+
+	Because the functions skipped would all have returned None, and
+	the others are still called in order, Select's results (including
+	the first-match-wins order and scanning) are the same.
+
+	"""
+	# Below this many selection functions, just try them all
+	min_functions = 16
+
+	def __init__(self, sel_funcs):
+		"""Build the index trees from list of selection functions"""
+		self.sel_funcs = sel_funcs
+		self.active = len(sel_funcs) >= self.min_functions
+		if not self.active: return
+		self.unindexed = []
+		# Tuple selection functions match rp.index, globs match rp.path,
+		# which for QuotedRPaths has the quoted index
+		self.tuple_root, self.quoted_root = {}, {}
+		for i in range(len(sel_funcs)):
+			sf = sel_funcs[i]
+			index = getattr(sf, 'index', None)
+			if index is None: self.unindexed.append(i)
+			elif sf.quoted: self.add(self.quoted_root, i, sf)
+			else: self.add(self.tuple_root, i, sf)
+		self.trim(self.tuple_root)
+		self.trim(self.quoted_root)
+
+	def add(self, node, i, sf):
+		"""Add sel_funcs[i] to tree starting at node
+
+		Each node is a dictionary mapping path components to nodes.
+		The key None holds the numbers of the functions whose index
+		ends at the node, and "" the includes whose index goes past
+		it.  (Neither can be a path component.)
+
+		"""
+		for comp in sf.index:
+			if sf.include: node.setdefault("", []).append(i)
+			node = node.setdefault(comp, {})
+		node.setdefault(None, []).append(i)
+
+	def trim(self, node):
+		"""Cut lists of includes after the first definite one
+
+		An include tuple function matches any rpath whose index is an
+		initial part of its own, so after it later functions can't
+		change the result.
+
+		"""
+		for key, value in node.items():
+			if key == "":
+				for j in range(len(value)):
+					if getattr(self.sel_funcs[value[j]], 'definite', None):
+						del value[j+1:]
+						break
+			elif key is not None: self.trim(value)
+
+	def get_functions(self, rp):
+		"""Return list of the selection functions that may match rp"""
+		nums = self.unindexed + self.get_nums(self.tuple_root, rp.index)
+		quoted_index = getattr(rp, 'quoted_index', rp.index)
+		nums.extend(self.get_nums(self.quoted_root, quoted_index))
+		nums.sort()
+		sel_funcs = self.sel_funcs
+		return [sel_funcs[i] for i in nums]
+
+	def get_nums(self, node, index):
+		"""Return numbers of functions in tree at node that may match"""
+		nums = node.get(None, [])[:]
+		for comp in index:
+			node = node.get(comp)
+			if node is None: return nums
+			nums.extend(node.get(None, []))
+		nums.extend(node.get("", []))
+		return nums
+
+
 class FilterIter:
 	"""Filter rorp_iter using a Select object, removing excluded rorps"""
 	def __init__(self, select, rorp_iter):
@@ -0,0 +1,148 @@
+# Copyright 2002, 2003 Ben Escoto
+#
+# This file is part of rdiff-backup.
+#
+# rdiff-backup is free software; you can redistribute it and/or modify
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# rdiff-backup is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rdiff-backup; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307
+# USA
+
+"""Keep the signatures of large mirror files between sessions
+
+Before a changed file is backed up, the destination sends the source
+a signature of the mirror file, which means reading all of it.  For
+large files that change a little every time, like databases and disk
+images, this doubles what the destination reads.  So when a mirror
+file of at least Globals.signature_cache_min_size bytes is written,
+its signature is made from the same data and stored in
+rdiff-backup-data/signatures.  In the next session the stored
+signature is used instead, as long as the mirror file's size, mtime,
+ctime and inode, and its SHA1 in the metadata, are still the same.
+
+The stored signatures are limited to Globals.signature_cache_size
+bytes in all.  At the end of a session the least recently used ones
+are deleted until they fit.
+
+"""
+
+import os, re
+import Globals, log, rpath, robust, librsync, Rdiff, TempFile, hash
+
+# Name of the directory in rdiff-backup-data holding the signatures
+sig_dir_name = "signatures"
+
+# Signature files are named by the SHA1 of the index of their file
+sig_name_re = re.compile("^[0-9a-f]{40}$")
+
+# RPath of the signature directory, set on first use in a session
+sig_dir_rp = None
+
+# Number of signatures used, looked for but not usable, and stored
+hits = misses = stores = 0
+
+def is_cached_size(size):
+	"""True if a mirror file of given size should have its signature kept"""
+	return (Globals.signature_cache_size > 0 and
+			size >= Globals.signature_cache_min_size)
+
+def get_sig_dir():
+	"""Return rpath of the signature directory, creating it if necessary"""
+	global sig_dir_rp
+	if not sig_dir_rp:
+		sig_dir_rp = Globals.rbdir.append(sig_dir_name)
+		if not sig_dir_rp.isdir(): sig_dir_rp.mkdir()
+	return sig_dir_rp
+
+def get_sig_rp(index):
+	"""Return rpath of the stored signature of the file with given index"""
+	return get_sig_dir().append(hash.sha.new("/".join(index)).hexdigest())
+
+def get_key(mirror_rp, sha1):
+	"""Return first line of a signature file, which says when it is good"""
+	return "%d %d %d %d %s\n" % (mirror_rp.getsize(), mirror_rp.getmtime(),
+								 mirror_rp.getctime(), mirror_rp.getinode(),
+								 sha1)
+
+def get_generator(rorp):
+	"""Return SigGenerator for a new mirror file like rorp, or None
+
+	The signature made will be the same as Rdiff.get_signature's of
+	the finished file.
+
+	"""
+	if not rorp.isreg() or not is_cached_size(rorp.getsize()): return None
+	return librsync.SigGenerator(Rdiff.find_blocksize(rorp.getsize()))
+
+def get_signature(mirror_rp, mirror_rorp):
+	"""Return file object with stored signature of mirror_rp, or None
+
+	mirror_rorp is the mirror file as recorded in the metadata.  Its
+	SHA1 must be the one the signature was stored with.
+
+	"""
+	global hits, misses
+	if not is_cached_size(mirror_rp.getsize()) or not mirror_rorp.has_sha1():
+		return None
+	sig_rp = get_sig_rp(mirror_rorp.index)
+	if not sig_rp.isreg():
+		misses += 1
+		return None
+	fp = sig_rp.open("rb")
+	if fp.readline() != get_key(mirror_rp, mirror_rorp.get_sha1()):
+		fp.close()
+		misses += 1
+		return None
+	log.Log("Using stored signature of " + mirror_rp.get_indexpath(), 7)
+	try: os.utime(sig_rp.path, None) # mark as recently used
+	except (IOError, OSError): pass
+	hits += 1
+	return fp
+
+def store(index, mirror_rp, sha1, sig):
+	"""Store signature string sig of mirror_rp, whose data has given SHA1"""
+	global stores
+	mirror_rp.setdata() # renaming into place changed the ctime
+	if not mirror_rp.isreg(): return
+	try:
+		tf = TempFile.new_in_dir(get_sig_dir())
+		tf.write_string(get_key(mirror_rp, sha1) + sig)
+		rpath.rename(tf, get_sig_rp(index))
+	except (IOError, OSError), exc:
+		log.Log("Unable to store signature of %s: %s" %
+				(mirror_rp.get_indexpath(), exc), 2)
+		return
+	stores += 1
+
+def close():
+	"""Trim the stored signatures to Globals.signature_cache_size"""
+	global sig_dir_rp, hits, misses, stores
+	sig_dir_rp = Globals.rbdir.append(sig_dir_name)
+	if sig_dir_rp.isdir():
+		log.Log("Signatures: %d stored ones used, %d missing or out of "
+				"date, %d stored" % (hits, misses, stores), 5)
+		prune(Globals.signature_cache_size)
+	sig_dir_rp = None
+	hits = misses = stores = 0
+
+def prune(max_size):
+	"""Delete least recently used signatures until under max_size bytes
+
+	Anything in the directory not named like a signature is a temp
+	file left by an interrupted write.
+
+	"""
+	def get_entry_key(rp):
+		filename = rp.dirsplit()[1]
+		if sig_name_re.match(filename): return filename
+		return None
+	robust.prune_lru_dir(sig_dir_rp, max_size, get_entry_key, "signature")
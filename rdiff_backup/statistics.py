@@ -376,7 +376,7 @@ class FileStats:
 		cls._fileobj.write("# Format of each line in file statistics file:")
 		cls._fileobj.write(cls._line_sep)
 		cls._fileobj.write("# Filename Changed SourceSize MirrorSize "
-						   "IncrementSize" + cls._line_sep)
+						   "IncrementSize IncrementCompression" + cls._line_sep)
 
 	def update(cls, source_rorp, dest_rorp, changed, inc):
 		"""Update file stats with given information"""
@@ -385,7 +385,8 @@ class FileStats:
 		filename = metadata.quote_path(filename)
 
 		size_list = map(cls.get_size, [source_rorp, dest_rorp, inc])
-		line = " ".join([filename, str(changed)] + size_list)
+		line = " ".join([filename, str(changed)] + size_list +
+						[cls.get_compression(inc)])
 		cls.line_buffer.append(line)
 		if len(cls.line_buffer) >= 100: cls.write_buffer()
 
@@ -395,6 +396,21 @@ class FileStats:
 		if rorp.isreg(): return str(rorp.getsize())
 		else: return "0"
 
+	def get_compression(cls, inc):
+		"""Return how the data in inc was stored
+
+		This is the compression suffix, "raw" if the data was sampled
+		and left uncompressed because it hardly compressed (see
+		increment.iscompressible), "none" if it was not compressed for
+		another reason, and "NA" if there is no snapshot or diff.
+
+		"""
+		if not inc or not inc.isreg() or not inc.isincfile(): return "NA"
+		if inc.getinctype() not in ("snapshot", "diff"): return "NA"
+		if inc.isinccompressed(): return inc.isinccompressed()
+		if inc.incompressible: return "raw"
+		return "none"
+
 	def write_buffer(cls):
 		"""Write buffer to file because buffer is full
 
@@ -1,6 +1,7 @@
-import unittest
+import unittest, cStringIO, re
 from commontest import *
-from rdiff_backup import Globals, SetConnections, user_group
+from rdiff_backup import Globals, SetConnections, user_group, rpath, backup, \
+	 Rdiff, hash, iterfile, Time, Hardlink
 
 class RemoteMirrorTest(unittest.TestCase):
 	"""Test mirroring"""
@@ -27,4 +28,269 @@ class RemoteMirrorTest(unittest.TestCase):
 						  'testfiles/increment3', 'testfiles/increment4'])
 
 
+class RemoteBackupTest(unittest.TestCase):
+	"""Test whole backups and restores through rdiff-backup --server"""
+	def testBackupRestore(self):
+		"""Remote backup and restore finish, logging stat counts"""
+		out = rpath.RPath(Globals.local_connection, "testfiles/output")
+		re_init_dir(out)
+		src = out.append("src")
+		src.mkdir()
+		src.append("file").write_string("data")
+		rdiff_backup(1, 0, "testfiles/output/src", "testfiles/output/dest",
+					 10000, "-v5")
+		src.append("file2").write_string("more data")
+		rdiff_backup(0, 1, "testfiles/output/src", "testfiles/output/dest",
+					 20000, "-v5")
+		rdiff_backup(1, 0, "testfiles/output/dest",
+					 "testfiles/output/restore", None, "-v5 -r 10000")
+		restore = out.append("restore")
+		assert restore.listdir() == ["file"], restore.listdir()
+		assert restore.append("file").get_data() == "data"
+
+
+class SyncBatchTest(unittest.TestCase):
+	"""Test delaying mirror changes until increments are synced"""
+	def setUp(self):
+		self.out = rpath.RPath(Globals.local_connection, "testfiles/output")
+		re_init_dir(self.out)
+		self.incs = []
+		for i in range(5):
+			inc = self.out.append("inc%d" % i)
+			inc.touch()
+			self.incs.append(inc)
+		self.done = []
+
+	def add(self, batch, i):
+		batch.add((str(i),), self.incs[i], lambda: self.done.append(i))
+
+	def testBatchSize(self):
+		"""Actions run in order once batch_size increments are queued"""
+		batch = backup.SyncBatch(3, 1000)
+		self.add(batch, 0)
+		self.add(batch, 1)
+		assert not self.done
+		assert batch.is_pending(("1",)) and not batch.is_pending(("",))
+		batch.add(("1", "a"), None, lambda: self.done.append("dir"))
+		assert not self.done
+		self.add(batch, 2)
+		assert self.done == [0, 1, "dir", 2], self.done
+		assert not batch.is_pending(("3",))
+		batch.add(("3",), None, lambda: self.done.append(3))
+		assert self.done[-1] == 3
+
+	def testBatchTime(self):
+		"""A batch is flushed when it gets too old"""
+		batch = backup.SyncBatch(1000, 0)
+		self.add(batch, 0)
+		assert self.done == [0]
+
+	def testUnbatched(self):
+		"""With a batch size of 1 each increment is fsync'd alone"""
+		batch = backup.SyncBatch(1, 1000)
+		for i in range(3): self.add(batch, i)
+		assert self.done == [0, 1, 2]
+
+	def testSyncFallback(self):
+		"""rpath.sync_files fsyncs the files without C.syncfs"""
+		def syncfs(fd): raise NotImplementedError("no syncfs")
+		orig_syncfs = rpath.C.syncfs
+		rpath.C.syncfs = syncfs
+		try:
+			batch = backup.SyncBatch(2, 1000)
+			for i in range(4): self.add(batch, i)
+		finally: rpath.C.syncfs = orig_syncfs
+		assert self.done == [0, 1, 2, 3]
+
+
+class DeltaPoolTest(unittest.TestCase):
+	"""Test making deltas ahead of time in worker threads"""
+	def setUp(self):
+		self.out = rpath.RPath(Globals.local_connection, "testfiles/output")
+		re_init_dir(self.out)
+
+	def get_sig_rorp(self, basis_rp):
+		"""Return rorp with the signature of basis_rp attached"""
+		sig_fp = Rdiff.get_signature(basis_rp)
+		sig_rorp = rpath.RORPath(basis_rp.index)
+		sig_rorp.setfile(cStringIO.StringIO(sig_fp.read()))
+		assert not sig_fp.close()
+		return sig_rorp
+
+	def testDeltas(self):
+		"""Spooled deltas and hashes match those made directly"""
+		pool = backup.DeltaPool(2, 50000)
+		jobs = []
+		for i in range(6):
+			basis_rp = self.out.append("basis%d" % i)
+			basis_rp.write_string("%d basis\n" % i * 10000)
+			new_rp = self.out.append("new%d" % i)
+			new_rp.write_string("%d new\n" % i * (i * 5000))
+			spool = pool.get_delta_sigrp_hash(self.get_sig_rorp(basis_rp),
+											  new_rp)
+			jobs.append((spool, basis_rp, new_rp))
+		for spool, basis_rp, new_rp in jobs:
+			delta_fp = Rdiff.get_delta_sigrp_hash(self.get_sig_rorp(basis_rp),
+												  new_rp)
+			assert spool.read(10) + spool.read() == delta_fp.read()
+			assert (spool.close().sha1_digest ==
+					delta_fp.close().sha1_digest == hash.compute_sha1(new_rp))
+		assert pool.buffer_used == 0, pool.buffer_used
+		pool.close()
+
+	def testReadAhead(self):
+		"""Diffs come out in order, and not read past a flush marker"""
+		pool = backup.DeltaPool(1, 1000)
+		pool.max_diffs = 5
+		num_read = [0]
+		def diff_iter():
+			for i in range(20):
+				num_read[0] += 1
+				if i % 8 == 7: yield iterfile.MiscIterFlush
+				else: yield rpath.RORPath((str(i),))
+		result = []
+		for diff in pool.read_ahead(diff_iter()):
+			if diff is iterfile.MiscIterFlush: result.append("flush")
+			else:
+				result.append(int(diff.index[0]))
+				assert num_read[0] <= result[-1] + 5 and \
+					   num_read[0] <= (result[-1] // 8 + 1) * 8, \
+					   (result, num_read)
+		assert result == [0, 1, 2, 3, 4, 5, 6, "flush", 8, 9, 10, 11, 12,
+						  13, 14, "flush", 16, 17, 18, 19], result
+		pool.close()
+
+
+class IncrementPoolTest(unittest.TestCase):
+	"""Test making increments in worker threads"""
+	def setUp(self):
+		self.out = rpath.RPath(Globals.local_connection, "testfiles/output")
+		re_init_dir(self.out)
+		Time.setcurtime(1000000000)
+		Time.setprevtime(999424113)
+		Globals.no_compression_regexp = \
+			re.compile(Globals.no_compression_regexp_string, re.I)
+		self.done = []
+
+	def add(self, pool, i, threaded = 1, inc_dir = ()):
+		"""Queue increment of mirror file i (missing if i is 3)"""
+		new_rp = self.out.append("new%d" % i)
+		new_rp.write_string("%d new\n" % i * 1000)
+		mirror_rp = self.out.append("mirror%d" % i)
+		if i != 3: mirror_rp.write_string("%d old\n" % i * 1000)
+		incpref = self.out.new_index(inc_dir + ("inc%d" % i,))
+		def finish(get_inc):
+			try: self.done.append((i, get_inc()))
+			except EnvironmentError: self.done.append((i, "error"))
+		pool.add((str(i),), (new_rp, mirror_rp, incpref), finish, threaded)
+
+	def testOrder(self):
+		"""Increments are finished in order, with directory actions"""
+		pool = backup.IncrementPool(3)
+		for i in range(4): self.add(pool, i)
+		pool.add_action(("4",), lambda: self.done.append((4, "dir")))
+		self.add(pool, 5, None)
+		pool.flush()
+		assert not pool.is_pending(("5",))
+		pool.close()
+
+		assert [i for i, inc in self.done] == range(6), self.done
+		for i, inc in self.done[:3] + self.done[5:]:
+			assert ".diff" in inc.path and inc.getsize() > 0, inc
+		assert self.done[3][1].path.endswith(".missing"), self.done
+
+	def testError(self):
+		"""An exception in a worker is raised when the job is finished"""
+		pool = backup.IncrementPool(1)
+		self.add(pool, 0, inc_dir = ("missing_dir",))
+		self.add(pool, 1)
+		pool.flush()
+		pool.close()
+		assert self.done[0] == (0, "error"), self.done
+		assert self.done[1][0] == 1 and self.done[1][1].lstat()
+
+
+class RenameDetectorTest(unittest.TestCase):
+	"""Test finding the old mirror files of renamed files"""
+	def setUp(self):
+		out = rpath.RPath(Globals.local_connection, "testfiles/output")
+		re_init_dir(out)
+		self.mirror = rpath.RPath(Globals.local_connection,
+								  "testfiles/output/mirror")
+		self.mirror.mkdir()
+		Globals.rbdir = out.append("rdiff-backup-data")
+		Globals.rbdir.mkdir()
+		self.old_min_size = Globals.rename_min_size
+		Globals.rename_min_size = 10
+
+	def tearDown(self):
+		Globals.rename_min_size = self.old_min_size
+
+	def make_mirror(self, name, inode, size = 100):
+		"""Write mirror file, return its rorp with given source inode"""
+		rp = self.mirror.append(name)
+		rp.write_string(name[0] * size)
+		rorp = rp.getRORPath()
+		rorp.set_data_item('inode', inode)
+		rorp.set_data_item('devloc', 5)
+		return rorp
+
+	def get_source(self, name, old_rorp):
+		"""Return source rorp of old_rorp renamed to name"""
+		src_rorp = old_rorp.getRORPath()
+		src_rorp.index = (name,)
+		return src_rorp
+
+	def testRenames(self):
+		"""Renamed files get old mirror file as basis, held if replaced"""
+		gone = self.make_mirror("b_gone", 1)
+		kept = self.make_mirror("c_kept", 2)
+		deleted = self.make_mirror("x_deleted", 6)
+		late = self.make_mirror("z_late", 3)
+		small = self.make_mirror("small", 4, 5)
+		source_keys = {}
+		for rorp in (gone, kept, late):
+			source_keys[Hardlink.get_inode_key(rorp)] = (rorp.getsize(),
+														 rorp.getmtime())
+		detector = backup.RenameDetector(self.mirror,
+				iter([gone, kept, small, deleted, late]), source_keys)
+		assert len(detector.moved) == 3, detector.moved
+		detector.add_mirror(None, gone, 1)
+		detector.add_mirror(kept, kept, 1) # changed in place
+		detector.add_mirror(None, deleted, 1) # not moved, so not held
+		self.mirror.append("b_gone").delete()
+		hold_dir_rp = Globals.rbdir.append(detector.hold_dir_name)
+		assert len(hold_dir_rp.listdir()) == 1
+
+		old_rorp, basis_rp = detector.find_basis(self.get_source("d", gone))
+		assert old_rorp.index == ("b_gone",) and old_rorp.isreg()
+		assert basis_rp.get_data() == "b" * 100, basis_rp
+		assert not detector.find_basis(self.get_source("d2", gone))
+		touched = self.get_source("g", late)
+		touched.set_data_item('mtime', late.getmtime() + 1)
+		assert not detector.find_basis(touched)
+		old_rorp, basis_rp = detector.find_basis(self.get_source("a", late))
+		assert old_rorp.index == ("z_late",) and basis_rp.index == ("z_late",)
+		detector.add_mirror(None, late, 1) # already used, so not held
+		assert len(hold_dir_rp.listdir()) == 1
+		assert not detector.find_basis(self.get_source("e", kept))
+		assert not detector.find_basis(self.get_source("f", small))
+
+		detector.set_basis(("d",), basis_rp)
+		assert detector.pop_basis(("d",)) is basis_rp
+		assert not detector.pop_basis(("d",))
+		detector.close()
+		assert not Globals.rbdir.append(detector.hold_dir_name).lstat()
+
+	def testUnchangedInode(self):
+		"""Metadata of unchanged files gets the source inode"""
+		dest_rorp = rpath.RORPath(("file",), {'type': 'reg', 'size': 100})
+		src_rorp = self.make_mirror("file", 7)
+		metadata_rorp = backup.get_unchanged_rorp(src_rorp, dest_rorp)
+		assert metadata_rorp is not dest_rorp and not dest_rorp.has_inode()
+		assert metadata_rorp.getinode() == 7, metadata_rorp
+		assert backup.get_unchanged_rorp(src_rorp,
+										 metadata_rorp) is metadata_rorp
+
+
 if __name__ == "__main__": unittest.main()
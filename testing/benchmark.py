@@ -117,12 +117,345 @@ def nested_files_rsync():
 	create_nested("testfiles/nested_out", "e", depth)
 	print "Update changed rsync: %ss" % (run_cmd(rsync_command),)
 
+def metadata_parsing():
+	"""Time reading 1000000 records from a mirror_metadata file
+
+	Records are parsed both the old way, one Record2RORP call per
+	record, and with C.parse_metadata.  The file is not compressed so
+	the time spent in gzip doesn't hide the difference.
+
+	"""
+	from rdiff_backup import metadata
+	count = 1000000
+	out_rp = rpath.RPath(Globals.local_connection, output_desc)
+	out_rp.mkdir()
+	meta_rp = out_rp.append("mirror_metadata.2005-11-03T14:51:06-06:00."
+							"snapshot")
+	fp = meta_rp.open("wb")
+	for i in xrange(count):
+		fp.write("File dir%d/file%d\n  Type reg\n  Size %d\n"
+				 "  ModTime 1130000000\n  Uid 1000\n  Uname ben\n"
+				 "  Gid 1000\n  Gname ben\n  Permissions 420\n" %
+				 (i / 1000, i % 1000, i))
+	assert not fp.close()
+
+	def time_iter(desc, get_iter):
+		fp = meta_rp.open("rb")
+		t = time.time()
+		i = 0
+		for rorp in get_iter(metadata.RorpExtractor(fp)): i += 1
+		t = time.time() - t
+		assert i == count, i
+		print "%s: %d records in %.2fs, %d records/s" % (desc, i, t, i/t)
+
+	time_iter("Record2RORP per record", metadata.FlatExtractor.iterate)
+	time_iter("C.parse_metadata", metadata.RorpExtractor.iterate)
+	meta_rp.delete()
+
+def compression_codecs():
+	"""Compare backup time and increment size for each codec and level
+
+	The source is backed up, every file is changed, and then the timed
+	backup writes one increment per file.  Half the files are text and
+	half are random, so both compressible and incompressible data are
+	included.
+
+	"""
+	count, size = 200, 64 * 1024
+	def write_source(s):
+		dir_rp = rpath.RPath(Globals.local_connection, "testfiles/codec_out")
+		if not dir_rp.lstat(): dir_rp.mkdir()
+		for i in xrange(count):
+			if i % 2: data = os.urandom(size)
+			else: data = ("%s line %d of file %d\n" % (s, i, i)) * \
+						 (size / 30)
+			rp = dir_rp.append(str(i))
+			if rp.lstat(): rp.delete()
+			rp.write_string(data)
+
+	def get_size(dirname):
+		total = 0
+		for dirpath, dirnames, filenames in os.walk(dirname):
+			for filename in filenames:
+				total += os.lstat(os.path.join(dirpath, filename)).st_size
+		return total
+
+	results = []
+	for codec, levels in [("store", [None]), ("gzip", [1, 6, 9]),
+						  ("bz2", [1, 9]), ("lzma", [1, 6])]:
+		for level in levels:
+			if codec != "store" and not rpath.compression_codecs[codec][1]:
+				print "Skipping %s, Python module not found" % (codec,)
+				continue
+			options = "--compression-codec " + codec
+			if level: options += " --compression-level %d" % (level,)
+			Myrm(output_desc)
+			Myrm("testfiles/codec_out")
+			write_source("old")
+			run_cmd("rdiff-backup %s testfiles/codec_out %s" %
+					(options, output_desc))
+			write_source("new")
+			t = run_cmd("rdiff-backup --current-time %d %s "
+						"testfiles/codec_out %s" % (time.time() + 10, options,
+													output_desc))
+			results.append((codec, level, t, get_size(
+				output_desc + "/rdiff-backup-data/increments")))
+
+	print "codec  level  backup time  increments size"
+	for codec, level, t, inc_size in results:
+		print "%-6s %5s  %10.2fs  %15d" % (codec, level or "-", t, inc_size)
+	Myrm("testfiles/codec_out")
+
+def selection_rules():
+	"""Time selecting 10000 nested files with many include/exclude rules
+
+	Half the rules are plain filenames and half are globs, spread
+	over the tree.  Files/second are printed with selection functions
+	tried one by one, and with a SelectionIndex.
+
+	"""
+	from rdiff_backup import selection
+	depth = 4
+	create_nested("testfiles/nested_out", "a", depth)
+	root = rpath.RPath(Globals.local_connection, "testfiles/nested_out")
+	rps = list(selection.Select(root).set_iter())
+
+	for count in (100, 1000, 5000):
+		tuplelist = []
+		for i in xrange(count):
+			path = "/".join(map(str, [(i * 7 + j) % 10 for j in range(3)]))
+			if i % 2: path = path[:-1] + "*[0-4]"
+			if i % 3: opt = "--exclude"
+			else: opt = "--include"
+			tuplelist.append((opt, "testfiles/nested_out/%d/%s" %
+							  (i % 10, path)))
+		tuplelist.append(("--exclude", "**"))
+
+		for desc, min_functions in (("linear", sys.maxint),
+									("indexed", 0)):
+			selection.SelectionIndex.min_functions = min_functions
+			sel = selection.Select(root)
+			sel.ParseArgs(tuplelist, [])
+			t = time.time()
+			for rp in rps: sel.Select(rp)
+			t = time.time() - t
+			print "%d rules, %s: %d files in %.2fs, %d files/s" % \
+				  (count, desc, len(rps), t, len(rps) / t)
+	Myrm("testfiles/nested_out")
+
+def deep_tree_scan():
+	"""Time iterating a 10 level deep tree with and without C.scan_dir
+
+	The tree has two subdirectories and five files in each directory,
+	about 1000 directories and 5000 files in all.
+
+	"""
+	from rdiff_backup import selection
+	def helper(rp, depth):
+		rp.mkdir()
+		for i in range(5): rp.append("file%d" % i).write_string("a")
+		if depth > 1:
+			for i in range(2): helper(rp.append("dir%d" % i), depth - 1)
+
+	Myrm("testfiles/deep_out")
+	root = rpath.RPath(Globals.local_connection, "testfiles/deep_out")
+	helper(root, 10)
+
+	scan_dir = rpath.scan_dir
+	for desc, func in (("listdir and lstat", lambda rp: None),
+					   ("C.scan_dir", scan_dir)):
+		rpath.scan_dir = func
+		for i in range(3):
+			t = time.time()
+			count = len(list(selection.Select(root).set_iter()))
+			t = time.time() - t
+			print "%s: %d files in %.2fs, %d files/s" % \
+				  (desc, count, t, count / t)
+	rpath.scan_dir = scan_dir
+	Myrm("testfiles/deep_out")
+
+def walker_prefetch():
+	"""Time walking a tree where each listing takes 5ms, like on NFS
+
+	The tree has 511 directories, and listings are read ahead with 0,
+	2, 4 and 8 threads.
+
+	"""
+	from rdiff_backup import selection, C
+	def helper(rp, depth):
+		rp.mkdir()
+		for i in range(5): rp.append("file%d" % i).write_string("a")
+		if depth > 1:
+			for i in range(2): helper(rp.append("dir%d" % i), depth - 1)
+
+	Myrm("testfiles/deep_out")
+	root = rpath.RPath(Globals.local_connection, "testfiles/deep_out")
+	helper(root, 9)
+
+	c_scan_dir = C.scan_dir
+	def slow_scan_dir(path):
+		time.sleep(0.005)
+		return c_scan_dir(path)
+	C.scan_dir = slow_scan_dir
+	for threads in (0, 2, 4, 8):
+		Globals.walker_threads = threads
+		t = time.time()
+		count = len(list(selection.Select(root).set_iter()))
+		t = time.time() - t
+		print "%d threads: %d files in %.2fs, %d files/s" % \
+			  (threads, count, t, count / t)
+	C.scan_dir = c_scan_dir
+	Globals.walker_threads = 0
+	Myrm("testfiles/deep_out")
+
+def huge_directory():
+	"""Time walking a directory of 300000 files, and its peak memory
+
+	Each walk runs in a forked process, so ru_maxrss only counts that
+	walk.  The run size is 0 (sort everything in memory), 100000, and
+	the default.
+
+	"""
+	import resource
+	from rdiff_backup import selection
+	Myrm("testfiles/huge_out")
+	root = rpath.RPath(Globals.local_connection, "testfiles/huge_out")
+	root.mkdir()
+	for i in range(300000):
+		os.close(os.open("testfiles/huge_out/file%d" % i, os.O_CREAT, 0600))
+
+	for run_size in (0, 100000, Globals.listdir_run_size):
+		pid = os.fork()
+		if not pid:
+			Globals.listdir_run_size = run_size
+			t = time.time()
+			count = 0
+			for rp in selection.Select(root).set_iter(): count += 1
+			t = time.time() - t
+			print "run size %d: %d files in %.2fs, peak memory %d KB" % \
+				  (run_size, count, t,
+				   resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+			os._exit(0)
+		os.waitpid(pid, 0)
+	Myrm("testfiles/huge_out")
+
+def rorp_memory():
+	"""Measure the memory used by keeping 500000 RORPaths
+
+	The RORPaths are made from metadata records, like the ones read
+	from mirror_metadata, and kept in a list.  A separate process holds
+	them while find-max-ram.py watches its RSS.
+
+	"""
+	count = 500000
+	script = "testfiles/rorp_memory_child.py"
+	fp = open(script, "w")
+	fp.write("""import time
+from rdiff_backup import rpath
+rorps = []
+for i in xrange(%d):
+	rorps.append(rpath.RORPath(('dir%%d' %% (i / 1000), 'file%%d' %% i),
+		{'type': 'reg', 'size': long(i), 'perms': 0644, 'uid': 1000,
+		 'gid': 1000, 'uname': 'user', 'gname': 'group', 'inode': long(i),
+		 'devloc': 2049L, 'nlink': 1, 'mtime': 1200000000L,
+		 'atime': 1200000000L, 'ctime': 1200000000L, 'sha1': '0' * 40}))
+time.sleep(2)
+""" % (count,))
+	assert not fp.close()
+
+	# The brackets keep find-max-ram.py from counting itself
+	ram_fp = os.popen("python find-max-ram.py 'rorp_memory_chil[d]'")
+	t = run_cmd("python " + script)
+	max_rss = int(ram_fp.readlines()[-1])
+	assert not ram_fp.close()
+	os.unlink(script)
+	print "%d RORPaths: %.2fs, peak memory %d KB, %d bytes per RORPath" % \
+		  (count, t, max_rss, max_rss * 1024 / count)
+
+def collate_interning():
+	"""Time collating a tree with its metadata, and peak memory
+
+	The tree has 200 directories of 1000 files.  Its metadata is
+	written to a file, and then in a forked process the tree is walked
+	and collated with the metadata read back, like
+	DestinationStruct.get_sigs does.  Every collated index is kept, as
+	the caches and hardlink dictionaries keep some.  To compare with
+	older code, run this with PYTHONPATH pointing at it.
+
+	"""
+	import resource
+	from rdiff_backup import selection, metadata, rorpiter
+	Myrm("testfiles/collate_out")
+	root = rpath.RPath(Globals.local_connection, "testfiles/collate_out")
+	root.mkdir()
+	for i in range(200):
+		dir_rp = root.append("directory%d" % i)
+		dir_rp.mkdir()
+		for j in range(1000):
+			os.close(os.open("%s/file%d" % (dir_rp.path, j),
+							 os.O_CREAT, 0600))
+	meta_rp = rpath.RPath(Globals.local_connection, "testfiles/"
+				"mirror_metadata.2005-11-03T14:51:06-06:00.snapshot")
+	mf = metadata.MetadataFile(meta_rp, 'w', check_path = 0, compress = 0)
+	for rp in selection.Select(root).set_iter(): mf.write_object(rp)
+	mf.close()
+
+	pid = os.fork()
+	if not pid:
+		mf = metadata.MetadataFile(meta_rp, 'r', check_path = 0,
+								   compress = 0)
+		t = time.time()
+		indicies = []
+		for src_rorp, dest_rorp in rorpiter.Collate2Iters(
+				selection.Select(root).set_iter(), mf.get_objects()):
+			assert src_rorp and dest_rorp
+			indicies.append((src_rorp.index, dest_rorp.index))
+		t = time.time() - t
+		print "%d files collated in %.2fs, %d files/s, peak memory %d KB" % \
+			  (len(indicies), t, len(indicies) / t,
+			   resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+		os._exit(0)
+	os.waitpid(pid, 0)
+	meta_rp.delete()
+	Myrm("testfiles/collate_out")
+
+def kernel_copy():
+	"""Time copying 50 files of 8MB with and without C.copy_fd
+
+	Each way, the files are copied as rpath.copy does for snapshots,
+	and again through hash.FileWrapper as when the mirror is written.
+
+	"""
+	from rdiff_backup import hash
+	count, size = 50, 8 * 1024 * 1024
+	create_many_files("testfiles/many_out", os.urandom(size), count)
+	src_dir = rpath.RPath(Globals.local_connection, "testfiles/many_out")
+	out_rp = rpath.RPath(Globals.local_connection, output_desc)
+	for use_kernel_copy in (0, 1):
+		Globals.kernel_copy = use_kernel_copy
+		for desc, with_hash in (("copy", 0), ("copy with SHA1", 1)):
+			out_rp.mkdir()
+			t = time.time()
+			for i in range(count):
+				src_rp = src_dir.append(str(i))
+				fp = src_rp.open("rb")
+				if with_hash: fp = hash.FileWrapper(fp)
+				out_rp.append(str(i)).write_from_fileobj(fp)
+			t = time.time() - t
+			print "kernel_copy = %d, %s: %.2fs, %.1f MB/s" % \
+				  (use_kernel_copy, desc, t, count * size / t / 1024 / 1024)
+			Myrm(out_rp.path)
+	Myrm("testfiles/many_out")
+
 if len(sys.argv) < 2 or len(sys.argv) > 3:
 	print "Syntax:  benchmark.py benchmark_func [output_description]"
 	print
 	print "Where output_description defaults to 'testfiles/output'."
 	print "Currently benchmark_func includes:"
-	print "'many_files', 'many_files_rsync', and, 'nested_files'."
+	print "'many_files', 'many_files_rsync', 'nested_files',"
+	print "'metadata_parsing', 'compression_codecs', 'selection_rules',"
+	print "'deep_tree_scan', 'walker_prefetch', 'huge_directory',"
+	print "'rorp_memory', 'collate_interning', and 'kernel_copy'."
 	sys.exit(1)
 
 if len(sys.argv) == 3:
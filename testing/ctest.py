@@ -1,6 +1,6 @@
 import unittest
 from commontest import *
-from rdiff_backup import C
+from rdiff_backup import C, selection
 from rdiff_backup.rpath import *
 
 class CTest(unittest.TestCase):
@@ -22,6 +22,34 @@ class CTest(unittest.TestCase):
 				print "for path ", rp.path
 				assert 0
 
+	def test_scan_dir(self):
+		"""Test C.scan_dir against make_file_dict"""
+		dirrp = RPath(Globals.local_connection, "testfiles/output")
+		re_init_dir(dirrp)
+		dirrp.append("reg").touch()
+		dirrp.append("dir").mkdir()
+		dirrp.append("sym").symlink("reg")
+		dirrp.append("fifo").mkfifo()
+
+		listing = C.scan_dir(dirrp.path)
+		listing.sort()
+		assert map(lambda pair: pair[0], listing) == \
+			   ["dir", "fifo", "reg", "sym"], listing
+		for filename, data in listing:
+			assert data == C.make_file_dict(dirrp.append(filename).path), \
+				   (filename, data)
+		self.assertRaises(OSError, C.scan_dir, "aestu/aeutoheu/oeu")
+
+		# The selection iterator should give the same rpaths either way
+		rps = list(selection.Select(dirrp).set_iter())
+		Globals.use_unicode_paths = 1 # rpath.scan_dir isn't used then
+		try: old_rps = list(selection.Select(dirrp).set_iter())
+		finally: Globals.use_unicode_paths = 0
+		assert len(rps) == 5, rps
+		for rp, old_rp in zip(rps, old_rps):
+			assert rp.index == old_rp.index and rp.data == old_rp.data, \
+				   (rp, old_rp)
+
 	def test_strlong(self):
 		"""Test str2long and long2str"""
 		self.assertRaises(TypeError, C.long2str, "hello")
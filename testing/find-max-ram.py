@@ -15,7 +15,8 @@ def get_val(cmdstr):
 	Returns None if process not found.
 
 	"""
-	cmd = ("ps -Ao cmd -o rss | grep '%s' | grep -v grep" % cmdstr)
+	# cmd comes last so ps doesn't truncate it
+	cmd = ("ps -Ao rss -o cmd | grep '%s' | grep -v grep" % cmdstr)
 #	print "Running ", cmd
 	fp = os.popen(cmd)
 	lines = fp.readlines()
@@ -27,8 +28,8 @@ def get_val(cmdstr):
 def read_ps_line(psline):
 	"""Given a specially formatted line by ps, return rss value"""
 	l = psline.split()
-	assert len(l) >= 2 # first few are name, last one is rss
-	return int(l[-1])
+	assert len(l) >= 2 # first one is rss, rest are name
+	return int(l[0])
 
 
 def main(cmdstr):
@@ -98,6 +98,36 @@ class inctest(unittest.TestCase):
 		assert rp.isinccompressed()
 		rp.delete()
 
+	def testBZ2snapshot(self):
+		"""Test making a snapshot with a codec other than gzip"""
+		Globals.compression = 1
+		Globals.compression_codec = "bz2"
+		try:
+			rp = increment.Increment(sym, rf, target)
+			self.check_time(rp)
+			assert rp.path.endswith(".snapshot.bz2"), rp.path
+			assert rp.isinccompressed() == "bz2"
+			assert rpath.cmpfileobj(rp.open("rb", rp.isinccompressed()),
+									rf.open("rb"))
+			rp.delete()
+		finally: Globals.compression_codec = "gzip"
+
+	def testIncompressible(self):
+		"""Random data should be sampled and stored uncompressed"""
+		Globals.compression = 1
+		for data, suffix in [(os.urandom(20000), "raw"),
+							 ("compressible " * 2000, "gz")]:
+			out2.setdata()
+			if out2.lstat(): out2.delete()
+			out2.write_string(data)
+			rp = increment.Increment(sym, out2, target)
+			self.check_time(rp)
+			assert rp.get_data(compressed = rp.isinccompressed()) == data
+			assert statistics.FileStats.get_compression(rp) == suffix
+			assert rp.incompressible == (suffix == "raw")
+			rp.delete()
+		out2.delete()
+
 	def testdir(self):
 		"""Test increment on dir"""
 		rp = increment.Increment(sym, dir, target)
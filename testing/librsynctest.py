@@ -1,6 +1,6 @@
-import unittest, random
+import unittest, random, cStringIO
 from commontest import *
-from rdiff_backup import librsync, log
+from rdiff_backup import librsync, log, hash
 
 def MakeRandomFile(path, length = None):
 	"""Writes a random file of given length, or random len if unspecified"""
@@ -74,6 +74,50 @@ class LibrsyncTest(unittest.TestCase):
 			assert sigfile_string == siggen_string, \
 				   (len(sigfile_string), len(siggen_string))
 
+	def testSigGeneratorSizes(self):
+		"""SigGenerator output shouldn't depend on the sizes of updates"""
+		MakeRandomFile(self.basis.path, 500000)
+		sf = librsync.SigFile(self.basis.open("rb"))
+		sigfile_string = sf.read()
+		sf.close()
+
+		infile = self.basis.open("rb")
+		data = infile.read()
+		infile.close()
+		for i in range(3):
+			sig_gen, pos = librsync.SigGenerator(), 0
+			while pos < len(data):
+				length = random.choice([1, 1000, librsync.blocksize - 1,
+										librsync.blocksize + 1, 200000])
+				sig_gen.update(data[pos:pos+length])
+				pos += length
+			assert sig_gen.getsig() == sigfile_string
+
+	def testRingBuffer(self):
+		"""Fill and empty a RingBuffer past its size"""
+		ring, expected = librsync.RingBuffer(10), "x"
+		ring.get_space(1)[:1] = "x"
+		ring.fill(1)
+		for i in range(20):
+			space = ring.get_space(4)
+			space[:4] = "%04d" % i
+			ring.fill(4)
+			expected += "%04d" % i
+			assert ring.get_view().tobytes() == expected
+			result = ring.read(4)
+			assert result == expected[:4], (result, expected)
+			expected = expected[4:]
+			assert len(ring) == len(expected)
+
+	def testWithoutBuffers(self):
+		"""Jobs run with cycle() on strings, as with python before 2.7"""
+		assert librsync.use_buffers
+		librsync.use_buffers, librsync.Buffer = 0, librsync.StringBuffer
+		try:
+			self.testSigGeneratorSizes()
+			self.testChunkedDelta()
+		finally: librsync.use_buffers, librsync.Buffer = 1, librsync.RingBuffer
+
 	def OldtestDelta(self):
 		"""Test delta generation against Rdiff"""
 		MakeRandomFile(self.basis.path)
@@ -148,7 +192,47 @@ class LibrsyncTest(unittest.TestCase):
 
 			assert real_new == librsync_new, \
 				   (len(real_new), len(librsync_new))
-			
+
+	def testChunkedSig(self):
+		"""Signature made in chunks is the same as SigFile's"""
+		MakeRandomFile(self.basis.path, 100000)
+		self.basis.setdata()
+		sf = librsync.SigFile(self.basis.open("rb"), 512)
+		sig = sf.read()
+		assert not sf.close()
+		csf = librsync.ChunkedSigFile(lambda: self.basis.open("rb"),
+									  self.basis.getsize(), 512, 10000, 3)
+		assert csf.read(100) + csf.read() == sig
+		csf.close()
+
+	def testChunkedDelta(self):
+		"""Chunked delta patches correctly, using the whole basis file"""
+		MakeRandomFile(self.basis.path, 100000)
+		fp = self.basis.open("rb")
+		basis = fp.read()
+		fp.close()
+		new = basis[:30000] + "x" + basis[30000:80000] + basis[:20000]
+		fp = self.new.open("wb")
+		fp.write(new)
+		fp.close()
+		self.new.setdata()
+		sf = librsync.SigFile(self.basis.open("rb"), 512)
+		cdf = librsync.ChunkedDeltaFile(sf, lambda: self.new.open("rb"),
+					self.new.getsize(), 7000, 3,
+					hash.FileWrapper(self.new.open("rb")))
+		delta = cdf.read(10) + cdf.read()
+		assert cdf.close().sha1_digest == hash.compute_sha1(self.new)
+		assert delta.startswith(librsync.chunked_delta_magic)
+		assert len(delta) < len(new) / 4, len(delta)
+
+		pf = librsync.get_patched_file(self.basis.open("rb"),
+									   cStringIO.StringIO(delta))
+		assert pf.read(5000) + pf.read() == new
+		pf.close()
+		pf = librsync.get_patched_file(self.basis.open("rb"),
+									   cStringIO.StringIO(delta[:-20]))
+		self.assertRaises(librsync.librsyncError, pf.read)
+
 
 
 if __name__ == "__main__": unittest.main()
@@ -1,5 +1,6 @@
 import unittest, os, cStringIO, time
-from rdiff_backup import rpath, connection, Globals, selection, lazy
+from rdiff_backup import rpath, connection, Globals, selection, lazy, C, \
+	 Time, manage, rorpiter
 from rdiff_backup.metadata import *
 
 tempdir = rpath.RPath(Globals.local_connection, "testfiles/output")
@@ -38,6 +39,23 @@ class MetadataTest(unittest.TestCase):
 			new_rorp = Record2RORP(record)
 			assert new_rorp == rp, (new_rorp, rp, record)
 
+	def testInode(self):
+		"""Inodes of regular files are kept even if not hard linked"""
+		self.make_temp()
+		rp = tempdir.append("file")
+		rp.touch()
+		assert rp.getnumlinks() == 1
+		new_rorp = Record2RORP(RORP2Record(rp))
+		assert new_rorp.getinode() == rp.getinode()
+		assert new_rorp.getdevloc() == rp.getdevloc()
+		assert new_rorp.getnumlinks() == 1
+
+		codec = BinaryRorpCodec()
+		record = codec.object_to_record(rp)
+		extractor = BinaryRorpExtractor(cStringIO.StringIO(record))
+		new_rorp = extractor.iterate().next()
+		assert new_rorp.data == Record2RORP(RORP2Record(rp)).data
+
 	def testIterator(self):
 		"""Test writing RORPs to file and iterating them back"""
 		def write_rorp_iter_to_file(rorp_iter, file):
@@ -57,6 +75,41 @@ class MetadataTest(unittest.TestCase):
 				assert 0, (i, str(l[i]), str(outlist[i]))
 		fp.close()
 
+	def testParseMetadata(self):
+		"""Test C.parse_metadata gives same rorps as Record2RORP"""
+		records = map(RORP2Record, self.get_rpaths())
+		records.extend(["File hello\\nthere/a\\\\b\n  Type reg\n  Size 3\n"
+						"  ModTime -2\n  Uname None\n  Gname foo\n",
+						"File odd\\escape\n  Type None\n",
+						"File rf\n  Type reg\n  ResourceFork None\n",
+						"File unknown\n  Type dir\n  Fieldname 3\n",
+						"File dev\n  Type dev\n  DeviceNum c 4 65\n",
+						"File baddev\n  Type dev\n  DeviceNum c 4\n",
+						"File badsize\n  Type reg\n  Size 3a\n",
+						"File .\n  Type dir\n\n  Uid 0\n"])
+		items = C.parse_metadata("".join(records), rpath.RORPath)
+		assert len(items) == len(records), (len(items), len(records))
+		for record, item in zip(records, items):
+			if type(item) is str:
+				assert item == record, (item, record)
+				continue
+			try: rorp = Record2RORP(record)
+			except ValueError: assert 0, record
+			assert item.index == rorp.index, (item.index, rorp.index)
+			assert item.data == rorp.data, (item.data, rorp.data)
+		assert type(items[-5]) is str # bad DeviceNum is left to python
+
+	def testInternedIndex(self):
+		"""Test filenames read from metadata are shared between indicies"""
+		records = "".join(["File dir%d/file\n  Type reg\n" % i
+						   for i in range(3)])
+		items = C.parse_metadata(records, rpath.RORPath)
+		names = "dir/file".split("/") # made here, so not interned
+		assert items[0].index[1] is items[2].index[1] is intern(names[1])
+		assert quoted_filename_to_index("dir0/file")[1] is items[1].index[1]
+		assert rpath.intern_filename(names[0]) is intern("dir")
+		assert rpath.intern_filename(u"dir") == u"dir"
+
 	def write_metadata_to_temp(self):
 		"""If necessary, write metadata of bigdir to file metadata.gz"""
 		global tempdir
@@ -109,6 +162,57 @@ class MetadataTest(unittest.TestCase):
 			  (i, time.time() - start_time)
 		assert i == 51
 
+	def test_blocksize(self):
+		"""Test reading with blocks smaller and larger than records"""
+		temprp = self.write_metadata_to_temp()
+		def get_indicies(blocksize, restrict_index = None, old_way = None):
+			Globals.metadata_blocksize = blocksize
+			try:
+				mf = MetadataFile(temprp, 'r')
+				if old_way:
+					rorp_iter = FlatExtractor.iterate(RorpExtractor(mf.fileobj))
+				else: rorp_iter = mf.get_objects(restrict_index)
+				return [rorp.index for rorp in rorp_iter]
+			finally: Globals.metadata_blocksize = 32 * 1024
+
+		indicies = get_indicies(32 * 1024)
+		assert indicies
+		for blocksize in (37, 1000, 1024 * 1024):
+			assert get_indicies(blocksize) == indicies, blocksize
+			assert get_indicies(blocksize, old_way = 1) == indicies, blocksize
+			assert len(get_indicies(blocksize, ("subdir3", "subdir10"))) == 51
+
+	def test_offsets(self):
+		"""Test restricted reading starting from an offset index"""
+		self.make_temp()
+		temprp = tempdir.append("mirror_metadata.2005-11-03T12:51:06-06:00.snapshot")
+		rootrp = rpath.RPath(Globals.local_connection, "testfiles/bigdir")
+		mf = MetadataFile(temprp, 'w')
+		mf._offsets_interval = 4096
+		for rp in selection.Select(rootrp).set_iter(): mf.write_object(rp)
+		mf.close()
+		temprp = mf.rp
+		offsets_rp = tempdir.append("metadata_offsets.2005-11-03T12:51:06-06:00.data")
+		assert offsets_rp.isreg()
+
+		def get_indicies(index, use_offsets):
+			mf = MetadataFile(temprp, 'r')
+			if not use_offsets: mf._use_offsets = None
+			return [rorp.index for rorp in mf.get_objects(index)]
+
+		for index in [("subdir3",), ("subdir3", "subdir10"),
+					  ("subdir9", "subdir9", "file9"), ("zzz",)]:
+			indicies = get_indicies(index, 1)
+			assert indicies == get_indicies(index, None), index
+			for i in indicies: assert i[:len(index)] == index, (i, index)
+		assert get_indicies(("subdir3", "subdir10"), 1)
+
+		# Stale offset index should be ignored
+		offsets_rp.delete()
+		offsets_rp.write_string("FlatFile %s 0\n0 .\nEnd\n" %
+								(temprp.dirsplit()[1],))
+		assert len(get_indicies(("subdir3", "subdir10"), 1)) == 51
+
 	def test_write(self):
 		"""Test writing to metadata file, then reading back contents"""
 		global tempdir
@@ -133,6 +237,45 @@ class MetadataTest(unittest.TestCase):
 		for i in range(len(reread_rps)):
 			assert reread_rps[i] == rps[i], i
 
+	def test_binary(self):
+		"""Test writing binary metadata, reading and converting it"""
+		self.make_temp()
+		Globals.rbdir = tempdir
+		rootrp = rpath.RPath(Globals.local_connection,
+							 "testfiles/various_file_types")
+		rps = list(selection.Select(rootrp).set_iter())
+
+		textrp = tempdir.append("mirror_metadata.2005-11-03T12:51:06-06:00.snapshot")
+		binrp = tempdir.append("mirror_metadata.2005-11-03T13:51:06-06:00.snapshot")
+		def write(rp, format):
+			write_mf = MetadataFile(rp, 'w', format = format)
+			for rorp in rps: write_mf.write_object(rorp)
+			write_mf.close()
+			return write_mf.rp
+		textrp, binrp = write(textrp, "text"), write(binrp, "binary")
+		assert MetadataFile(textrp, 'r').format == "text"
+		assert MetadataFile(binrp, 'r').format == "binary"
+
+		def check_equal(rp1, rp2, index = None):
+			iter1 = MetadataFile(rp1, 'r').get_objects(index)
+			iter2 = MetadataFile(rp2, 'r').get_objects(index)
+			for rorp1, rorp2 in rorpiter.Collate2Iters(iter1, iter2):
+				assert rorp1 and rorp2, (rorp1, rorp2)
+				assert rorp1.data == rorp2.data, (rorp1.data, rorp2.data)
+		check_equal(textrp, binrp)
+		check_equal(textrp, binrp, ("subdir",))
+		assert len(list(MetadataFile(binrp, 'r').get_objects())) == len(rps)
+
+		ConvertFormat("binary")
+		assert tempdir.append("metadata_format").get_data() == "binary\n"
+		textrp.setdata()
+		assert MetadataFile(textrp, 'r').format == "binary"
+		check_equal(textrp, binrp)
+		ConvertFormat("text")
+		binrp.setdata()
+		assert MetadataFile(binrp, 'r').format == "text"
+		check_equal(textrp, binrp)
+
 	def test_patch(self):
 		"""Test combining 3 iters of metadata rorps"""
 		self.make_temp()
@@ -213,6 +356,128 @@ class MetadataTest(unittest.TestCase):
 		compare(man, inc2, 20000)
 		compare(man, inc3, 30000)
 		compare(man, inc4, 40000)
-		
+
+	def test_meta_diff_stream(self):
+		"""Write diffs while writing the new snapshot, as backup does"""
+		def write_dir_to_meta(man, rp, time, prevtime = None):
+			"""Write snapshot of rp, and diff to prevtime if possible"""
+			if prevtime:
+				old_iter = man.GetAtTime(prevtime)
+				man.open_meta_diff(prevtime)
+			else: old_iter = iter([])
+			metawriter = man.get_meta_writer('snapshot', time)
+			new_iter = selection.Select(rp).set_iter()
+			for new_rorp, old_rorp in rorpiter.Collate2Iters(new_iter,
+															 old_iter):
+				if new_rorp: metawriter.write_object(new_rorp)
+				man.write_meta_diff(new_rorp, old_rorp)
+			metawriter.close()
+			man.ConvertMetaToDiff()
+
+		def compare(man, rootrp, time):
+			assert lazy.Iter.equal(selection.Select(rootrp).set_iter(),
+								   man.get_meta_at_time(time, None))
+
+		self.make_temp()
+		Globals.rbdir = tempdir
+		incs = [rpath.RPath(Globals.local_connection,
+							"testfiles/increment%d" % i) for i in range(1, 5)]
+		write_dir_to_meta(PatchDiffMan(), incs[0], 10000)
+		write_dir_to_meta(PatchDiffMan(), incs[1], 20000, 10000)
+		write_dir_to_meta(PatchDiffMan(), incs[2], 30000, 20000)
+		man = PatchDiffMan()
+		man.max_diff_chain = 3
+		write_dir_to_meta(man, incs[3], 40000, 30000)
+
+		man = PatchDiffMan()
+		l = man.sorted_prefix_inclist('mirror_metadata')
+		assert [(rp.getinctime(), rp.getinctype()) for rp in l] == \
+			   [(40000, 'snapshot'), (30000, 'snapshot'),
+				(20000, 'diff'), (10000, 'diff')], l
+		for i in range(4): compare(man, incs[i], (i+1)*10000)
+
+	def test_meta_diff_offsets(self):
+		"""The offset index of a snapshot goes when it becomes a diff"""
+		def write_snapshot(man, time):
+			metawriter = man.get_meta_writer('snapshot', time)
+			for rorp in selection.Select(rootrp).set_iter():
+				metawriter.write_object(rorp)
+			metawriter.close()
+
+		self.make_temp()
+		Globals.rbdir = tempdir
+		rootrp = tempdir.append("root")
+		rootrp.mkdir()
+		for i in range(300): rootrp.append("file%03d" % i).touch()
+		old_interval = MetadataFile._offsets_interval
+		MetadataFile._offsets_interval = 100
+		try:
+			write_snapshot(PatchDiffMan(), 10000)
+			offsets_rp = tempdir.append("metadata_offsets.%s.data" %
+										(Time.timetostring(10000),))
+			assert offsets_rp.isreg()
+			man = PatchDiffMan()
+			man.open_meta_diff(10000)
+			man.meta_diff[0]._use_offsets = None # as when written remotely
+			write_snapshot(man, 20000)
+			man.ConvertMetaToDiff()
+		finally: MetadataFile._offsets_interval = old_interval
+		offsets_rp.setdata()
+		assert not offsets_rp.lstat()
+		assert tempdir.append("metadata_offsets.%s.data" %
+							  (Time.timetostring(20000),)).isreg()
+
+	def test_meta_cache(self):
+		"""Test saving patched metadata in the metadata_cache directory"""
+		self.make_temp()
+		Globals.rbdir = tempdir
+		incs = map(lambda i: rpath.RPath(Globals.local_connection,
+										 "testfiles/increment%d" % i), [1, 2, 3])
+		for i in range(3):
+			man = PatchDiffMan()
+			metawriter = man.get_meta_writer('snapshot', (i+1) * 10000)
+			for rorp in selection.Select(incs[i]).set_iter():
+				metawriter.write_object(rorp)
+			metawriter.close()
+			man.ConvertMetaToDiff()
+		man = PatchDiffMan()
+
+		def get_cache_rp(time):
+			return tempdir.append("metadata_cache").append(
+				"mirror_metadata.%s.snapshot.gz" % Time.timetostring(time))
+		def compare(time):
+			assert lazy.Iter.equal(
+				selection.Select(incs[time/10000 - 1]).set_iter(),
+				man.get_meta_at_time(time, None))
+
+		assert not get_cache_rp(10000).lstat()
+		compare(10000)
+		assert get_cache_rp(10000).isreg()
+		compare(10000) # now read from cache
+		indicies = [rorp.index for rorp in man.get_meta_at_time(10000, None)]
+		index = indicies[1][:1]
+		restricted = [rorp.index for rorp in man.get_meta_at_time(10000, index)]
+		assert restricted == filter(lambda i: i[:1] == index, indicies)
+
+		# Least recently used entry is deleted when over the size limit
+		compare(20000)
+		size = max(get_cache_rp(20000).getsize(),
+				   man.relevant_meta_incs(20000)[0].getsize())
+		get_cache_rp(20000).delete()
+		os.utime(get_cache_rp(10000).path, (0, 0))
+		Globals.metadata_cache_size = size
+		try: compare(20000)
+		finally: Globals.metadata_cache_size = 64 * 1024 * 1024
+		assert get_cache_rp(20000).isreg()
+		get_cache_rp(10000).setdata()
+		assert not get_cache_rp(10000).lstat()
+
+		compare(10000)
+		manage.delete_earlier_than(tempdir, 15000)
+		get_cache_rp(10000).setdata()
+		assert not get_cache_rp(10000).lstat()
+		get_cache_rp(20000).setdata()
+		assert get_cache_rp(20000).isreg()
+
 
 if __name__ == "__main__": unittest.main()
@@ -1,4 +1,4 @@
-import os, cPickle, sys, unittest, time
+import os, cPickle, sys, unittest, time, types, cStringIO
 from commontest import *
 from rdiff_backup.rpath import *
 from rdiff_backup import rpath
@@ -20,7 +20,32 @@ class RORPStateTest(RPathTest):
 		rorp2 = cPickle.loads(cPickle.dumps(rorp, 1))
 		assert rorp2.isreg()
 		assert rorp2.data == rorp.data and rorp.index == rorp2.index
-		
+
+	def testDataView(self):
+		"""Test the data attribute of slotted RORPaths"""
+		rorp = RORPath(("foo",), {'type': 'reg', 'size': 3L,
+								  'carbonfile': 'cf', 'linked': ("bar",)})
+		assert not hasattr(rorp, '__dict__')
+		assert rorp.isreg() and rorp.getsize() == 3
+		assert rorp.data['carbonfile'] == 'cf' and rorp.isflaglinked()
+		assert rorp.data.has_key('size') and not rorp.data.has_key('uid')
+		assert rorp.data.get('uid', 7) == 7
+		self.assertRaises(KeyError, lambda: rorp.data['uid'])
+
+		rorp.data['uid'] = 10
+		del rorp.data['linked']
+		assert rorp.uid == 10 and not rorp.isflaglinked()
+		d = rorp.data.copy()
+		assert d == {'type': 'reg', 'size': 3L, 'uid': 10,
+					 'carbonfile': 'cf'}, d
+		assert rorp.data == d and rorp.data != {'type': 'reg'}
+
+		rorp2 = cPickle.loads(cPickle.dumps(rorp, 1))
+		assert rorp2.data == rorp.data and rorp2.index == ("foo",)
+		assert cPickle.loads(cPickle.dumps(rorp.data, 1)) == d
+		rorp2.data = {'type': 'dir'}
+		assert rorp2.isdir() and not rorp2.has_carbonfile()
+		assert rorp.equal_verbose(RORPath(("foo",), rorp.data))
 
 class CheckTypes(RPathTest):
 	"""Check to see if file types are identified correctly"""
@@ -147,6 +172,36 @@ class CheckDir(RPathTest):
 		dirlist.sort()
 		assert dirlist == ["1", "2", "3", "4"], dirlist
 
+	def testListdirSorted(self):
+		"""Test listing a directory with more entries than the run size"""
+		d = RPath(self.lc, "testfiles/output")
+		re_init_dir(d)
+		filenames = map(lambda i: "file%d" % (i * 7 % 100), range(100))
+		for filename in filenames: d.append(filename).touch()
+		filenames.sort()
+
+		old_run_size = Globals.listdir_run_size
+		Globals.listdir_run_size = 12
+		try:
+			assert rpath.scan_dir(d) is None
+			listing = rpath.listdir_sorted(d)
+			assert type(listing) is not types.ListType
+			assert list(listing) == filenames
+		finally: Globals.listdir_run_size = old_run_size
+		assert list(rpath.listdir_sorted(d)) == filenames
+
+	def testSortedRuns(self):
+		"""Test merging runs of strings, including empty ones"""
+		runs = SortedRuns()
+		runs.blocksize = 5
+		for chunk in [["b", "a\nb"], ["c"], [], ["aa", "bb", "a"]]:
+			runs.add(chunk)
+		assert list(runs.get_sorted()) == ["a", "a\nb", "aa", "b", "bb", "c"]
+		runs = SortedRuns()
+		runs.add(["z", "y"])
+		assert runs.get_sorted() == ["y", "z"]
+		assert SortedRuns().get_sorted() == []
+
 
 class CheckSyms(RPathTest):
 	"""Check symlinking and reading"""
@@ -261,6 +316,22 @@ class FilenameOps(RPathTest):
 			assert result == split, \
 				   "%s => %s instead of %s" % (full, result, split)
 
+	def testSplitNoStat(self):
+		"""dirsplit and new_sibling only stat the new file"""
+		out = RPath(self.lc, "testfiles/output")
+		re_init_dir(out)
+		out.append("sibling").touch()
+		rp = RPath(self.lc, "testfiles", ("output", "file"))
+		lstats = rpath.stat_counts.get('lstat', 0)
+		assert rp.dirsplit() == ("testfiles/output", "file")
+		assert rpath.stat_counts['lstat'] == lstats
+		sibling = rp.new_sibling("sibling")
+		assert rpath.stat_counts['lstat'] == lstats + 1
+		assert sibling.index == ("output", "sibling") and sibling.isreg()
+		sibling = RPath(self.lc, "/a/b").new_sibling("c")
+		assert sibling.path == "/a/c", sibling.path
+		assert RPath(self.lc, "/a").new_sibling("c").path == "/c"
+
 	def testGetnums(self):
 		"""Test getting file numbers"""
 		devnums = RPath(self.lc, "/dev/hda", ()).getdevnums()
@@ -330,6 +401,183 @@ class FileIO(RPathTest):
 		assert not fp_in.close()		
 
 
+class KernelCopy(RPathTest):
+	"""Test copying between local files with C.copy_fd"""
+	def setUp(self):
+		self.out = RPath(self.lc, "testfiles/output")
+		re_init_dir(self.out)
+		self.data = "".join(map(lambda i: "%d\n" % i, range(100000)))
+		self.src = self.out.append("src")
+		self.src.write_string(self.data)
+		self.dest = self.out.append("dest")
+
+	def testCopy(self):
+		"""Copy whole file, and with data already written to dest"""
+		assert copy_fd_local(self.src.open("rb"), self.dest.open("wb"))
+		assert self.dest.get_data() == self.data
+		self.dest.delete()
+		outfp = self.dest.open("wb")
+		outfp.write("start")
+		copyfileobj(self.src.open("rb"), outfp)
+		outfp.write("end")
+		assert not outfp.close()
+		assert self.dest.get_data() == "start" + self.data + "end"
+
+	def testHash(self):
+		"""The SHA1 of a hash.FileWrapper is still computed"""
+		from rdiff_backup import hash
+		fw = hash.FileWrapper(self.src.open("rb"))
+		self.dest.write_from_fileobj(fw)
+		assert self.dest.get_data() == self.data
+		assert fw.close().sha1_digest == hash.compute_sha1(self.src)
+
+		def copy_fd(*args): raise NotImplementedError("no copy")
+		old_copy_fd, rpath.C.copy_fd = rpath.C.copy_fd, copy_fd
+		try:
+			self.dest.delete()
+			fw = hash.FileWrapper(self.src.open("rb"))
+			self.dest.write_from_fileobj(fw)
+		finally: rpath.C.copy_fd = old_copy_fd
+		assert self.dest.get_data() == self.data
+		assert fw.close().sha1_digest == self.src.get_sha1()
+
+	def testHashWritten(self):
+		"""The SHA1 is of the data written, even if the source changes"""
+		from rdiff_backup import hash
+		old_copy_fd = rpath.C.copy_fd
+		def copy_fd(in_fd, out_fd):
+			result = old_copy_fd(in_fd, out_fd)
+			fp = self.src.open("wb")
+			fp.write("changed")
+			assert not fp.close()
+			return result
+		rpath.C.copy_fd = copy_fd
+		try:
+			fw = hash.FileWrapper(self.src.open("rb"))
+			self.dest.write_from_fileobj(fw)
+		finally: rpath.C.copy_fd = old_copy_fd
+		assert self.dest.get_data() == self.data
+		assert fw.close().sha1_digest == hash.compute_sha1(self.dest)
+
+	def testShort(self):
+		"""Copies the kernel stops early are finished in python"""
+		def copy_part(in_fd, out_fd):
+			os.write(out_fd, os.read(in_fd, 1000))
+			return 1000
+		def copy_none(in_fd, out_fd): return 0
+		old_copy_fd = rpath.C.copy_fd
+		try:
+			for copy_fd in (copy_part, copy_none):
+				rpath.C.copy_fd = copy_fd
+				dest = self.out.append(copy_fd.__name__)
+				assert copy_fd_local(self.src.open("rb"), dest.open("wb"))
+				assert dest.get_data() == self.data
+		finally: rpath.C.copy_fd = old_copy_fd
+
+	def testBuffered(self):
+		"""Files with read buffers, or other objects, aren't copied"""
+		infp = self.src.open("rb")
+		assert infp.read(10) == self.data[:10]
+		outfp = self.dest.open("wb")
+		assert not copy_fd_local(infp, outfp)
+		copyfileobj(infp, outfp)
+		assert not outfp.close()
+		assert self.dest.get_data() == self.data[10:]
+		assert not copy_fd_local(cStringIO.StringIO("a"), outfp)
+
+
+class SparseFiles(RPathTest):
+	"""Test writing files with holes"""
+	def setUp(self):
+		self.out = RPath(self.lc, "testfiles/output")
+		re_init_dir(self.out)
+		self.src = self.out.append("src")
+		fp = self.src.open("wb")
+		fp.write("a" * 5000)
+		fp.seek(1024 * 1024)
+		fp.write("b" * 5000)
+		fp.truncate(3 * 1024 * 1024)
+		assert not fp.close()
+		self.src.setdata()
+		self.data = self.src.get_data()
+		self.dest = self.out.append("dest")
+
+	def get_allocated(self, rp):
+		"""Return number of bytes allocated on disk for rp"""
+		return os.lstat(rp.path).st_blocks * 512
+
+	def testGetHoles(self):
+		"""Test finding the holes of a file"""
+		if rpath.SEEK_HOLE is None: return
+		fp = self.src.open("rb")
+		holes = get_holes(fp.fileno())
+		if not holes: return # filesystem doesn't report holes
+		assert len(holes) == 2, holes
+		assert holes[0][0] >= 5000 and holes[0][0] + holes[0][1] <= 1024*1024
+		assert holes[1][0] + holes[1][1] == 3 * 1024 * 1024, holes
+		assert get_holes(fp.fileno(), holes[1][0] + 1) == \
+			   [(holes[1][0] + 1, holes[1][1] - 1)]
+		assert get_holes(fp.fileno(), 0, 1) == holes[:1]
+		assert fp.tell() == 0 and not fp.close()
+
+	def testCopy(self):
+		"""Holes of local files are kept, other data is written in full"""
+		from rdiff_backup import hash
+		if rpath.SEEK_HOLE is None: return
+		fp = self.src.open("rb")
+		holes = get_holes(fp.fileno())
+		assert not fp.close()
+		if not holes: return # filesystem doesn't report holes
+		for fp in (self.src.open("rb"), hash.FileWrapper(self.src.open("rb"))):
+			if self.dest.lstat(): self.dest.delete()
+			self.dest.write_from_fileobj(fp)
+			assert self.dest.get_data() == self.data
+			assert self.get_allocated(self.dest) < 1024 * 1024
+		self.dest.delete()
+		self.dest.write_from_fileobj(cStringIO.StringIO(self.data))
+		assert self.dest.get_data() == self.data
+		assert self.get_allocated(self.dest) >= len(self.data)
+
+	def testPatchSparseBasis(self):
+		"""Patching a basis with holes writes the result sparsely"""
+		from rdiff_backup import Rdiff, librsync
+		if not rpath.has_holes(self.src): return # no holes found here
+		new_data = "c" * 3000 + self.data[3000:]
+		delta = self.out.append("delta")
+		delta.write_from_fileobj(librsync.DeltaFile(Rdiff.get_signature(
+			self.src), cStringIO.StringIO(new_data)))
+		Rdiff.patch_local(self.src, delta, self.dest)
+		assert self.dest.get_data() == new_data
+		assert self.get_allocated(self.dest) < 1024 * 1024
+
+	def testSparseFlag(self):
+		"""Data of a rorp flagged sparse is written sparsely"""
+		rorp = rpath.RORPath(("dest",), self.src.data)
+		rorp.setfile(cStringIO.StringIO(self.data))
+		rorp.set_sparse()
+		rpath.copy(rorp, self.dest)
+		assert self.dest.get_data() == self.data
+		assert self.get_allocated(self.dest) < 1024 * 1024
+
+	def testAllocated(self):
+		"""Zeros in a file without holes aren't made into holes"""
+		self.src.delete()
+		self.src.write_string("a" * 5000 + "\0" * (2 * 1024 * 1024))
+		Globals.kernel_copy = 0
+		try: self.dest.write_from_fileobj(self.src.open("rb"))
+		finally: Globals.kernel_copy = 1
+		assert self.dest.get_data() == self.src.get_data()
+		assert self.get_allocated(self.dest) >= 2 * 1024 * 1024
+
+	def testNoSparse(self):
+		"""With sparse_files off, blocks of zeros are written"""
+		Globals.sparse_files = Globals.kernel_copy = 0
+		try: self.dest.write_from_fileobj(cStringIO.StringIO(self.data))
+		finally: Globals.sparse_files = Globals.kernel_copy = 1
+		assert self.dest.get_data() == self.data
+		assert self.get_allocated(self.dest) >= len(self.data)
+
+
 class FileCopying(RPathTest):
 	"""Test file copying and comparison"""
 	def setUp(self):
@@ -480,7 +728,59 @@ class Gzip(RPathTest):
 		assert base_gz.isreg(), base_gz
 		data = base_gz.get_data(compressed = 1)
 		assert data == "lala", data
-		
+
+	def test_threaded(self):
+		"""Test ThreadedWriter and ThreadedReader on gzip files"""
+		dirrp = rpath.RPath(self.lc, "testfiles/output")
+		re_init_dir(dirrp)
+		rp = dirrp.append('foo.gz')
+		lines = map(lambda i: "line %d\n" % i, range(10000))
+
+		fileobj = rpath.ThreadedWriter(rp.open("wb", compress = 1))
+		for line in lines: fileobj.write(line)
+		assert not fileobj.close()
+		assert rp.get_data(compressed = 1) == "".join(lines)
+
+		fileobj = rpath.ThreadedReader(rp.open("rb", compress = 1), 1000)
+		assert fileobj.readline() == lines[0]
+		assert fileobj.read(len(lines[1])) == lines[1]
+		assert fileobj.read() == "".join(lines[2:])
+		assert fileobj.read() == ""
+		assert not fileobj.close()
+
+		# Closing before the end should stop the reader thread
+		fileobj = rpath.ThreadedReader(rp.open("rb", compress = 1), 10)
+		assert fileobj.read(5) == "line "
+		assert not fileobj.close()
+		assert not fileobj.thread.isAlive()
+
+		# Errors in the thread are raised in the caller
+		fileobj = rpath.ThreadedWriter(dirrp.append('bar').open("wb"))
+		fileobj.fileobj.close()
+		fileobj.write("hello")
+		self.assertRaises(ValueError, fileobj.close)
+		assert not fileobj.thread.isAlive()
+
+	def test_codecs(self):
+		"""Test writing and reading with each available codec and level"""
+		dirrp = rpath.RPath(self.lc, "testfiles/output")
+		re_init_dir(dirrp)
+		s = "Hello, world!\n" * 1000
+		for codec, (suffix, module, fileclass) in \
+				rpath.compression_codecs.items():
+			if not module: continue
+			for level in (1, 9):
+				Globals.compression_level = level
+				rp = dirrp.append("foo.2001-09-02T02:48:33-07:00.diff." +
+								  suffix)
+				rp.write_string(s, compress = suffix)
+				assert rp.isincfile() and rp.isinccompressed() == suffix
+				assert rp.getinctype() == "diff"
+				assert rp.get_data(compressed = suffix) == s
+				assert len(rp.get_data()) < len(s)
+				rp.delete()
+		Globals.compression_level = None
+
 
 if __name__ == "__main__":
 	unittest.main()
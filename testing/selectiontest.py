@@ -1,5 +1,5 @@
 from __future__ import generators
-import re, StringIO, unittest, types
+import re, StringIO, unittest, types, random
 from commontest import *
 from rdiff_backup.selection import *
 from rdiff_backup import Globals, rpath, lazy
@@ -448,6 +448,129 @@ testfiles/select**/2
 #						  verbose = 1)
 
 
+class SelectionIndexTest(unittest.TestCase):
+	"""Test that using a SelectionIndex doesn't change Select's results"""
+	def get_tuplelist(self, rand, count):
+		"""Return list of count random selection options"""
+		comps = ["a", "b", "c", "ab"]
+		patterns = comps + ["*", "?", "a*", "[ab]", "**"]
+		tuplelist = []
+		for i in range(count):
+			opt = rand.choice(["--include", "--exclude"])
+			path = ["testfiles/select"]
+			for j in range(rand.randint(1, 4)):
+				path.append(rand.choice(comps))
+			if rand.random() < 0.6: # make a glob
+				path[rand.randint(1, len(path) - 1)] = rand.choice(patterns)
+				if rand.random() < 0.1:
+					path[0] = "ignorecase:" + path[0].upper()
+			if rand.random() < 0.05: path = ["**"] + path[1:]
+			tuplelist.append((opt, "/".join(path)))
+			if rand.random() < 0.02:
+				tuplelist.append(("--include-regexp", "b/c"))
+		tuplelist.append(("--exclude", "**"))
+		return tuplelist
+
+	def get_indicies(self, rand, count):
+		"""Return sorted list of count random indicies"""
+		indicies = [()]
+		for i in range(count):
+			indicies.append(tuple([rand.choice(["a", "b", "c", "ab", "d"])
+								   for j in range(rand.randint(1, 5))]))
+		indicies.sort()
+		return indicies
+
+	def testSameResults(self):
+		"""Compare indexed and unindexed results on random selections"""
+		root = RPath(Globals.local_connection, "testfiles/select")
+		rand = random.Random(12)
+		for trial in range(10):
+			tuplelist = self.get_tuplelist(rand, rand.choice([20, 100]))
+			indexed, unindexed = Select(root), Select(root)
+			indexed.ParseArgs(tuplelist, [])
+			unindexed.ParseArgs(tuplelist, [])
+			unindexed.selection_index = SelectionIndex([])
+			for index in self.get_indicies(rand, 500):
+				rp = root.new_index(index)
+				result = indexed.Select(rp)
+				assert result == unindexed.Select(rp), (index, tuplelist)
+			assert indexed.selection_index.active
+
+
+class DirPrefetcherTest(unittest.TestCase):
+	"""Test reading directory listings ahead in threads"""
+	def make_tree(self):
+		"""Make a tree of directories and files in testfiles/output"""
+		root = MakeOutputDir()
+		for i in range(6):
+			dir_rp = root.append("d%d" % i)
+			dir_rp.mkdir()
+			for j in range(4):
+				dir_rp.append("f%d" % j).touch()
+				subdir_rp = dir_rp.append("s%d" % j)
+				subdir_rp.mkdir()
+				subdir_rp.append("f").touch()
+		return root
+
+	def get_rps(self, root, tuplelist):
+		"""Return list of rpaths selected under root by tuplelist"""
+		select = Select(root)
+		select.ParseArgs(tuplelist, [])
+		return list(select.set_iter())
+
+	def testSameOrder(self):
+		"""Walk with and without prefetching, compare results"""
+		root = self.make_tree()
+		for tuplelist in [[], [("--exclude", "testfiles/output/d2"),
+							   ("--include", "testfiles/output/d*/s1"),
+							   ("--exclude", "testfiles/output/d*/s*")]]:
+			rps = self.get_rps(root, tuplelist)
+			for threads, prefetch in [(1, 1), (3, 5), (4, 100)]:
+				Globals.walker_threads = threads
+				Globals.walker_prefetch = prefetch
+				try: prefetched_rps = self.get_rps(root, tuplelist)
+				finally: Globals.walker_threads = 0
+				assert len(rps) == len(prefetched_rps), \
+					   (len(rps), len(prefetched_rps))
+				for rp, prefetched_rp in zip(rps, prefetched_rps):
+					assert rp.index == prefetched_rp.index, \
+						   (rp, prefetched_rp)
+					assert rp.data == prefetched_rp.data, (rp, prefetched_rp)
+
+	def testPrefetcher(self):
+		"""Test DirPrefetcher directly"""
+		root = self.make_tree()
+		prefetcher = DirPrefetcher(2, 3)
+		prefetcher.prefetch(root, rpath.scan_dir(root))
+		assert len(prefetcher.slots) == 3, prefetcher.slots
+		for i in range(3):
+			dir_rp = root.append("d%d" % i)
+			listing = prefetcher.get(dir_rp)
+			assert listing is None or listing == rpath.scan_dir(dir_rp), \
+				   listing
+		assert prefetcher.get(root.append("d5")) is None
+		assert not prefetcher.slots, prefetcher.slots
+		prefetcher.close()
+
+	def testExcludedNotRead(self):
+		"""Excluded directories aren't read ahead"""
+		root = self.make_tree()
+		scanned, scan_dir = [], rpath.scan_dir
+		def record_scan_dir(dir_rp):
+			scanned.append(dir_rp.index)
+			return scan_dir(dir_rp)
+		rpath.scan_dir = record_scan_dir
+		Globals.walker_threads, Globals.walker_prefetch = 3, 100
+		try: self.get_rps(root, [("--exclude", "testfiles/output/d2"),
+								 ("--include", "testfiles/output/d*/s1"),
+								 ("--exclude", "testfiles/output/d*/s*")])
+		finally: Globals.walker_threads, rpath.scan_dir = 0, scan_dir
+		for index in scanned:
+			assert index[:1] != ("d2",), scanned
+			assert len(index) < 2 or index[1] == "s1", scanned
+		assert ("d3", "s1") in scanned, scanned
+
+
 class CommandTest(unittest.TestCase):
 	"""Test rdiff-backup on actual directories"""
 	def testEmptyDirInclude(self):
@@ -0,0 +1,76 @@
+import os, unittest
+from commontest import *
+from rdiff_backup import sigcache, Globals, rpath, hash
+
+class SigCacheTest(unittest.TestCase):
+	"""Test storing, using, and pruning mirror file signatures"""
+	def setUp(self):
+		MakeOutputDir()
+		self.out_rp = rpath.RPath(Globals.local_connection, "testfiles/output")
+		Globals.rbdir = self.out_rp.append("rdiff-backup-data")
+		Globals.rbdir.mkdir()
+		self.old_min_size = Globals.signature_cache_min_size
+		Globals.signature_cache_min_size = 10
+
+	def tearDown(self):
+		Globals.signature_cache_min_size = self.old_min_size
+		sigcache.sig_dir_rp = None
+
+	def make_file(self, filename, data):
+		"""Write data to filename in the output dir, return rp and rorp"""
+		rp = self.out_rp.append(filename)
+		rp.write_string(data)
+		rorp = rp.getRORPath()
+		rorp.set_sha1(hash.sha.new(data).hexdigest())
+		return rp, rorp
+
+	def testStoreGet(self):
+		"""Stored signature is used only while the file is the same"""
+		rp, rorp = self.make_file("big", "0123456789" * 10)
+		assert not sigcache.get_signature(rp, rorp)
+		sigcache.store(rp.index, rp, rorp.get_sha1(), "sigdata")
+		fp = sigcache.get_signature(rp, rorp)
+		assert fp and fp.read() == "sigdata"
+		assert not fp.close()
+
+		other_rorp = rorp.getRORPath()
+		other_rorp.set_sha1("0" * 40)
+		assert not sigcache.get_signature(rp, other_rorp)
+
+		rp.chmod(0600) # changes the ctime
+		os.utime(rp.path, (0, 0))
+		rp.setdata()
+		assert not sigcache.get_signature(rp, rorp)
+
+		small_rp, small_rorp = self.make_file("small", "012345")
+		sigcache.store(small_rp.index, small_rp, small_rorp.get_sha1(), "s")
+		assert not sigcache.get_signature(small_rp, small_rorp)
+
+	def testPrune(self):
+		"""Least recently used signatures are deleted first"""
+		rps = []
+		for i in range(3):
+			rp, rorp = self.make_file("file%d" % i, "%d" % i * 20)
+			sigcache.store(rp.index, rp, rorp.get_sha1(), "x" * 100)
+			sig_rp = sigcache.get_sig_rp(rp.index)
+			os.utime(sig_rp.path, (1000 * (i + 1), 1000 * (i + 1)))
+			rps.append((rp, rorp))
+		fp = sigcache.get_signature(*rps[0]) # now most recently used
+		assert fp and not fp.close()
+		sig_dir_rp = sigcache.get_sig_dir()
+		sig_dir_rp.append("rdiff-backup.tmp.5").touch()
+
+		sig_size = sigcache.get_sig_rp(rps[0][0].index).getsize()
+		expected = [sigcache.get_sig_rp(rps[i][0].index).dirsplit()[1]
+					for i in (0, 2)]
+		expected.sort()
+		old_cache_size = Globals.signature_cache_size
+		Globals.signature_cache_size = 2 * sig_size
+		try: sigcache.close()
+		finally: Globals.signature_cache_size = old_cache_size
+		remaining = sig_dir_rp.listdir()
+		remaining.sort()
+		assert remaining == expected, (remaining, expected)
+
+
+if __name__ == "__main__": unittest.main()